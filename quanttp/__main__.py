@@ -22,26 +22,105 @@
 
 import os
 import sys
-import threading
 import json
 import socket
 import requests
 import base64
+import itertools
+import threading
+import time
 
-from flask import Flask, request, Response
+from flask import Flask, g, request, Response
 from flask_sockets import Sockets
 from gevent import pywsgi
+from gevent.server import StreamServer
 from geventwebsocket.handler import WebSocketHandler
-
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Rule
+
+from quanttp import asgi, batch, config, metrics, streaming, subscriptions, unixsocket, wire, workers
+from quanttp.scheduler import FairScheduler, QuotaExceeded
+from quanttp.shmring import ShmPublisher
+from quanttp.subscriptions import WS_COMMANDS
+from quanttp.data import conversions
+from quanttp.data.device_recovery import DeviceUnavailable, QUARANTINED, RECOVERING
+from quanttp.data.device_registry import DeviceRegistry
+from quanttp.data.entropy_pool import EntropyPools
+from quanttp.data.entropy_spool import EntropySpools, SpoolEmpty
 from quanttp.data.meterfeeder_wrapper import MeterFeederWrapper
+from quanttp.data.health_tests import SEVERITY, UNAVAILABLE, worst
+from quanttp.data.multi_device import MultiDeviceRouter, VIRTUAL_DEVICE_IDS
+from quanttp.data.pod_gateway import PodGateway
+from quanttp.data.request_coalescer import RequestCoalescer
 
 app = Flask(__name__)
 sockets = Sockets(app)
 
-mf_wrapper = MeterFeederWrapper()
+# Set up by init(): local generators, or upstream pods in gateway mode
+mf_wrapper = None
+registry = None
+pools = None
+spools = None
+recovery = None
+entropy = None
+scheduler = None
+
+def init(upstreams=None, worker=None):
+    global mf_wrapper, registry, pools, spools, recovery, entropy, scheduler
+    if mf_wrapper is not None:
+        return
+    if worker is not None and not worker.owner:
+        # Workers other than worker 0 are gateways to it
+        upstreams = [worker.ownerUrl]
+    if upstreams:
+        # The gateway stands in for the device wrapper. Pods keep their own
+        # pools, so reads go straight upstream, coalesced.
+        mf_wrapper = PodGateway(upstreams)
+        registry = DeviceRegistry(mf_wrapper, config.GATEWAY_REFRESH_INTERVAL)
+        source = RequestCoalescer(mf_wrapper)
+    else:
+        mf_wrapper = MeterFeederWrapper()
+        registry = DeviceRegistry(mf_wrapper)
+        # Quarantined generators drop out of the registry until they have recovered
+        recovery = mf_wrapper.recovery
+        recovery.addListener(lambda name, state: registry.requestRefresh())
+        pools = EntropyPools(RequestCoalescer(mf_wrapper))
+        registry.addListener(pools.sync)
+        source = pools
+        if config.SPOOL_DIR:
+            # Bursts are served from the spool, the rest from the pools
+            spools = EntropySpools(pools, mf_wrapper)
+            registry.addListener(spools.sync)
+            source = spools
+    # Failed generators drop out of the registry, and come back after a reset
+    mf_wrapper.health.addListener(lambda deviceId, status: registry.requestRefresh())
+    entropy = MultiDeviceRouter(source, registry.deviceIds)
+    if worker is not None and not worker.owner:
+        # Worker 0 admits and schedules the reads of every worker
+        scheduler = workers.OwnerScheduler(worker.ownerSocket, entropy)
+    else:
+        scheduler = FairScheduler(entropy) if config.SCHEDULER else None
 
 def main():
-    # Commandline Arguments (servername, port)
+    # Commandline Arguments (servername, port) or (gateway, servername, port, upstream URLs...)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'gateway':
+        if len(sys.argv) < 5:
+            print("--------------------------------------------------------------------------")
+            print("Please provide arguments: gateway <servername> <port> <upstream URL> [...]")
+            print("--------------------------------------------------------------------------")
+            return
+        servername = sys.argv[2]
+        port = int(sys.argv[3])
+        worker = start_worker(port)
+        init(sys.argv[4:], worker)
+        registry.start()
+        if worker is None or worker.owner:
+            print("----------------------------------------------------------------------------------------")
+            print("Gateway \"", servername, "\" on http://0.0.0.0:", port, "/api/... serving TRNG ", registry.csv(), " from ", ', '.join(sys.argv[4:]), sep='')
+            print("----------------------------------------------------------------------------------------")
+        serve(servername, port, worker)
+        return
 
     argNo = len(sys.argv) - 1
 
@@ -52,53 +131,130 @@ def main():
     else:
         servername = sys.argv[1]
         port = int(sys.argv[2])
-        ip = requests.get('https://api.ipify.org').text
-        id = str(mf_wrapper.deviceIds(False))
-        print("----------------------------------------------------------------------------------------")
-        print("Serving Entropy from TRNG ", id, " as pod \"", servername, "\" on http://", ip, ":", port, "/api/...", sep='')
-        print("----------------------------------------------------------------------------------------")
-        serve(servername, port, id)
+        worker = start_worker(port)
+        # Only the first worker opens the generators, the others serve them through it
+        init(None, worker)
+        registry.start()
+        if worker is None or worker.owner:
+            print("----------------------------------------------------------------------------------------")
+            print("Serving Entropy from TRNG ", registry.csv(), " as pod \"", servername, "\" on http://0.0.0.0:", port, "/api/...", sep='')
+            print("----------------------------------------------------------------------------------------")
+            if config.PUBLIC_IP_LOOKUP:
+                threading.Thread(target=print_public_address, args=(port,), daemon=True).start()
+        serve(servername, port, worker)
+
+def start_worker(port):
+    # This process's asyncio worker, None unless QUANTTP_WORKERS asks for several
+    if config.ENGINE != 'asyncio' or config.WORKERS < 2:
+        return None
+    asgi.require_uvicorn()
+    return workers.fork_workers(port, config.WORKERS)
+
+def print_public_address(port):
+    # Informational only, never holds up startup
+    try:
+        ip = requests.get(config.PUBLIC_IP_URL, timeout=10).text.strip()
+        print("Public address: http://", ip, ":", port, "/api/...", sep='')
+    except requests.RequestException as e:
+        print("Public address lookup failed:", e)
+
+def valid_device_id(deviceId):
+    return registry.isValid(deviceId)
+
+def device_status(deviceId):
+    if deviceId in VIRTUAL_DEVICE_IDS:
+        deviceIds = registry.deviceIds()
+        if len(deviceIds) == 0:
+            return UNAVAILABLE
+        return worst(mf_wrapper.status(d) for d in deviceIds)
+    return mf_wrapper.status(deviceId)
+
+def client_key():
+    return resolve_client_key(request.headers.get('X-API-Key') or request.args.get('apiKey'), request.remote_addr)
+
+def resolve_client_key(apiKey, address):
+    # The client's API key if it is one of QUANTTP_SCHED_CLIENTS, else its address
+    if apiKey and scheduler is not None and scheduler.knownClient(apiKey):
+        return apiKey
+    return address
+
+def client_entropy(clientKey=None, wait=False):
+    if scheduler is None:
+        return entropy
+    source = scheduler.client(client_key() if clientKey is None else clientKey, wait)
+    if not wait:
+        # Refused with 429 while the client is over its rate limit
+        source.admit()
+    return source
+
+def serve(servername, port, worker=None):
+
+    init()
+    registry.start()
+
+    # Metrics ----------------------------------------------
+
+    @app.before_request
+    def before_request():
+        g.route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        g.start = time.perf_counter()
+        metrics.HTTP_REQUESTS_IN_FLIGHT.inc(g.route)
+
+    @app.after_request
+    def after_request(response):
+        route, start, status = g.route, g.start, str(response.status_code)
+        # Streamed bodies are only finished when the response is closed
+        def finished():
+            metrics.HTTP_REQUESTS_IN_FLIGHT.dec(route)
+            metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, route, status)
+        response.call_on_close(finished)
+        return response
+
+    @app.route('/metrics')
+    def metricsexposition():
+        return Response(metrics.REGISTRY.exposition(), content_type='text/plain; version=0.0.4')
 
-def serve(servername, port, id):
 
     # Original API ----------------------------------------------
 
     @app.route('/api/devices')
     def devices():
-        devices = str(mf_wrapper.deviceIds(False))
+        devices = registry.csv()
         return Response(devices, content_type='text/plain')
 
     @app.route('/api/randint32')
     def randint32():
         deviceId = request.args.get('deviceId')
-        if len(deviceId) != 8:
-            return Response('deviceId must be a valid 8 character serial number', status=400, content_type='text/plain')
-        return Response(str(mf_wrapper.randint32(deviceId)), content_type='text/plain')
+        if not valid_device_id(deviceId):
+            return Response('deviceId must be the serial number of an attached device, ANY or XOR', status=400, content_type='text/plain')
+        return Response(str(conversions.int32(client_entropy().randbytes(deviceId, conversions.INT32_SIZE))), content_type='text/plain')
 
     @app.route('/api/randuniform')
     def randuniform():
         deviceId = request.args.get('deviceId')
-        if len(deviceId) != 8:
-            return Response('deviceId must be a valid 8 character serial number', status=400, content_type='text/plain')
-        return Response(str(mf_wrapper.randuniform(deviceId)), content_type='text/plain')
+        if not valid_device_id(deviceId):
+            return Response('deviceId must be the serial number of an attached device, ANY or XOR', status=400, content_type='text/plain')
+        return Response(str(conversions.uniform(client_entropy().randbytes(deviceId, conversions.UNIFORM_SIZE))), content_type='text/plain')
 
     @app.route('/api/randnormal')
     def randnormal():
         deviceId = request.args.get('deviceId')
-        if len(deviceId) != 8:
-            return Response('deviceId must be a valid 8 character serial number', status=400, content_type='text/plain')
-        return Response(str(mf_wrapper.randnormal(deviceId)), content_type='text/plain')
+        if not valid_device_id(deviceId):
+            return Response('deviceId must be the serial number of an attached device, ANY or XOR', status=400, content_type='text/plain')
+        return Response(str(conversions.normal(client_entropy().randbytes(deviceId, conversions.NORMAL_SIZE))), content_type='text/plain')
 
     @app.route('/api/randhex')
     def randhex():
         try:
             deviceId = request.args.get('deviceId')
-            if len(deviceId) != 8:
-                return Response('deviceId must be a valid 8 character serial number', status=400, content_type='text/plain')
+            if not valid_device_id(deviceId):
+                return Response('deviceId must be the serial number of an attached device, ANY or XOR', status=400, content_type='text/plain')
             length = int(request.args.get('length'))
             if length < 1:
                 return Response('length must be greater than 0', status=400, content_type='text/plain')
-            return Response(mf_wrapper.randbytes(deviceId, length).hex(), content_type='text/plain')
+            if length > config.STREAM_THRESHOLD:
+                return Response(streaming.hex_stream(streaming.chunks(client_entropy(), deviceId, length, config.STREAM_CHUNK_SIZE)), content_type='text/plain')
+            return Response(client_entropy().randbytes(deviceId, length).hex(), content_type='text/plain')
         except (TypeError, ValueError) as e:
             return Response(str(e), status=400, content_type='text/plain')
 
@@ -106,12 +262,14 @@ def serve(servername, port, id):
     def randbase64():
         try:
             deviceId = request.args.get('deviceId')
-            if len(deviceId) != 8:
-                return Response('deviceId must be a valid 8 character serial number', status=400, content_type='text/plain')
+            if not valid_device_id(deviceId):
+                return Response('deviceId must be the serial number of an attached device, ANY or XOR', status=400, content_type='text/plain')
             length = int(request.args.get('length'))
             if length < 1:
                 return Response('length must be greater than 0', status=400, content_type='text/plain')
-            return Response(base64.b64encode(mf_wrapper.randbytes(deviceId, length)).decode('utf-8'), content_type='text/plain')
+            if length > config.STREAM_THRESHOLD:
+                return Response(streaming.base64_stream(streaming.chunks(client_entropy(), deviceId, length, config.STREAM_CHUNK_SIZE)), content_type='text/plain')
+            return Response(base64.b64encode(client_entropy().randbytes(deviceId, length)).decode('utf-8'), content_type='text/plain')
         except (TypeError, ValueError) as e:
             return Response(str(e), status=400, content_type='text/plain')
 
@@ -120,54 +278,80 @@ def serve(servername, port, id):
     def randbytes():
         try:
             deviceId = request.args.get('deviceId')
-            if len(deviceId) != 8:
-                return Response('deviceId must be a valid 8 character serial number', status=400, content_type='text/plain')
+            if not valid_device_id(deviceId):
+                return Response('deviceId must be the serial number of an attached device, ANY or XOR', status=400, content_type='text/plain')
             length = int(request.args.get('length'))
             if length < 1:
                 return Response('length must be greater than 0', status=400, content_type='text/plain')
-            return Response(mf_wrapper.randbytes(deviceId, length), content_type='application/octet-stream')
+            if length > config.STREAM_THRESHOLD:
+                return Response(streaming.chunks(client_entropy(), deviceId, length, config.STREAM_CHUNK_SIZE), content_type='application/octet-stream')
+            # In a list, so that a memoryview from the spool is sent without a copy
+            return Response([client_entropy().randbytes(deviceId, length)], content_type='application/octet-stream')
         except (TypeError, ValueError) as e:
             return Response(str(e), status=400, content_type='text/plain')
 
     @app.route('/api/clear')
     def clear():
         deviceId = request.args.get('deviceId')
-        if len(deviceId) != 8:
-            return Response('deviceId must be a valid 8 character serial number', status=400, content_type='text/plain')
-        mf_wrapper.clear(deviceId)
+        if not valid_device_id(deviceId):
+            return Response('deviceId must be the serial number of an attached device, ANY or XOR', status=400, content_type='text/plain')
+        entropy.clear(deviceId)
         return Response(status=204)
         
     @app.route('/api/reset')
     def reset():
-        mf_wrapper.reset()
+        entropy.reset()
+        registry.requestRefresh()
         return Response(status=204)
 
     @app.route('/api/status')
     def status():
-        status = "ONLINE" # TODO implement me
-        return Response(json.dumps({"server" : servername, "devices": id, "status": status}), status=400, content_type='text/plain')
+        # Every generator seen so far, including those excluded after failing
+        deviceIds = sorted(set(registry.deviceIds()) | set(mf_wrapper.health.statuses()))
+        health = {deviceId: mf_wrapper.health.report(deviceId) for deviceId in deviceIds}
+        status = worst(report["status"] for report in health.values())
+        # Lets a gateway in front of this pod weigh its load
+        load = {"requestsInFlight": sum(metrics.HTTP_REQUESTS_IN_FLIGHT.values().values()) - 1}
+        fields = {"server" : servername, "devices": registry.csv(), "status": status, "health": health, "load": load}
+        if recovery is not None:
+            # Generators that were ever quarantined, and MF_Initialize as "backend"
+            fields["recovery"] = recovery.reports()
+        return Response(json.dumps(fields),
+                        status=200 if len(registry.deviceIds()) > 0 else 503, content_type='application/json')
 
     # JSON API ----------------------------------------------
 
     @app.route('/api/json/devices')
     def devicesjson():
-        devices = str(mf_wrapper.deviceIds(True))
+        devices = str(registry.generators())
         return Response('{"devices":'+devices+'}', content_type='application/json')
 
+    def numeric_response(name, values, length, status, format, dtype):
+        fields = {"server" : servername, "device": registry.csv(), "status": status, "type": "string", "format": name, "length":length}
+        if format == 'json':
+            fields.update({"data": values.tolist(), "success":True})
+            return Response(json.dumps(fields), content_type='application/json')
+        data = wire.pack(values, dtype)
+        if format == 'binary':
+            headers = {'X-Quanttp-Format': name, 'X-Quanttp-Dtype': dtype, 'X-Quanttp-Length': str(length), 'X-Quanttp-Device': registry.csv()}
+            return Response(data, content_type=wire.MIMETYPES['binary'], headers=headers)
+        fields.update({"type": "binary", "dtype": dtype, "data": data, "success":True})
+        return Response(wire.envelope(format, fields), content_type=wire.MIMETYPES[format])
+
     @app.route('/api/json/randint32')
     def randjsonint32():
         try:
             deviceId = request.args.get('deviceId')
-            if len(deviceId) != 8:
-                return Response(json.dumps({"error": 'deviceId must be a valid 8 character serial number', "success":False}), status=400, content_type='application/json')
-            status = str(mf_wrapper.status())
+            if not valid_device_id(deviceId):
+                return Response(json.dumps({"error": 'deviceId must be the serial number of an attached device, ANY or XOR', "success":False}), status=400, content_type='application/json')
+            status = device_status(deviceId)
             length = int(request.args.get('length'))
             if length < 1:
                 return Response(json.dumps({"error": 'length must be greater than 0', "success":False}), status=400, content_type='application/json')
-            int32array = []
-            for x in range(0, length):
-                int32array.append(mf_wrapper.randint32(deviceId))
-            return Response(json.dumps({"server" : servername, "device": id, "status": status, "type": "string", "format": "int32", "length":length, "data": int32array, "success":True}), content_type='application/json')
+            format = wire.negotiate(request.args.get('format'), request.accept_mimetypes)
+            dtype = wire.dtype('int32', request.args.get('dtype'))
+            int32array = conversions.int32_array(client_entropy().randbytes(deviceId, conversions.INT32_SIZE * length))
+            return numeric_response("int32", int32array, length, status, format, dtype)
         except (TypeError, ValueError) as e:
             return Response(json.dumps({"error": str(e), "status": status, "success":False}), status=400, content_type='application/json')
 
@@ -175,171 +359,229 @@ def serve(servername, port, id):
     def randjsonuniform():
         try:
             deviceId = request.args.get('deviceId')
-            if len(deviceId) != 8:
-                return Response(json.dumps({"error": 'deviceId must be a valid 8 character serial number', "success":False}), status=400, content_type='application/json')
-            status = str(mf_wrapper.status())
+            if not valid_device_id(deviceId):
+                return Response(json.dumps({"error": 'deviceId must be the serial number of an attached device, ANY or XOR', "success":False}), status=400, content_type='application/json')
+            status = device_status(deviceId)
             length = int(request.args.get('length'))
             if length < 1:
                 return Response(json.dumps({"error": 'length must be greater than 0', "success":False}), status=400, content_type='application/json')
-            uniformarray = []
-            for x in range(0, length):
-                uniformarray.append(mf_wrapper.randuniform(deviceId))
-            return Response(json.dumps({"server" : servername, "device": id, "status": status, "type": "string", "format": "uniform", "length":length, "data": uniformarray, "success":True}), content_type='application/json')
+            format = wire.negotiate(request.args.get('format'), request.accept_mimetypes)
+            dtype = wire.dtype('uniform', request.args.get('dtype'))
+            uniformarray = conversions.uniform_array(client_entropy().randbytes(deviceId, conversions.UNIFORM_SIZE * length))
+            return numeric_response("uniform", uniformarray, length, status, format, dtype)
         except (TypeError, ValueError) as e:
-            return Response(json.dumps({"error": str(e), "device": id, "status": status, "success":False}), status=400, content_type='application/json')
+            return Response(json.dumps({"error": str(e), "device": registry.csv(), "status": status, "success":False}), status=400, content_type='application/json')
 
     @app.route('/api/json/randnormal')
     def randjsonnormal():
         try:
             deviceId = request.args.get('deviceId')
-            if len(deviceId) != 8:
-                return Response(json.dumps({"error": 'deviceId must be a valid 8 character serial number', "success":False}), status=400, content_type='application/json')
-            status = str(mf_wrapper.status())
+            if not valid_device_id(deviceId):
+                return Response(json.dumps({"error": 'deviceId must be the serial number of an attached device, ANY or XOR', "success":False}), status=400, content_type='application/json')
+            status = device_status(deviceId)
             length = int(request.args.get('length'))
             if length < 1:
                 return Response(json.dumps({"error": 'length must be greater than 0', "success":False}), status=400, content_type='application/json')
-            normarray = []
-            for x in range(0, length):
-                normarray.append(mf_wrapper.randnormal(deviceId))
-            return Response(json.dumps({"server" : servername, "device": id, "status": status, "type": "string", "format": "normal", "length":length, "data": normarray, "success":True}), content_type='application/json')
+            format = wire.negotiate(request.args.get('format'), request.accept_mimetypes)
+            dtype = wire.dtype('normal', request.args.get('dtype'))
+            normarray = conversions.normal_array(client_entropy().randbytes(deviceId, conversions.NORMAL_SIZE * length))
+            return numeric_response("normal", normarray, length, status, format, dtype)
         except (TypeError, ValueError) as e:
-            return Response(json.dumps({"error": str(e), "device": id, "status": status, "success":False}), status=400, content_type='application/json')
+            return Response(json.dumps({"error": str(e), "device": registry.csv(), "status": status, "success":False}), status=400, content_type='application/json')
 
     @app.route('/api/json/randhex')
     def randjsonhex():
         try:
             deviceId = request.args.get('deviceId')
-            if len(deviceId) != 8:
-                return Response(json.dumps({"error": 'deviceId must be a valid 8 character serial number', "success":False}), status=400, content_type='application/json')
-            status = str(mf_wrapper.status())
+            if not valid_device_id(deviceId):
+                return Response(json.dumps({"error": 'deviceId must be the serial number of an attached device, ANY or XOR', "success":False}), status=400, content_type='application/json')
+            status = device_status(deviceId)
             length = int(request.args.get('length'))
             size = int(request.args.get('size'))
             if length < 1:
                 return Response(json.dumps({"error": 'length must be greater than 0', "success":False}), status=400, content_type='application/json')
             if size < 1:
                 return Response(json.dumps({"error": 'size must be greater than 0', "success":False}), status=400, content_type='application/json')
-#            entropy = mf_wrapper.randbytes(size*length)
-            hexarray = []
-            for x in range(0, length):
-                hexarray.append(mf_wrapper.randbytes(deviceId, size).hex())
-#                hexarray.append(entropy[x*size:(x+1)*size].hex())
-            return Response(json.dumps({"server" : servername, "device": id, "status": status, "type": "string", "format": "hex", "length":length, "size": size, "data": hexarray, "success":True}), content_type='application/json')
+            body = streaming.json_envelope({"server" : servername, "device": registry.csv(), "status": status, "type": "string", "format": "hex", "length":length, "size": size},
+                                           streaming.json_string_array(client_entropy(), deviceId, length, size, streaming.encode_hex, config.STREAM_CHUNK_SIZE))
+            if length * size > config.STREAM_THRESHOLD:
+                return Response(body, content_type='application/json')
+            return Response(''.join(body), content_type='application/json')
         except (TypeError, ValueError) as e:
-            return Response(json.dumps({"error": str(e), "device": id, "status": status, "success":False}), status=400, content_type='application/json')
+            return Response(json.dumps({"error": str(e), "device": registry.csv(), "status": status, "success":False}), status=400, content_type='application/json')
             
     @app.route('/api/json/randbase64')
     def randjsonbase64():
         try:
             deviceId = request.args.get('deviceId')
-            if len(deviceId) != 8:
-                return Response(json.dumps({"error": 'deviceId must be a valid 8 character serial number', "success":False}), status=400, content_type='application/json')
-            status = str(mf_wrapper.status())
+            if not valid_device_id(deviceId):
+                return Response(json.dumps({"error": 'deviceId must be the serial number of an attached device, ANY or XOR', "success":False}), status=400, content_type='application/json')
+            status = device_status(deviceId)
             length = int(request.args.get('length'))
             size = int(request.args.get('size'))
             if length < 1:
                 return Response(json.dumps({"error": 'length must be greater than 0', "success":False}), status=400, content_type='application/json')
             if size < 1:
                 return Response(json.dumps({"error": 'size must be greater than 0', "success":False}), status=400, content_type='application/json')
-#            entropy = mf_wrapper.randbytes(size*length)
-            basearray = []
-            for x in range(0, length):
-                basearray.append(base64.b64encode(mf_wrapper.randbytes(deviceId, size)).decode('utf-8'))
-#                basearray.append(base64.b64encode(entropy[x*size:(x+1)*size]).decode('utf-8'))
-            return Response(json.dumps({"server" : servername, "device": id, "status": status, "type": "string", "format": "base64", "length":length, "size": size, "data": basearray, "success":True}), content_type='application/json')
+            body = streaming.json_envelope({"server" : servername, "device": registry.csv(), "status": status, "type": "string", "format": "base64", "length":length, "size": size},
+                                           streaming.json_string_array(client_entropy(), deviceId, length, size, streaming.encode_base64, config.STREAM_CHUNK_SIZE))
+            if length * size > config.STREAM_THRESHOLD:
+                return Response(body, content_type='application/json')
+            return Response(''.join(body), content_type='application/json')
         except (TypeError, ValueError) as e:
-            return Response(json.dumps({"error": str(e), "device": id, "status": status, "success":False}), status=400, content_type='application/json')
-        
+            return Response(json.dumps({"error": str(e), "device": registry.csv(), "status": status, "success":False}), status=400, content_type='application/json')
+
+    @app.route('/api/json/batch', methods=['POST'])
+    def randjsonbatch():
+        try:
+            format = wire.negotiate(request.args.get('format'), request.accept_mimetypes)
+            draws = batch.parse(request.get_json(force=True, silent=True), valid_device_id, config.BATCH_MAX_DRAWS, config.BATCH_MAX_BYTES)
+            # Paid once per batch instead of once per draw
+            statuses = {deviceId: device_status(deviceId) for deviceId in batch.deviceIds(draws)}
+            status = worst(statuses.values())
+            batch.read(client_entropy(), draws)
+            if format == 'binary':
+                data = [draw.packed() for draw in draws]
+                offsets = [0] + list(itertools.accumulate(len(d) for d in data))[:-1]
+                headers = {'X-Quanttp-Format': 'batch', 'X-Quanttp-Dtype': ','.join(draw.dtype for draw in draws),
+                           'X-Quanttp-Offsets': ','.join(str(offset) for offset in offsets), 'X-Quanttp-Device': registry.csv()}
+                return Response(b''.join(data), content_type=wire.MIMETYPES['binary'], headers=headers)
+            fields = {"server" : servername, "device": registry.csv(), "status": status, "format": "batch",
+                      "results": [draw.result(statuses[draw.deviceId], format != 'json') for draw in draws], "success":True}
+            if format == 'json':
+                return Response(json.dumps(fields), content_type='application/json')
+            return Response(wire.envelope(format, fields), content_type=wire.MIMETYPES[format])
+        except (TypeError, ValueError) as e:
+            return Response(json.dumps({"error": str(e), "device": registry.csv(), "success":False}), status=400, content_type='application/json')
+
 
     # Websockets ----------------------------------------------
 
-    @sockets.route('/ws')
+    subscription_limiter = subscriptions.SubscriptionLimiter(config.WS_MAX_SUBSCRIPTIONS_PER_DEVICE)
+
+    metrics.REGISTRY.register(metrics.GaugeFunction(
+        'quanttp_ws_subscriptions', 'Active WebSocket subscriptions', ('device',),
+        lambda: {(deviceId,): count for deviceId, count in subscription_limiter.counts().items()}))
+    metrics.REGISTRY.register(metrics.GaugeFunction(
+        'quanttp_pool_bytes', 'Bytes waiting in the entropy pool', ('device',),
+        lambda: {(deviceId,): level for deviceId, level in (pools.levels() if pools is not None else {}).items()}))
+    metrics.REGISTRY.register(metrics.GaugeFunction(
+        'quanttp_spool_bytes', 'Unserved bytes in the entropy spool', ('device',),
+        lambda: {(deviceId,): level for deviceId, level in (spools.levels() if spools is not None else {}).items()}))
+    metrics.REGISTRY.register(metrics.GaugeFunction(
+        'quanttp_device_health', 'Health test status per generator: 0 OK, 1 DEGRADED, 2 FAILED', ('device',),
+        lambda: {(deviceId,): SEVERITY[status] for deviceId, status in mf_wrapper.health.statuses().items()}))
+    metrics.REGISTRY.register(metrics.GaugeFunction(
+        'quanttp_device_quarantined', 'Generators quarantined or being recovered: 1, else 0', ('device',),
+        lambda: {(name,): int(state in (QUARANTINED, RECOVERING)) for name, state in (recovery.states() if recovery is not None else {}).items()}))
+    if scheduler is not None:
+        metrics.REGISTRY.register(metrics.GaugeFunction(
+            'quanttp_sched_queued_bytes', 'Bytes waiting for the fair-share scheduler', ('device',),
+            lambda: {(deviceId,): queued for deviceId, queued in scheduler.queued().items()}))
+
+    def serve_commands(connection):
+        try:
+            while not connection.closed:
+                message = connection.receive()
+                if message is None:
+                    break
+                command = message.strip().upper().split(' ', 1)[0]
+                with metrics.WS_COMMAND_SECONDS.time(command if command in WS_COMMANDS else 'UNKNOWN'):
+                    handle_ws_message(message, connection)
+        finally:
+            connection.unsubscribe()
+
     def ws(websocket):
-        subscribed = [False]
-        while not websocket.closed:
-            threading.Thread(target=handle_ws_message, args=(websocket.receive(), websocket, subscribed)).start()
+        metrics.WS_CONNECTIONS.inc()
+        try:
+            serve_commands(subscriptions.Connection(websocket, subscription_limiter, config.WS_SEND_BUFFER, client_key()))
+        finally:
+            metrics.WS_CONNECTIONS.dec()
 
-    def handle_ws_message(message, websocket, subscribed):
+    # flask_sockets drops rule options, and Werkzeug 2 only matches WebSocket
+    # upgrades against rules declared with websocket=True
+    sockets.url_map.add(Rule('/ws', endpoint=ws, websocket=True))
+
+    def subscribe(websocket, deviceId, frames):
+        if not websocket.subscribe(deviceId, frames):
+            frames.close()
+            websocket.send('SUBSCRIPTION LIMIT REACHED')
+
+    def handle_ws_message(message, websocket):
         try:
             split_message = message.strip().upper().split()
             if split_message[0] == 'DEVICES':
-                websocket.send(str(mf_wrapper.deviceIds(False)))
+                websocket.send(registry.csv())
             elif split_message[0] == 'RANDINT32':
                 deviceId = split_message[1]
-                if len(deviceId) != 8:
+                if not valid_device_id(deviceId):
                     raise ValueError()
-                websocket.send(str(mf_wrapper.randint32(deviceId)))
+                websocket.send(str(conversions.int32(client_entropy(websocket.clientKey).randbytes(deviceId, conversions.INT32_SIZE))))
             elif split_message[0] == 'RANDUNIFORM':
                 deviceId = split_message[1]
-                if len(deviceId) != 8:
+                if not valid_device_id(deviceId):
                     raise ValueError()
-                websocket.send(str(mf_wrapper.randuniform(deviceId)))
+                websocket.send(str(conversions.uniform(client_entropy(websocket.clientKey).randbytes(deviceId, conversions.UNIFORM_SIZE))))
             elif split_message[0] == 'RANDNORMAL':
                 deviceId = split_message[1]
-                if len(deviceId) != 8:
+                if not valid_device_id(deviceId):
                     raise ValueError()
-                websocket.send(str(mf_wrapper.randnormal(deviceId)))
+                websocket.send(str(conversions.normal(client_entropy(websocket.clientKey).randbytes(deviceId, conversions.NORMAL_SIZE))))
             elif split_message[0] == 'RANDBYTES':
                 deviceId = split_message[1]
-                if len(deviceId) != 8:
+                if not valid_device_id(deviceId):
                     raise ValueError()
                 length = int(split_message[2])
                 if length < 1:
                     raise ValueError()
-                websocket.send(mf_wrapper.randbytes(deviceId, length))
-            elif split_message[0] == 'SUBSCRIBEINT32':
-                deviceId = split_message[1]
-                if len(deviceId) != 8:
-                    raise ValueError()
-                if not subscribed[0]:
-                    subscribed[0] = True
-                    while subscribed[0] and not websocket.closed:
-                        websocket.send(str(mf_wrapper.randint32(deviceId)))
-            elif split_message[0] == 'SUBSCRIBEUNIFORM':
+                websocket.send(client_entropy(websocket.clientKey).randbytes(deviceId, length))
+            elif split_message[0] in ('SUBSCRIBEINT32', 'SUBSCRIBEUNIFORM', 'SUBSCRIBENORMAL'):
                 deviceId = split_message[1]
-                if len(deviceId) != 8:
+                if not valid_device_id(deviceId):
                     raise ValueError()
-                if not subscribed[0]:
-                    subscribed[0] = True
-                    while subscribed[0] and not websocket.closed:
-                        websocket.send(str(mf_wrapper.randuniform(deviceId)))
-            elif split_message[0] == 'SUBSCRIBENORMAL':
+                batch = subscriptions.batch_size(split_message[2]) if len(split_message) > 2 else config.WS_BATCH_SIZE
+                if split_message[0] == 'SUBSCRIBEINT32':
+                    frames = subscriptions.value_frames(client_entropy(websocket.clientKey, wait=True), deviceId, conversions.int32_array, conversions.INT32_SIZE, batch, config.SUBSCRIBE_READ_VALUES)
+                elif split_message[0] == 'SUBSCRIBEUNIFORM':
+                    frames = subscriptions.value_frames(client_entropy(websocket.clientKey, wait=True), deviceId, conversions.uniform_array, conversions.UNIFORM_SIZE, batch, config.SUBSCRIBE_READ_VALUES)
+                else:
+                    frames = subscriptions.value_frames(client_entropy(websocket.clientKey, wait=True), deviceId, conversions.normal_array, conversions.NORMAL_SIZE, batch, config.SUBSCRIBE_READ_VALUES)
+                subscribe(websocket, deviceId, frames)
+            elif split_message[0] in ('SUBSCRIBEINT32BIN', 'SUBSCRIBEUNIFORMBIN', 'SUBSCRIBENORMALBIN'):
                 deviceId = split_message[1]
-                if len(deviceId) != 8:
-                    raise ValueError()
-                if not subscribed[0]:
-                    subscribed[0] = True
-                    while subscribed[0] and not websocket.closed:
-                        websocket.send(str(mf_wrapper.randnormal(deviceId)))
-            elif split_message[0] == 'SUBSCRIBEBYTES':
-                deviceId = split_message[1]
-                if len(deviceId) != 8:
-                    raise ValueError()
-                chunk = int(split_message[2])
-                if chunk < 1:
+                if not valid_device_id(deviceId):
                     raise ValueError()
-                if not subscribed[0]:
-                    subscribed[0] = True
-                    while subscribed[0] and not websocket.closed:
-                        websocket.send(mf_wrapper.randbytes(deviceId, chunk))
-            elif split_message[0] == 'SUBSCRIBEHEX':
+                batch = subscriptions.batch_size(split_message[2]) if len(split_message) > 2 else config.WS_BATCH_SIZE
+                if split_message[0] == 'SUBSCRIBEINT32BIN':
+                    frames = subscriptions.packed_frames(client_entropy(websocket.clientKey, wait=True), deviceId, conversions.int32_array, conversions.INT32_SIZE, batch, config.SUBSCRIBE_READ_VALUES, wire.dtype('int32', None))
+                elif split_message[0] == 'SUBSCRIBEUNIFORMBIN':
+                    frames = subscriptions.packed_frames(client_entropy(websocket.clientKey, wait=True), deviceId, conversions.uniform_array, conversions.UNIFORM_SIZE, batch, config.SUBSCRIBE_READ_VALUES, wire.dtype('uniform', None))
+                else:
+                    frames = subscriptions.packed_frames(client_entropy(websocket.clientKey, wait=True), deviceId, conversions.normal_array, conversions.NORMAL_SIZE, batch, config.SUBSCRIBE_READ_VALUES, wire.dtype('normal', None))
+                subscribe(websocket, deviceId, frames)
+            elif split_message[0] in ('SUBSCRIBEBYTES', 'SUBSCRIBEHEX'):
                 deviceId = split_message[1]
-                if len(deviceId) != 8:
+                if not valid_device_id(deviceId):
                     raise ValueError()
-                chunk = int(split_message[2])
-                if chunk < 1:
-                    raise ValueError()
-                if not subscribed[0]:
-                    subscribed[0] = True
-                    while subscribed[0] and not websocket.closed:
-                        websocket.send(mf_wrapper.randbytes(deviceId, chunk).hex())
+                chunk = subscriptions.chunk_size(split_message[2])
+                encode = None if split_message[0] == 'SUBSCRIBEBYTES' else streaming.encode_hex
+                subscribe(websocket, deviceId, subscriptions.byte_frames(client_entropy(websocket.clientKey, wait=True), deviceId, chunk, encode))
             elif split_message[0] == 'UNSUBSCRIBE':
-                subscribed[0] = False
+                websocket.unsubscribe()
                 websocket.send('UNSUBSCRIBED')
             elif split_message[0] == 'CLEAR':
                 deviceId = split_message[1]
-                if len(deviceId) != 8:
+                if not valid_device_id(deviceId):
                     raise ValueError()
-                mf_wrapper.clear(deviceId)
+                entropy.clear(deviceId)
+        except QuotaExceeded as e:
+            websocket.send('RATE LIMITED ' + str(e.retryAfter))
+        except SpoolEmpty:
+            websocket.send('SPOOL EMPTY')
+        except DeviceUnavailable:
+            websocket.send('DEVICE UNAVAILABLE')
+        except subscriptions.TooLarge as e:
+            websocket.send(str(e))
         except (IndexError, ValueError, BlockingIOError):
             pass
         except Exception as e:
@@ -347,9 +589,67 @@ def serve(servername, port, id):
 
     @app.errorhandler(Exception)
     def handle_exception(e):
-        return Response(e.description, status=e.code, content_type='text/plain')
+        if isinstance(e, QuotaExceeded):
+            return Response(str(e), status=429, headers={'Retry-After': str(e.retryAfter)}, content_type='text/plain')
+        if isinstance(e, (SpoolEmpty, DeviceUnavailable)):
+            return Response(str(e), status=503, content_type='text/plain')
+        if isinstance(e, HTTPException):
+            return Response(e.description, status=e.code, content_type='text/plain')
+        if isinstance(e, ValueError):
+            return Response(str(e), status=400, content_type='text/plain')
+        return Response(str(e), status=500, content_type='text/plain')
+
+    # Local transport ----------------------------------------------
+
+    # Left to the worker owning the generators
+    local = worker is None or worker.owner
+
+    if config.LOCAL_SHM_DIR and local:
+        publisher = ShmPublisher(client_entropy(config.LOCAL_CLIENT_KEY, wait=True), registry.deviceIds)
+        publisher.start()
+        metrics.REGISTRY.register(metrics.GaugeFunction(
+            'quanttp_local_ring_bytes', 'Unclaimed bytes in the shared-memory ring', ('device',),
+            lambda: {(deviceId,): level for deviceId, level in publisher.levels().items()}))
+
+    def unix_connection(sock, address):
+        metrics.LOCAL_CONNECTIONS.inc()
+        websocket = unixsocket.UnixSocketConnection(sock)
+        try:
+            serve_commands(subscriptions.Connection(websocket, subscription_limiter, config.WS_SEND_BUFFER, unixsocket.peer_key(sock)))
+        finally:
+            websocket.close()
+            metrics.LOCAL_CONNECTIONS.dec()
+
+    if config.LOCAL_SOCKET and local:
+        StreamServer(unixsocket.listen(config.LOCAL_SOCKET), unix_connection).start()
+
+    # Workers ----------------------------------------------
+
+    def worker_read(clientKey, deviceId, length, wait, admit):
+        # A read for a client of another worker, admitted and scheduled here
+        if scheduler is not None and admit:
+            scheduler.admit(clientKey, wait)
+        if length == 0:
+            return b''
+        if scheduler is None:
+            return entropy.randbytes(deviceId, length)
+        return scheduler.randbytes(clientKey, deviceId, length)
+
+    if worker is not None and worker.owner:
+        workers.serve_workers(worker.ownerSocket, worker_read)
+
+    if config.ENGINE == 'asyncio':
+        engine = asgi.Engine(servername, registry, entropy, client_entropy, resolve_client_key, device_status, app, subscription_limiter)
+        asgi.serve(engine, port, worker.sockets if worker is not None else None)
+        return
+    if config.ENGINE != 'pywsgi':
+        raise ValueError('unknown engine ' + config.ENGINE)
 
     server = pywsgi.WSGIServer(('0.0.0.0', port), application=app, handler_class=WebSocketHandler)
+    server.init_socket()
+    # Accepted connections inherit TCP_NODELAY. Without it keep-alive clients
+    # wait for a delayed ACK (~40 ms) between the response headers and body.
+    server.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     server.serve_forever()
 
 if __name__ == "__main__":
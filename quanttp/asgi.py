@@ -0,0 +1,510 @@
+##
+ # asyncio serving engine
+ #
+ # With QUANTTP_ENGINE=asyncio the API is served by an ASGI application on
+ # uvicorn instead of Flask on gevent's pywsgi. The hot endpoints, single
+ # values, plain byte encodings and the numeric JSON API, are answered by the
+ # handlers below without Flask. Every other request goes to the Flask app.
+ # URLs, parameters, responses and errors are the same in both engines.
+ #
+ # The data layer stays on the gevent hub in the main thread, where the
+ # scheduler, coalescer and router keep their greenlets and blocking device
+ # I/O keeps going to the per-device thread pools. The event loop runs in a
+ # thread of its own and awaits each read from the hub. /ws connections are
+ # served on the event loop with the same commands and replies as under
+ # pywsgi, a subscription being a task that awaits its reads and sends.
+ #
+ # With QUANTTP_WORKERS > 1 the engine runs in that many processes sharing the
+ # listening socket, see workers.py.
+ ##
+
+import asyncio
+import base64
+import io
+import json
+import sys
+import threading
+import time
+import urllib.parse
+
+import gevent
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from quanttp import config, metrics, streaming, subscriptions, wire
+from quanttp.scheduler import QuotaExceeded
+from quanttp.data import conversions
+from quanttp.data.device_recovery import DeviceUnavailable
+from quanttp.data.entropy_spool import SpoolEmpty
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+DEVICE_ID_ERROR = 'deviceId must be the serial number of an attached device, ANY or XOR'
+# Longest close reason a WebSocket close frame can hold
+_MAX_CLOSE_REASON = 123
+
+
+def require_uvicorn():
+    if uvicorn is None:
+        raise ImportError('QUANTTP_ENGINE=asyncio needs the uvicorn package')
+
+
+class HubBridge:
+    # Lets the event loop await functions run as greenlets on the gevent hub
+    # of the thread that made the bridge
+
+    def __init__(self):
+        self._hub = gevent.get_hub()
+
+    def wake(self, function, *args):
+        # From any thread, function runs in the hub's loop
+        self._hub.loop.run_callback_threadsafe(function, *args)
+
+    async def call(self, function, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.wake(gevent.spawn, self._run, loop, future, function, args)
+        return await future
+
+    def _run(self, loop, future, function, args):
+        try:
+            value = function(*args)
+        except Exception as e:
+            loop.call_soon_threadsafe(_reject, future, e)
+        else:
+            loop.call_soon_threadsafe(_resolve, future, value)
+
+
+def _resolve(future, value):
+    # A request whose client went away is cancelled while its read goes on
+    if not future.done():
+        future.set_result(value)
+
+
+def _reject(future, exception):
+    if not future.done():
+        future.set_exception(exception)
+
+
+class Request:
+
+    def __init__(self, scope):
+        self.args = {}
+        for name, value in urllib.parse.parse_qsl(scope['query_string'].decode('utf-8', 'replace'), keep_blank_values=True):
+            # Like Flask's request.args.get, the first value wins
+            self.args.setdefault(name, value)
+        self.headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+        self.remoteAddress = scope['client'][0] if scope.get('client') else None
+
+    def acceptMimetypes(self):
+        return parse_accept_header(self.headers.get('accept'), MIMEAccept)
+
+
+def _failure(e):
+    # The replies of the Flask app's error handler
+    if isinstance(e, QuotaExceeded):
+        return 429, str(e), 'text/plain', [('Retry-After', str(e.retryAfter))]
+    if isinstance(e, (SpoolEmpty, DeviceUnavailable)):
+        return 503, str(e), 'text/plain'
+    if isinstance(e, ValueError):
+        return 400, str(e), 'text/plain'
+    return 500, str(e), 'text/plain'
+
+
+async def _respond(send, status, body, contentType, headers=()):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    elif not isinstance(body, bytes):
+        body = bytes(body)
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', contentType.encode('latin-1')), (b'content-length', str(len(body)).encode('latin-1'))] +
+                           [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope['http_version'],
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': config.WORKERS > 1,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        value = value.decode('latin-1')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+class Engine:
+
+    def __init__(self, servername, registry, entropy, clientEntropy, resolveClientKey, deviceStatus, wsgiApp, subscriptionLimiter):
+        # entropy and clientEntropy(clientKey, wait) are used on the hub, the
+        # rest is safe to call from the event loop
+        self.servername = servername
+        self.registry = registry
+        self._entropy = entropy
+        self._clientEntropy = clientEntropy
+        self._resolveClientKey = resolveClientKey
+        self._deviceStatus = deviceStatus
+        self._wsgiApp = wsgiApp
+        self.subscriptionLimiter = subscriptionLimiter
+        self._hub = HubBridge()
+        self._routes = {
+            '/api/devices': self.devices,
+            '/api/randint32': lambda request: self.value(request, conversions.int32, conversions.INT32_SIZE),
+            '/api/randuniform': lambda request: self.value(request, conversions.uniform, conversions.UNIFORM_SIZE),
+            '/api/randnormal': lambda request: self.value(request, conversions.normal, conversions.NORMAL_SIZE),
+            '/api/randhex': lambda request: self.encoded(request, lambda data: data.hex(), 'text/plain'),
+            '/api/randbase64': lambda request: self.encoded(request, lambda data: base64.b64encode(data).decode('utf-8'), 'text/plain'),
+            '/api/randbytes': lambda request: self.encoded(request, bytes, 'application/octet-stream'),
+            '/api/json/devices': self.devicesjson,
+            '/api/json/randint32': lambda request: self.numeric(request, 'int32', conversions.int32_array, conversions.INT32_SIZE),
+            '/api/json/randuniform': lambda request: self.numeric(request, 'uniform', conversions.uniform_array, conversions.UNIFORM_SIZE),
+            '/api/json/randnormal': lambda request: self.numeric(request, 'normal', conversions.normal_array, conversions.NORMAL_SIZE),
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        elif scope['type'] == 'websocket':
+            await self._websocket(scope, receive, send)
+
+    def clientKey(self, request):
+        return self._resolveClientKey(request.headers.get('x-api-key') or request.args.get('apiKey'), request.remoteAddress)
+
+    async def read(self, clientKey, deviceId, length, wait=False):
+        return await self._hub.call(self._randbytes, clientKey, deviceId, length, wait)
+
+    def _randbytes(self, clientKey, deviceId, length, wait):
+        # On the hub
+        return self._clientEntropy(clientKey, wait).randbytes(deviceId, length)
+
+    async def clear(self, deviceId):
+        await self._hub.call(self._entropy.clear, deviceId)
+
+    # Hot endpoints ----------------------------------------------
+    # Each returns (status, body, content type[, headers]), or None to leave
+    # the request to the Flask app
+
+    async def devices(self, request):
+        return 200, self.registry.csv(), 'text/plain'
+
+    async def value(self, request, convert, size):
+        deviceId = request.args.get('deviceId')
+        if not self.registry.isValid(deviceId):
+            return 400, DEVICE_ID_ERROR, 'text/plain'
+        return 200, str(convert(await self.read(self.clientKey(request), deviceId, size))), 'text/plain'
+
+    async def encoded(self, request, encode, contentType):
+        try:
+            deviceId = request.args.get('deviceId')
+            if not self.registry.isValid(deviceId):
+                return 400, DEVICE_ID_ERROR, 'text/plain'
+            length = int(request.args.get('length'))
+            if length < 1:
+                return 400, 'length must be greater than 0', 'text/plain'
+            if length > config.STREAM_THRESHOLD:
+                # Streamed by the Flask app
+                return None
+            return 200, encode(await self.read(self.clientKey(request), deviceId, length)), contentType
+        except (TypeError, ValueError) as e:
+            return 400, str(e), 'text/plain'
+
+    async def devicesjson(self, request):
+        return 200, '{"devices":' + str(self.registry.generators()) + '}', 'application/json'
+
+    async def numeric(self, request, name, convert, size):
+        status = None
+        try:
+            deviceId = request.args.get('deviceId')
+            if not self.registry.isValid(deviceId):
+                return 400, json.dumps({"error": DEVICE_ID_ERROR, "success": False}), 'application/json'
+            status = self._deviceStatus(deviceId)
+            length = int(request.args.get('length'))
+            if length < 1:
+                return 400, json.dumps({"error": 'length must be greater than 0', "success": False}), 'application/json'
+            format = wire.negotiate(request.args.get('format'), request.acceptMimetypes())
+            dtype = wire.dtype(name, request.args.get('dtype'))
+            values = convert(await self.read(self.clientKey(request), deviceId, size * length))
+            return self._numericResponse(name, values, length, status, format, dtype)
+        except (TypeError, ValueError) as e:
+            fields = {"error": str(e), "device": self.registry.csv(), "status": status, "success": False}
+            if name == 'int32':
+                # /api/json/randint32 never named the device in its errors
+                del fields["device"]
+            return 400, json.dumps(fields), 'application/json'
+
+    def _numericResponse(self, name, values, length, status, format, dtype):
+        fields = {"server": self.servername, "device": self.registry.csv(), "status": status, "type": "string", "format": name, "length": length}
+        if format == 'json':
+            fields.update({"data": values.tolist(), "success": True})
+            return 200, json.dumps(fields), 'application/json'
+        data = wire.pack(values, dtype)
+        if format == 'binary':
+            headers = [('X-Quanttp-Format', name), ('X-Quanttp-Dtype', dtype), ('X-Quanttp-Length', str(length)), ('X-Quanttp-Device', self.registry.csv())]
+            return 200, data, wire.MIMETYPES['binary'], headers
+        fields.update({"type": "binary", "dtype": dtype, "data": data, "success": True})
+        return 200, wire.envelope(format, fields), wire.MIMETYPES[format]
+
+    # HTTP ----------------------------------------------
+
+    async def _http(self, scope, receive, send):
+        handler = self._routes.get(scope['path']) if scope['method'] == 'GET' else None
+        if handler is not None:
+            route = scope['path']
+            start = time.perf_counter()
+            reply = None
+            metrics.HTTP_REQUESTS_IN_FLIGHT.inc(route)
+            try:
+                try:
+                    reply = await handler(Request(scope))
+                except Exception as e:
+                    reply = _failure(e)
+                if reply is not None:
+                    await _respond(send, *reply)
+            finally:
+                metrics.HTTP_REQUESTS_IN_FLIGHT.dec(route)
+            if reply is not None:
+                metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, route, str(reply[0]))
+                return
+        await self._wsgi(scope, receive, send)
+
+    async def _wsgi(self, scope, receive, send):
+        # The Flask app runs on the hub, so its streamed responses keep
+        # prefetching with greenlets
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        status, headers, content, result = await self._hub.call(self._startWsgi, _environ(scope, b''.join(body)))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        if result is None:
+            await send({'type': 'http.response.body', 'body': content})
+            return
+        chunks = iter(result)
+        try:
+            while True:
+                chunk = await self._hub.call(next, chunks, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await self._hub.call(result.close)
+
+    def _startWsgi(self, environ):
+        # On the hub. A response of known length is collected right away,
+        # a streamed one is returned for the event loop to pull.
+        started = []
+        result = self._wsgiApp(environ, lambda status, headers, exc_info=None: started.extend((status, headers)))
+        status, headers = started
+        status = int(status.split(' ', 1)[0])
+        encoded = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        if environ['REQUEST_METHOD'] == 'HEAD' or any(name.lower() == 'content-length' for name, value in headers):
+            try:
+                return status, encoded, b''.join(bytes(chunk) for chunk in result), None
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        return status, encoded, None, result
+
+    # WebSocket ----------------------------------------------
+
+    async def _websocket(self, scope, receive, send):
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        if scope['path'] != '/ws':
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+        await send({'type': 'websocket.accept'})
+        session = WebSocketSession(self, send, self.clientKey(Request(scope)))
+        metrics.WS_CONNECTIONS.inc()
+        try:
+            while not session.closed:
+                message = await receive()
+                if message['type'] != 'websocket.receive':
+                    break
+                text = message.get('text')
+                if text is None:
+                    text = (message.get('bytes') or b'').decode('utf-8', 'replace')
+                command = text.strip().upper().split(' ', 1)[0]
+                with metrics.WS_COMMAND_SECONDS.time(command if command in subscriptions.WS_COMMANDS else 'UNKNOWN'):
+                    await session.handle(text)
+        finally:
+            session.closed = True
+            session.unsubscribe()
+            metrics.WS_CONNECTIONS.dec()
+
+
+VALUES = {
+    'RANDINT32': (conversions.int32, conversions.INT32_SIZE),
+    'RANDUNIFORM': (conversions.uniform, conversions.UNIFORM_SIZE),
+    'RANDNORMAL': (conversions.normal, conversions.NORMAL_SIZE),
+}
+# Conversion, bytes per value and, for binary frames, the name of the values
+SUBSCRIBE_VALUES = {
+    'SUBSCRIBEINT32': (conversions.int32_array, conversions.INT32_SIZE, None),
+    'SUBSCRIBEUNIFORM': (conversions.uniform_array, conversions.UNIFORM_SIZE, None),
+    'SUBSCRIBENORMAL': (conversions.normal_array, conversions.NORMAL_SIZE, None),
+    'SUBSCRIBEINT32BIN': (conversions.int32_array, conversions.INT32_SIZE, 'int32'),
+    'SUBSCRIBEUNIFORMBIN': (conversions.uniform_array, conversions.UNIFORM_SIZE, 'uniform'),
+    'SUBSCRIBENORMALBIN': (conversions.normal_array, conversions.NORMAL_SIZE, 'normal'),
+}
+
+
+class WebSocketSession:
+    # A /ws connection on the event loop, with the commands, replies and
+    # subscription behaviour of the command handler in __main__. A
+    # subscription is a task that awaits each frame's send before making the
+    # next, so a client that stops reading stops its device reads.
+
+    def __init__(self, engine, send, clientKey):
+        self._engine = engine
+        self._send = send
+        self.clientKey = clientKey
+        self._sendLock = asyncio.Lock()
+        self._task = None
+        self.closed = False
+
+    async def send(self, message):
+        async with self._sendLock:
+            await self._sendFrame(message)
+
+    async def _sendFrame(self, message):
+        if isinstance(message, str):
+            await self._send({'type': 'websocket.send', 'text': message})
+        else:
+            await self._send({'type': 'websocket.send', 'bytes': bytes(message)})
+
+    async def close(self, code=1000, message=''):
+        self.unsubscribe()
+        if self.closed:
+            return
+        self.closed = True
+        reason = message.encode('utf-8')[:_MAX_CLOSE_REASON].decode('utf-8', 'ignore')
+        try:
+            await self._send({'type': 'websocket.close', 'code': code, 'reason': reason})
+        except OSError:
+            pass
+
+    def _deviceId(self, split_message):
+        deviceId = split_message[1]
+        if not self._engine.registry.isValid(deviceId):
+            raise ValueError()
+        return deviceId
+
+    async def handle(self, message):
+        try:
+            split_message = message.strip().upper().split()
+            command = split_message[0]
+            if command == 'DEVICES':
+                await self.send(self._engine.registry.csv())
+            elif command in VALUES:
+                deviceId = self._deviceId(split_message)
+                convert, size = VALUES[command]
+                await self.send(str(convert(await self._engine.read(self.clientKey, deviceId, size))))
+            elif command == 'RANDBYTES':
+                deviceId = self._deviceId(split_message)
+                length = int(split_message[2])
+                if length < 1:
+                    raise ValueError()
+                await self.send(await self._engine.read(self.clientKey, deviceId, length))
+            elif command in SUBSCRIBE_VALUES:
+                deviceId = self._deviceId(split_message)
+                batch = subscriptions.batch_size(split_message[2]) if len(split_message) > 2 else config.WS_BATCH_SIZE
+                convert, size, name = SUBSCRIBE_VALUES[command]
+                if name is None:
+                    framer = subscriptions.value_framer(convert, size, batch, config.SUBSCRIBE_READ_VALUES)
+                else:
+                    framer = subscriptions.packed_framer(convert, size, batch, config.SUBSCRIBE_READ_VALUES, wire.dtype(name, None))
+                await self._subscribe(deviceId, *framer)
+            elif command in ('SUBSCRIBEBYTES', 'SUBSCRIBEHEX'):
+                deviceId = self._deviceId(split_message)
+                chunk = subscriptions.chunk_size(split_message[2])
+                encode = None if command == 'SUBSCRIBEBYTES' else streaming.encode_hex
+                await self._subscribe(deviceId, *subscriptions.byte_framer(chunk, encode))
+            elif command == 'UNSUBSCRIBE':
+                self.unsubscribe()
+                await self.send('UNSUBSCRIBED')
+            elif command == 'CLEAR':
+                await self._engine.clear(self._deviceId(split_message))
+        except QuotaExceeded as e:
+            await self.send('RATE LIMITED ' + str(e.retryAfter))
+        except SpoolEmpty:
+            await self.send('SPOOL EMPTY')
+        except DeviceUnavailable:
+            await self.send('DEVICE UNAVAILABLE')
+        except subscriptions.TooLarge as e:
+            await self.send(str(e))
+        except (IndexError, ValueError, BlockingIOError):
+            pass
+        except Exception as e:
+            await self.close(code=1011, message=str(e))
+
+    async def _subscribe(self, deviceId, readSize, framer):
+        # Like before, a second SUBSCRIBE while one is running is ignored
+        if self._task is not None:
+            return
+        if not self._engine.subscriptionLimiter.acquire(deviceId):
+            await self.send('SUBSCRIPTION LIMIT REACHED')
+            return
+        self._task = asyncio.ensure_future(self._run(deviceId, readSize, framer))
+
+    def unsubscribe(self):
+        self._task = None
+
+    async def _run(self, deviceId, readSize, framer):
+        task = asyncio.current_task()
+        try:
+            while True:
+                data = await self._engine.read(self.clientKey, deviceId, readSize, wait=True)
+                for frame in framer(data):
+                    async with self._sendLock:
+                        # Checked under the send lock so nothing follows UNSUBSCRIBED
+                        if self._task is not task or self.closed:
+                            return
+                        await self._sendFrame(frame)
+        except OSError:
+            pass
+        except Exception as e:
+            await self.close(code=1011, message=str(e))
+        finally:
+            self._engine.subscriptionLimiter.release(deviceId)
+            if self._task is task:
+                self._task = None
+
+
+def serve(engine, port, sockets=None):
+    # The event loop runs in a thread of its own, the calling thread keeps
+    # running the hub for the data layer
+    require_uvicorn()
+    server = uvicorn.Server(uvicorn.Config(engine, host='0.0.0.0', port=port, lifespan='off', log_level='warning', access_log=False))
+    thread = threading.Thread(target=server.run, kwargs={'sockets': sockets}, name='asyncio-engine', daemon=True)
+    thread.start()
+    while thread.is_alive():
+        gevent.sleep(1)
+
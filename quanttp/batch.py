@@ -0,0 +1,128 @@
+##
+ # Batch requests
+ #
+ # POST /api/json/batch takes a JSON list of draws, e.g.
+ #
+ #   [{"format": "int32", "deviceId": "ANY", "length": 4},
+ #    {"format": "normal", "deviceId": "QWR4E001", "length": 16, "dtype": "float32"},
+ #    {"format": "hex", "deviceId": "ANY", "length": 2, "size": 32}]
+ #
+ # Draws are planned per deviceId: every deviceId is read once for the bytes
+ # of all its draws, the deviceIds in parallel, and each draw converts its own
+ # disjoint slice of that read. The values are the ones the separate JSON API
+ # requests would have returned, in the order of the draws.
+ ##
+
+import gevent
+
+from quanttp import streaming, wire
+from quanttp.data import conversions
+
+# Bytes per value and the conversion of a whole buffer
+NUMERIC = {
+    'int32': (conversions.INT32_SIZE, conversions.int32_array),
+    'uniform': (conversions.UNIFORM_SIZE, conversions.uniform_array),
+    'normal': (conversions.NORMAL_SIZE, conversions.normal_array),
+}
+# Strings of size bytes each
+STRINGS = {
+    'hex': streaming.encode_hex,
+    'base64': streaming.encode_base64,
+}
+# Raw bytes of a string draw in the binary formats
+RAW_DTYPE = '|u1'
+
+
+class Draw:
+
+    def __init__(self, format, deviceId, length, size, dtype):
+        self.format = format
+        self.deviceId = deviceId
+        self.length = length
+        self.size = size
+        self.dtype = dtype
+        self.byteCount = length * (NUMERIC[format][0] if format in NUMERIC else size)
+        self.data = None
+
+    def values(self):
+        if self.format in NUMERIC:
+            return NUMERIC[self.format][1](self.data)
+        encode = STRINGS[self.format]
+        return [encode(self.data[i * self.size:(i + 1) * self.size]) for i in range(self.length)]
+
+    def packed(self):
+        if self.format in NUMERIC:
+            return wire.pack(self.values(), self.dtype)
+        return bytes(self.data)
+
+    def result(self, status, binary):
+        result = {"format": self.format, "deviceId": self.deviceId, "status": status, "length": self.length}
+        if self.size is not None:
+            result["size"] = self.size
+        if binary:
+            result.update({"type": "binary", "dtype": self.dtype, "data": self.packed()})
+        else:
+            result.update({"type": "string", "data": self.values().tolist() if self.format in NUMERIC else self.values()})
+        return result
+
+
+def _int(spec, name, index):
+    value = spec.get(name)
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise ValueError('draw %d: %s must be an integer greater than 0' % (index, name))
+    return value
+
+
+def parse(specs, validDeviceId, maxDraws, maxBytes):
+    if not isinstance(specs, list) or len(specs) == 0:
+        raise ValueError('the request body must be a non-empty JSON list of draws')
+    if len(specs) > maxDraws:
+        raise ValueError('a batch may hold at most %d draws' % maxDraws)
+    draws = []
+    for index, spec in enumerate(specs):
+        if not isinstance(spec, dict):
+            raise ValueError('draw %d: must be an object' % index)
+        format = spec.get('format')
+        if format not in NUMERIC and format not in STRINGS:
+            raise ValueError('draw %d: format must be one of %s' % (index, ', '.join(list(NUMERIC) + list(STRINGS))))
+        deviceId = spec.get('deviceId')
+        if not isinstance(deviceId, str) or not validDeviceId(deviceId):
+            raise ValueError('draw %d: deviceId must be the serial number of an attached device, ANY or XOR' % index)
+        length = _int(spec, 'length', index)
+        if format in NUMERIC:
+            size = None
+            try:
+                dtype = wire.dtype(format, spec.get('dtype'))
+            except ValueError as e:
+                raise ValueError('draw %d: %s' % (index, e))
+        else:
+            size = _int(spec, 'size', index)
+            dtype = RAW_DTYPE
+        draws.append(Draw(format, deviceId, length, size, dtype))
+    if sum(draw.byteCount for draw in draws) > maxBytes:
+        raise ValueError('a batch may draw at most %d bytes' % maxBytes)
+    return draws
+
+
+def deviceIds(draws):
+    return list(dict.fromkeys(draw.deviceId for draw in draws))
+
+
+def read(source, draws):
+    # One read per deviceId, then every draw gets a view of its slice
+    plan = {}
+    for draw in draws:
+        plan.setdefault(draw.deviceId, []).append(draw)
+    reads = [(deviceId, sum(draw.byteCount for draw in planned)) for deviceId, planned in plan.items()]
+    if len(reads) == 1:
+        results = [source.randbytes(*reads[0])]
+    else:
+        greenlets = [gevent.spawn(source.randbytes, deviceId, length) for deviceId, length in reads]
+        gevent.joinall(greenlets, raise_error=True)
+        results = [greenlet.value for greenlet in greenlets]
+    for (deviceId, length), data in zip(reads, results):
+        view = memoryview(data)
+        offset = 0
+        for draw in plan[deviceId]:
+            draw.data = view[offset:offset + draw.byteCount]
+            offset += draw.byteCount
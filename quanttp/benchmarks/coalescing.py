@@ -0,0 +1,73 @@
+##
+ # Direct versus coalesced small device reads
+ #
+ #   python3 -m quanttp.benchmarks.coalescing [clients] [seconds] [length]
+ #
+ # Runs concurrent clients that each draw length bytes (4 by default, one
+ # int32) in a loop from a simulated generator, first with one MF_GetBytes call
+ # per draw and then through the RequestCoalescer. Reports draws per second,
+ # p50/p99 latency and the number of device calls for both.
+ ##
+
+import sys
+import time
+
+import gevent
+
+from quanttp import config
+from quanttp.data.meterfeeder_wrapper import MeterFeederWrapper
+from quanttp.data.request_coalescer import RequestCoalescer
+from quanttp.data.simulated_backend import SimulatedMeterFeeder
+
+
+class CountingSource:
+
+    def __init__(self, source):
+        self.calls = 0
+        self._source = source
+
+    def randbytes(self, deviceId, length):
+        self.calls += 1
+        return self._source.randbytes(deviceId, length)
+
+
+def run(name, source, deviceId, clients, seconds, length):
+    latencies = []
+    deadline = time.perf_counter() + seconds
+
+    def client():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            source.randbytes(deviceId, length)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    gevent.joinall([gevent.spawn(client) for i in range(clients)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print("%-10s %12.0f %10.2f %10.2f" % (
+        name, len(latencies) / elapsed,
+        latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000), end='')
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    length = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    mf_wrapper = MeterFeederWrapper(SimulatedMeterFeeder(devices=1))
+    deviceId = mf_wrapper.deviceIds(True)[0].split("|")[0]
+
+    print("%d clients, %d bytes per draw, %.4f s window, simulated latency %.4f s" % (
+        clients, length, config.COALESCE_WINDOW, config.SIM_LATENCY))
+    print("%-10s %12s %10s %10s %12s" % ("mode", "draws/s", "p50 ms", "p99 ms", "device calls"))
+    direct = CountingSource(mf_wrapper)
+    run("direct", direct, deviceId, clients, seconds, length)
+    print(" %12d" % direct.calls)
+    counting = CountingSource(mf_wrapper)
+    run("coalesced", RequestCoalescer(counting), deviceId, clients, seconds, length)
+    print(" %12d" % counting.calls)
+
+
+if __name__ == "__main__":
+    main()
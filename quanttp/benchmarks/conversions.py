@@ -0,0 +1,62 @@
+##
+ # Per-element cost of the JSON numeric arrays: one draw per element versus
+ # one bulk read converted with NumPy
+ #
+ #   python3 -m quanttp.benchmarks.conversions [length] [deviceId]
+ #
+ # Without a deviceId, os.urandom stands in for the device so that only the
+ # per-call and conversion overhead is measured. With a deviceId the real
+ # MF_RandInt32/MF_RandUniform/MF_RandNormal calls are compared against a
+ # single MF_GetBytes read.
+ ##
+
+import os
+import sys
+import time
+
+from quanttp.data import conversions
+
+
+def _time(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main():
+    length = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    deviceId = sys.argv[2] if len(sys.argv) > 2 else None
+
+    if deviceId is None:
+        source = lambda n: os.urandom(n)
+        per_call = {
+            'int32': lambda: conversions.int32(source(conversions.INT32_SIZE)),
+            'uniform': lambda: conversions.uniform(source(conversions.UNIFORM_SIZE)),
+            'normal': lambda: conversions.normal(source(conversions.NORMAL_SIZE)),
+        }
+    else:
+        from quanttp.data.meterfeeder_wrapper import MeterFeederWrapper
+        mf_wrapper = MeterFeederWrapper()
+        source = lambda n: mf_wrapper.randbytes(deviceId, n)
+        per_call = {
+            'int32': lambda: mf_wrapper.randint32(deviceId),
+            'uniform': lambda: mf_wrapper.randuniform(deviceId),
+            'normal': lambda: mf_wrapper.randnormal(deviceId),
+        }
+    bulk = {
+        'int32': lambda: conversions.int32_array(source(conversions.INT32_SIZE * length)).tolist(),
+        'uniform': lambda: conversions.uniform_array(source(conversions.UNIFORM_SIZE * length)).tolist(),
+        'normal': lambda: conversions.normal_array(source(conversions.NORMAL_SIZE * length)).tolist(),
+    }
+
+    print("length:", length, "source:", deviceId or "os.urandom")
+    print("%-8s %14s %14s %9s" % ("format", "per-call ns", "bulk ns", "speedup"))
+    for name in ('int32', 'uniform', 'normal'):
+        draw = per_call[name]
+        loop = _time(lambda: [draw() for x in range(length)])
+        vectorized = _time(bulk[name])
+        print("%-8s %14.1f %14.1f %8.1fx" % (name, loop / length * 1e9, vectorized / length * 1e9, loop / vectorized))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+##
+ # End-to-end throughput and latency benchmark
+ #
+ # Drives every REST and WebSocket endpoint of a running server at a fixed
+ # concurrency and reports requests/sec, bytes/sec and p50/p99/p999 latency.
+ # Each subscription is run twice: for frames/sec, with the time between
+ # frames as latency, and for the time from SUBSCRIBE to the first frame.
+ # Start a server without hardware with
+ #
+ #   QUANTTP_BACKEND=simulated python3 -m quanttp bench 8080
+ #
+ # and run
+ #
+ #   python3 -m quanttp.benchmarks.endpoints http://localhost:8080 SIM00001
+ ##
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import time
+
+import gevent
+import requests
+
+from quanttp.wsclient import WebSocketClient
+
+
+def percentile(latencies, p):
+    if len(latencies) == 0:
+        return float('nan')
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+def rest_scenarios(deviceId, length, size):
+    return [
+        ('/api/devices', {}),
+        ('/api/json/devices', {}),
+        ('/api/status', {}),
+        ('/api/randint32', {'deviceId': deviceId}),
+        ('/api/randuniform', {'deviceId': deviceId}),
+        ('/api/randnormal', {'deviceId': deviceId}),
+        ('/api/randbytes', {'deviceId': deviceId, 'length': length}),
+        ('/api/randhex', {'deviceId': deviceId, 'length': length}),
+        ('/api/randbase64', {'deviceId': deviceId, 'length': length}),
+        ('/api/json/randint32', {'deviceId': deviceId, 'length': length}),
+        ('/api/json/randuniform', {'deviceId': deviceId, 'length': length}),
+        ('/api/json/randnormal', {'deviceId': deviceId, 'length': length}),
+        ('/api/json/randint32', {'deviceId': deviceId, 'length': length, 'format': 'binary'}),
+        ('/api/json/randuniform', {'deviceId': deviceId, 'length': length, 'format': 'binary'}),
+        ('/api/json/randnormal', {'deviceId': deviceId, 'length': length, 'format': 'binary'}),
+        ('/api/json/randhex', {'deviceId': deviceId, 'length': length, 'size': size}),
+        ('/api/json/randbase64', {'deviceId': deviceId, 'length': length, 'size': size}),
+    ]
+
+
+def job_draws(deviceId, size):
+    # A typical job: a few ints, a normal vector and some hex keys
+    return [
+        {'format': 'int32', 'deviceId': deviceId, 'length': 4},
+        {'format': 'normal', 'deviceId': deviceId, 'length': 16},
+        {'format': 'hex', 'deviceId': deviceId, 'length': 4, 'size': size},
+    ]
+
+
+def ws_scenarios(deviceId, length):
+    return [
+        'DEVICES',
+        'RANDINT32 ' + deviceId,
+        'RANDUNIFORM ' + deviceId,
+        'RANDNORMAL ' + deviceId,
+        'RANDBYTES ' + deviceId + ' ' + str(length),
+    ]
+
+
+def subscription_scenarios(deviceId, length, batch):
+    return [
+        'SUBSCRIBEINT32 ' + deviceId,
+        'SUBSCRIBEUNIFORM ' + deviceId,
+        'SUBSCRIBENORMAL ' + deviceId,
+        'SUBSCRIBEINT32 ' + deviceId + ' ' + str(batch),
+        'SUBSCRIBEUNIFORM ' + deviceId + ' ' + str(batch),
+        'SUBSCRIBENORMAL ' + deviceId + ' ' + str(batch),
+        'SUBSCRIBEINT32BIN ' + deviceId + ' ' + str(batch),
+        'SUBSCRIBEUNIFORMBIN ' + deviceId + ' ' + str(batch),
+        'SUBSCRIBENORMALBIN ' + deviceId + ' ' + str(batch),
+        'SUBSCRIBEBYTES ' + deviceId + ' ' + str(length),
+        'SUBSCRIBEHEX ' + deviceId + ' ' + str(length),
+    ]
+
+
+def run(name, concurrency, duration, connect, request):
+    # request(connection) returns the bytes received, or the bytes and the
+    # latency to record if that is not the duration of the whole call
+    latencies = []
+    received = [0]
+    errors = [0]
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        connection = connect()
+        try:
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    # request() yields to other workers, so add its result afterwards
+                    n = request(connection)
+                except Exception:
+                    errors[0] += 1
+                    continue
+                latency = time.perf_counter() - start
+                if isinstance(n, tuple):
+                    n, latency = n
+                received[0] += n
+                latencies.append(latency)
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    gevent.joinall([gevent.spawn(worker) for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print("%-56s %10.0f %12.0f %9.2f %9.2f %9.2f %7d" % (
+        name, len(latencies) / elapsed, received[0] / elapsed,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, percentile(latencies, 0.999) * 1000,
+        errors[0]))
+    return len(latencies) / elapsed, percentile(latencies, 0.99)
+
+
+def run_rest(baseUrl, path, params, concurrency, duration):
+    def request(session):
+        response = session.get(baseUrl + path, params=params)
+        if response.status_code >= 500:
+            raise IOError(response.status_code)
+        return len(response.content)
+    query = '&'.join('%s=%s' % item for item in params.items())
+    run('GET ' + path + ('?' + query if query else ''), concurrency, duration, requests.Session, request)
+
+
+def run_job(baseUrl, draws, concurrency, duration):
+    # One JSON API request per draw, one after the other
+    def request(session):
+        received = 0
+        for draw in draws:
+            params = {key: value for key, value in draw.items() if key != 'format'}
+            response = session.get(baseUrl + '/api/json/rand' + draw['format'], params=params)
+            if response.status_code >= 500:
+                raise IOError(response.status_code)
+            received += len(response.content)
+        return received
+    run('JOB %d x GET /api/json/rand...' % len(draws), concurrency, duration, requests.Session, request)
+
+
+def run_batch(baseUrl, draws, concurrency, duration):
+    def request(session):
+        response = session.post(baseUrl + '/api/json/batch', json=draws)
+        if response.status_code >= 500:
+            raise IOError(response.status_code)
+        return len(response.content)
+    run('JOB POST /api/json/batch (%d draws)' % len(draws), concurrency, duration, requests.Session, request)
+
+
+def run_ws(wsUrl, command, concurrency, duration):
+    def request(websocket):
+        websocket.send(command)
+        return len(websocket.receive())
+    run('WS ' + command, concurrency, duration, lambda: WebSocketClient(wsUrl), request)
+
+
+def run_ws_subscription(wsUrl, command, concurrency, duration):
+    # Throughput: every received frame counts as one request, its latency is
+    # the time since the previous frame
+    def connect():
+        websocket = WebSocketClient(wsUrl)
+        websocket.send(command)
+        return websocket
+    run('WS ' + command, concurrency, duration, connect, lambda websocket: len(websocket.receive()))
+
+
+def run_ws_subscribe(wsUrl, command, concurrency, duration):
+    # Latency: subscribe, wait for the first frame and unsubscribe again. The
+    # latency is the time until the first frame.
+    def request(websocket):
+        start = time.perf_counter()
+        websocket.send(command)
+        received = len(websocket.receive())
+        latency = time.perf_counter() - start
+        websocket.send('UNSUBSCRIBE')
+        # Frames sent before the server saw UNSUBSCRIBE
+        while websocket.receive() != 'UNSUBSCRIBED':
+            pass
+        return received, latency
+    run('WS ' + command + ' first frame', concurrency, duration, lambda: WebSocketClient(wsUrl), request)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark a running Pod Entropy Server')
+    parser.add_argument('url', help='base URL, e.g. http://localhost:8080')
+    parser.add_argument('deviceId', help='device to draw from, e.g. SIM00001 or ANY')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per endpoint')
+    parser.add_argument('--length', type=int, default=1024)
+    parser.add_argument('--size', type=int, default=16)
+    parser.add_argument('--batch', type=int, default=256, help='values per subscription frame')
+    parser.add_argument('--only', default=None, help='only run scenarios whose name contains this text')
+    args = parser.parse_args()
+
+    baseUrl = args.url.rstrip('/')
+    wsUrl = 'ws' + baseUrl[len('http'):] + '/ws'
+    selected = lambda name: args.only is None or args.only in name
+
+    print("concurrency %d, %.1f s per endpoint" % (args.concurrency, args.duration))
+    print("%-56s %10s %12s %9s %9s %9s %7s" % ("endpoint", "req/s", "bytes/s", "p50 ms", "p99 ms", "p999 ms", "errors"))
+    for path, params in rest_scenarios(args.deviceId, args.length, args.size):
+        if selected(path):
+            run_rest(baseUrl, path, params, args.concurrency, args.duration)
+    if selected('JOB'):
+        run_job(baseUrl, job_draws(args.deviceId, args.size), args.concurrency, args.duration)
+        run_batch(baseUrl, job_draws(args.deviceId, args.size), args.concurrency, args.duration)
+    for command in ws_scenarios(args.deviceId, args.length):
+        if selected(command):
+            run_ws(wsUrl, command, args.concurrency, args.duration)
+    for command in subscription_scenarios(args.deviceId, args.length, args.batch):
+        if selected(command):
+            run_ws_subscription(wsUrl, command, args.concurrency, args.duration)
+            run_ws_subscribe(wsUrl, command, args.concurrency, args.duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+##
+ # The pywsgi and asyncio serving engines side by side
+ #
+ #   python3 -m quanttp.benchmarks.engines [connections] [seconds] [workers]
+ #
+ # Starts a server on simulated generators with QUANTTP_ENGINE=pywsgi, then
+ # with QUANTTP_ENGINE=asyncio and, when workers (default 1) is above 1, with
+ # that many asyncio workers. Each is driven with the same requests over
+ # connections (default 32) keep-alive connections for seconds (default 5)
+ # per scenario. HTTP is sent over raw sockets, so that the load generator
+ # costs as little as possible of the CPU it shares with the server. Other
+ # QUANTTP_* settings are passed on, and QUANTTP_SIM_RATE defaults to 0 so
+ # that the generators are never the bottleneck. Reports requests, or frames
+ # for subscriptions, per second and p99 latency for every engine.
+ ##
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from quanttp.benchmarks.endpoints import run
+from quanttp.wsclient import WebSocketClient
+
+SCENARIOS = [
+    ('GET', '/api/randint32?deviceId=ANY'),
+    ('GET', '/api/randbytes?deviceId=ANY&length=1024'),
+    ('GET', '/api/json/randuniform?deviceId=ANY&length=1024'),
+    ('GET', '/api/json/randuniform?deviceId=ANY&length=1024&format=binary'),
+    ('GET', '/api/status'),
+    ('WS', 'RANDINT32 ANY'),
+    ('SUBSCRIBE', 'SUBSCRIBEINT32 ANY'),
+    ('SUBSCRIBE', 'SUBSCRIBEINT32BIN ANY 256'),
+]
+
+
+class HttpConnection:
+    # Keep-alive GETs, for responses with a Content-Length
+
+    def __init__(self, port):
+        self._socket = socket.create_connection(('127.0.0.1', port))
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._socket.makefile('rb')
+
+    def get(self, path):
+        self._socket.sendall(b'GET ' + path.encode() + b' HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        status = int(self._reader.readline().split()[1])
+        length = 0
+        while True:
+            line = self._reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                length = int(value)
+        body = self._reader.read(length)
+        if status >= 500:
+            raise IOError(status)
+        return body
+
+    def close(self):
+        self._reader.close()
+        self._socket.close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, engine, workers):
+    env = dict(os.environ, QUANTTP_BACKEND='simulated', QUANTTP_ENGINE=engine, QUANTTP_WORKERS=str(workers))
+    env.setdefault('QUANTTP_SIM_RATE', '0')
+    server = subprocess.Popen([sys.executable, '-m', 'quanttp', 'bench', str(port)], env=env, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            connection = HttpConnection(port)
+            try:
+                if connection.get('/api/devices'):
+                    return server
+            finally:
+                connection.close()
+        except (OSError, IndexError, ValueError):
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise IOError('the ' + engine + ' server did not start')
+
+
+def run_engine(name, engine, workers, connections, seconds):
+    port = free_port()
+    server = start_server(port, engine, workers)
+    wsUrl = 'ws://127.0.0.1:%d/ws' % port
+    results = []
+    try:
+        print(name)
+        for kind, target in SCENARIOS:
+            if kind == 'GET':
+                result = run('  GET ' + target, connections, seconds, lambda: HttpConnection(port),
+                             lambda connection: len(connection.get(target)))
+            elif kind == 'WS':
+                def request(websocket):
+                    websocket.send(target)
+                    return len(websocket.receive())
+                result = run('  WS ' + target, connections, seconds, lambda: WebSocketClient(wsUrl), request)
+            else:
+                def subscribe():
+                    websocket = WebSocketClient(wsUrl)
+                    websocket.send(target)
+                    return websocket
+                result = run('  WS ' + target, connections, seconds, subscribe, lambda websocket: len(websocket.receive()))
+            results.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def main():
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    engines = [('pywsgi', 'pywsgi', 1), ('asyncio', 'asyncio', 1)]
+    if workers > 1:
+        engines.append(('asyncio x%d' % workers, 'asyncio', workers))
+    print("%d connections, %.1f s per scenario, %d CPUs" % (connections, seconds, os.cpu_count()))
+    print("%-58s %10s %12s %9s %9s %9s %7s" % ("scenario", "req/s", "bytes/s", "p50 ms", "p99 ms", "p999 ms", "errors"))
+    results = [run_engine(name, engine, count, connections, seconds) for name, engine, count in engines]
+
+    print()
+    print("%-66s" % "req/s (p99 ms)" + ''.join("%20s" % name for name, engine, count in engines))
+    for i, (kind, target) in enumerate(SCENARIOS):
+        print("%-66s" % ((kind if kind != 'SUBSCRIBE' else 'WS') + ' ' + target) +
+              ''.join("%20s" % ("%.0f (%.1f)" % (result[i][0], result[i][1] * 1000)) for result in results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+##
+ # Cost of the continuous health tests
+ #
+ #   python3 -m quanttp.benchmarks.health [megabytes] [readSize]
+ #
+ # Feeds os.urandom buffers of readSize bytes (the pool's read size by
+ # default) through HealthTests and reports the test throughput, and how
+ # long the tests take per second of a generator streaming at
+ # QUANTTP_SIM_RATE bytes/sec.
+ ##
+
+import os
+import sys
+import time
+
+from quanttp import config
+from quanttp.data.health_tests import HealthTests
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    readSize = int(sys.argv[2]) if len(sys.argv) > 2 else config.POOL_READ_SIZE
+
+    tests = HealthTests(config.HEALTH_MIN_ENTROPY, config.HEALTH_ALPHA_EXPONENT, config.HEALTH_WINDOW, config.HEALTH_Z_LIMIT)
+    # Enough distinct data that no statistics window sees repeated buffers
+    buffers = [os.urandom(readSize) for i in range(max(16, 2 * config.HEALTH_WINDOW // readSize))]
+    reads = megabytes * 1024 * 1024 // readSize
+
+    start = time.perf_counter()
+    for i in range(reads):
+        tests.update(buffers[i % len(buffers)])
+    elapsed = time.perf_counter() - start
+
+    rate = reads * readSize / elapsed
+    print("RCT cutoff %d, APT cutoff %d of %d" % (tests.rctCutoff, tests.aptCutoff, 512))
+    print("%d reads of %d bytes: %.1f MB/s, %.1f us per read, status %s" % (
+        reads, readSize, rate / 1e6, elapsed / reads * 1e6, tests.status))
+    if config.SIM_RATE > 0:
+        print("%.3f%% of one CPU for a generator streaming %d bytes/s" % (100.0 * config.SIM_RATE / rate, config.SIM_RATE))
+
+
+if __name__ == "__main__":
+    main()
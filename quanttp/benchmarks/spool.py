@@ -0,0 +1,84 @@
+##
+ # Demand burst served live versus from the entropy spool
+ #
+ #   python3 -m quanttp.benchmarks.spool [clients] [seconds] [length] [megabytes]
+ #
+ # Fills a spool of megabytes bytes (16 by default) in a temporary directory
+ # from an unthrottled simulated generator, then reopens it the way a
+ # restarted server would. Concurrent clients then draw a burst of half the
+ # spool size, length bytes (4096 by default) at a time, from a generator
+ # producing QUANTTP_SIM_RATE bytes/sec: first live through the entropy pool,
+ # giving up after seconds, and then spool-first. Reports the megabytes
+ # served, the time taken, MB/s and p50/p99 latency for both.
+ ##
+
+import shutil
+import sys
+import tempfile
+import time
+
+import gevent
+
+from quanttp import config
+from quanttp.data.entropy_pool import EntropyPools
+from quanttp.data.entropy_spool import EntropySpools
+from quanttp.data.meterfeeder_wrapper import MeterFeederWrapper
+from quanttp.data.simulated_backend import SimulatedMeterFeeder
+
+
+def run(name, source, deviceId, clients, seconds, length, burst):
+    # Serves a burst of burst bytes, or as much of it as fits in seconds
+    latencies = []
+    deadline = time.perf_counter() + seconds
+
+    def client():
+        while len(latencies) * length < burst and time.perf_counter() < deadline:
+            start = time.perf_counter()
+            source.randbytes(deviceId, length)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    gevent.joinall([gevent.spawn(client) for i in range(clients)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print("%-12s %10.2f %10.2f %10.2f %10.2f %10.2f" % (
+        name, len(latencies) * length / 1e6, elapsed, len(latencies) * length / elapsed / 1e6,
+        latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    length = int(sys.argv[3]) if len(sys.argv) > 3 else 4096
+    megabytes = int(sys.argv[4]) if len(sys.argv) > 4 else 16
+    directory = tempfile.mkdtemp(prefix='quanttp-spool-')
+
+    # Fill at full speed, as if the pod had been idle overnight
+    fast = MeterFeederWrapper(SimulatedMeterFeeder(devices=1, rate=0))
+    deviceId = fast.deviceIds(True)[0].split("|")[0]
+    filling = EntropySpools(fast, fast, directory=directory, capacity=megabytes * 1024 * 1024, idleTime=0)
+    filling.sync([deviceId])
+    while filling.levels()[deviceId] < megabytes * 1024 * 1024:
+        time.sleep(0.1)
+    filling.close()
+    print("spool of %d MB filled in %s" % (megabytes, directory))
+
+    mf_wrapper = MeterFeederWrapper(SimulatedMeterFeeder(devices=1))
+    pools = EntropyPools(mf_wrapper)
+    pools.sync([deviceId])
+    spools = EntropySpools(pools, mf_wrapper, directory=directory, capacity=megabytes * 1024 * 1024)
+    spools.sync([deviceId])
+    print("%d clients, %d bytes per draw, generator %d bytes/s, %d bytes spooled" % (
+        clients, length, config.SIM_RATE, spools.levels()[deviceId]))
+    print("%-12s %10s %10s %10s %10s %10s" % ("mode", "MB", "seconds", "MB/s", "p50 ms", "p99 ms"))
+    burst = megabytes * 1024 * 1024 // 2
+    run("live", pools, deviceId, clients, seconds, length, burst)
+    run("spool-first", spools, deviceId, clients, seconds, length, burst)
+
+    spools.close()
+    pools.stop()
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
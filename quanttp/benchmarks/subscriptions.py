@@ -0,0 +1,157 @@
+##
+ # Load test for the WebSocket subscription engine
+ #
+ #   python3 -m quanttp.benchmarks.subscriptions [fast] [slow] [seconds] [batch]
+ #
+ # Runs fast and slow SUBSCRIBEINT32 subscribers side by side in-process, each
+ # on a real WebSocket over a loopback TCP connection with a small send
+ # buffer, and an os.urandom stand-in for the device. Fast clients read as
+ # fast as they can, slow clients at a limited rate, so the subscriptions of
+ # slow clients block on a full socket. For every subscriber it reports frames
+ # and values per second, the bytes drawn from the device and the bytes the
+ # client received. Slow subscribers draw in proportion to what their client
+ # reads, give or take the socket buffers, so they do not read more than they
+ # can send.
+ ##
+
+import logging
+import os
+import socket
+import sys
+import time
+import tracemalloc
+
+import gevent
+import gevent.socket
+from geventwebsocket.websocket import Stream, WebSocket
+
+from quanttp import subscriptions
+from quanttp.data import conversions
+
+# Kernel buffers of each connection, the kernel may round them up
+SEND_BUFFER = 8192
+RECEIVE_BUFFER = 8192
+# Slow clients read this many bytes every SLOW_READ_INTERVAL seconds
+SLOW_READ_SIZE = 4096
+SLOW_READ_INTERVAL = 0.01
+
+
+class CountingSource:
+
+    def __init__(self):
+        self.drawn = {}
+
+    def randbytes(self, deviceId, length):
+        self.drawn[deviceId] = self.drawn.get(deviceId, 0) + length
+        return os.urandom(length)
+
+
+class _Handler:
+    # What geventwebsocket needs of its WSGI handler
+
+    logger = logging.getLogger('quanttp.benchmarks.subscriptions')
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.rfile = sock.makefile('rb')
+
+
+class CountingWebSocket:
+    # A server side WebSocket that counts the frames it has written
+
+    def __init__(self, sock):
+        self.handler = _Handler(sock)
+        self._websocket = WebSocket({}, Stream(self.handler), self.handler)
+        self.frames = 0
+        self.values = 0
+
+    @property
+    def closed(self):
+        return self._websocket.closed
+
+    def send(self, message):
+        self._websocket.send(message)
+        self.frames += 1
+        self.values += message.count(',') + 1
+
+    def close(self, code=1000, message=''):
+        self.handler.socket.close()
+
+
+def connect(listener):
+    client = gevent.socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+    client.connect(listener.getsockname())
+    server, address = listener.accept()
+    return server, client
+
+
+def read(client, slow, received):
+    # received[0] counts the bytes, frame headers included
+    try:
+        while True:
+            data = client.recv(SLOW_READ_SIZE if slow else 65536)
+            if not data:
+                return
+            received[0] += len(data)
+            if slow:
+                gevent.sleep(SLOW_READ_INTERVAL)
+    except OSError:
+        pass
+
+
+def main():
+    fast = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    slow = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+    batch = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+
+    source = CountingSource()
+    limiter = subscriptions.SubscriptionLimiter(0)
+    listener = gevent.socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(fast + slow)
+    clients = []
+    tracemalloc.start()
+    for i in range(fast + slow):
+        kind = 'fast' if i < fast else 'slow'
+        # One virtual device per subscriber so device reads can be attributed
+        deviceId = '%s%04d' % (kind.upper(), i)
+        server, client = connect(listener)
+        websocket = CountingWebSocket(server)
+        received = [0]
+        reader = gevent.spawn(read, client, kind == 'slow', received)
+        # Sets SO_SNDBUF the way QUANTTP_WS_SEND_BUFFER does
+        connection = subscriptions.Connection(websocket, limiter, SEND_BUFFER)
+        connection.subscribe(deviceId, subscriptions.value_frames(source, deviceId, conversions.int32_array, conversions.INT32_SIZE, batch, batch))
+        clients.append((kind, deviceId, websocket, connection, client, reader, received))
+
+    start = time.perf_counter()
+    gevent.sleep(seconds)
+    elapsed = time.perf_counter() - start
+    drawn = dict(source.drawn)
+    for kind, deviceId, websocket, connection, client, reader, received in clients:
+        connection.unsubscribe()
+        # Unblocks a subscriber waiting for room in the send buffer
+        client.close()
+        reader.kill()
+        websocket.close()
+    gevent.sleep(0.1)
+    listener.close()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("subscribers: %d fast, %d slow, batch %d, %.1f s" % (fast, slow, batch, elapsed))
+    print("%-5s %-9s %12s %12s %14s %14s" % ("kind", "device", "frames/s", "values/s", "device bytes", "received"))
+    for kind, deviceId, websocket, connection, client, reader, received in clients:
+        print("%-5s %-9s %12.0f %12.0f %14d %14d" % (kind, deviceId, websocket.frames / elapsed, websocket.values / elapsed,
+                                                   drawn.get(deviceId, 0), received[0]))
+    for kind in ('fast', 'slow'):
+        values = [client[2].values for client in clients if client[0] == kind]
+        if values:
+            print("%s total: %.0f values/s" % (kind, sum(values) / elapsed))
+    print("peak traced memory: %.1f KiB, still subscribed: %d" % (peak / 1024, limiter.active()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+##
+ # Pod Entropy Server configuration
+ #
+ # Every setting can be overridden with an environment variable so that pods
+ # can be tuned without changing the <servername> <port> command line.
+ ##
+
+import os
+
+
+def _str(name, default):
+    value = os.environ.get(name)
+    return default if value is None or value == '' else value
+
+
+def _int(name, default):
+    return int(_str(name, default))
+
+
+def _float(name, default):
+    return float(_str(name, default))
+
+
+# Device backend ----------------------------------------------
+
+# "meterfeeder" loads libmeterfeeder, "simulated" uses SimulatedMeterFeeder
+BACKEND = _str('QUANTTP_BACKEND', 'meterfeeder')
+
+# Simulated generators: number of devices, bytes/sec per device (0 for
+# unlimited) and per-call latency and jitter in seconds
+SIM_DEVICES = _int('QUANTTP_SIM_DEVICES', 2)
+# Serial number of the first simulated generator, give each simulated pod its own range
+SIM_FIRST_SERIAL = _int('QUANTTP_SIM_FIRST_SERIAL', 1)
+SIM_RATE = _int('QUANTTP_SIM_RATE', 100000)
+SIM_LATENCY = _float('QUANTTP_SIM_LATENCY', 0.001)
+SIM_JITTER = _float('QUANTTP_SIM_JITTER', 0.0005)
+# Fault injection: probability per call of an error, of a stall lasting
+# SIM_STALL_TIME seconds, and of the device disconnecting until MF_Reset
+SIM_ERROR_RATE = _float('QUANTTP_SIM_ERROR_RATE', 0.0)
+SIM_STALL_RATE = _float('QUANTTP_SIM_STALL_RATE', 0.0)
+SIM_STALL_TIME = _float('QUANTTP_SIM_STALL_TIME', 5.0)
+SIM_DISCONNECT_RATE = _float('QUANTTP_SIM_DISCONNECT_RATE', 0.0)
+# Probability per call that the generator gets stuck repeating one byte until MF_Reset
+SIM_STUCK_RATE = _float('QUANTTP_SIM_STUCK_RATE', 0.0)
+
+
+# Startup and device registry ----------------------------------------------
+
+# Look up and print the pod's public IP in the background at startup (0 or 1)
+PUBLIC_IP_LOOKUP = _int('QUANTTP_PUBLIC_IP_LOOKUP', 0)
+PUBLIC_IP_URL = _str('QUANTTP_PUBLIC_IP_URL', 'https://api.ipify.org')
+# Seconds between background device enumerations, 0 to only refresh after a reset
+DEVICE_REFRESH_INTERVAL = _float('QUANTTP_DEVICE_REFRESH_INTERVAL', 30)
+
+
+# Health tests ----------------------------------------------
+
+# Run the continuous health tests on every byte read (0 or 1)
+HEALTH_TESTS = _int('QUANTTP_HEALTH_TESTS', 1)
+# Assessed min-entropy in bits per byte, sets the RCT and APT cutoffs
+HEALTH_MIN_ENTROPY = _float('QUANTTP_HEALTH_MIN_ENTROPY', 7.0)
+# False positive rate of the RCT and APT is 2^-HEALTH_ALPHA_EXPONENT
+HEALTH_ALPHA_EXPONENT = _int('QUANTTP_HEALTH_ALPHA_EXPONENT', 40)
+# Bytes per monobit and chi-square window
+HEALTH_WINDOW = _int('QUANTTP_HEALTH_WINDOW', 256 * 1024)
+# A window whose monobit or chi-square z-score exceeds this is DEGRADED
+HEALTH_Z_LIMIT = _float('QUANTTP_HEALTH_Z_LIMIT', 5.0)
+
+
+# Device recovery ----------------------------------------------
+
+# A call may take this many seconds, plus the time its bytes take at RECOVERY_MIN_RATE,
+# before the generator counts as hung and is quarantined
+RECOVERY_READ_TIMEOUT = _float('QUANTTP_RECOVERY_READ_TIMEOUT', 1.0)
+# Slowest acceptable read rate in bytes/sec, 0 to only apply RECOVERY_READ_TIMEOUT
+RECOVERY_MIN_RATE = _int('QUANTTP_RECOVERY_MIN_RATE', 32768)
+# Seconds before the first recovery attempt, doubled after every failed attempt...
+RECOVERY_BACKOFF = _float('QUANTTP_RECOVERY_BACKOFF', 1.0)
+# ...up to this many seconds
+RECOVERY_MAX_BACKOFF = _float('QUANTTP_RECOVERY_MAX_BACKOFF', 60.0)
+
+
+# Entropy pool ----------------------------------------------
+
+# Size of the per-device ring buffer in bytes
+POOL_CAPACITY = _int('QUANTTP_POOL_CAPACITY', 1024 * 1024)
+# The background reader starts refilling when the pool drops below this level...
+POOL_LOW_WATERMARK = _int('QUANTTP_POOL_LOW_WATERMARK', 256 * 1024)
+# ...and stops once the pool holds at least this many bytes
+POOL_HIGH_WATERMARK = _int('QUANTTP_POOL_HIGH_WATERMARK', 1024 * 1024)
+# Number of bytes requested from MF_GetBytes per background read
+POOL_READ_SIZE = _int('QUANTTP_POOL_READ_SIZE', 64 * 1024)
+
+
+# Entropy spool ----------------------------------------------
+
+# Directory of the per-device spool files, empty to run without a spool
+SPOOL_DIR = _str('QUANTTP_SPOOL_DIR', '')
+# "spool-first" serves from the spool and the rest live, "spool-only" never
+# reads live for a request, "live-only" keeps filling the spool but never serves from it
+SPOOL_MODE = _str('QUANTTP_SPOOL_MODE', 'spool-first')
+# Size of each device's spool file in bytes, rounded up to whole pages
+SPOOL_SIZE = _int('QUANTTP_SPOOL_SIZE', 64 * 1024 * 1024)
+# Number of bytes requested from MF_GetBytes per harvester read
+SPOOL_READ_SIZE = _int('QUANTTP_SPOOL_READ_SIZE', 64 * 1024)
+# Bytes the persisted read offset runs ahead of the bytes served, lost after a crash
+SPOOL_RESERVE = _int('QUANTTP_SPOOL_RESERVE', 64 * 1024)
+# msync every write and read offset update (0 or 1), without it only a process crash is safe
+SPOOL_SYNC = _int('QUANTTP_SPOOL_SYNC', 1)
+# Seconds a generator must go without live reads before harvesting resumes
+SPOOL_IDLE_TIME = _float('QUANTTP_SPOOL_IDLE_TIME', 1.0)
+
+
+# Request coalescing ----------------------------------------------
+
+# Seconds that small device reads wait to be combined with others
+COALESCE_WINDOW = _float('QUANTTP_COALESCE_WINDOW', 0.0005)
+# A batch is read right away once this many bytes are pending
+COALESCE_MAX_BYTES = _int('QUANTTP_COALESCE_MAX_BYTES', 64 * 1024)
+# Reads larger than this many bytes are never coalesced, 0 disables coalescing
+COALESCE_MAX_REQUEST = _int('QUANTTP_COALESCE_MAX_REQUEST', 4096)
+
+# Fair-share scheduler ----------------------------------------------
+
+# Schedule device reads fairly between clients (0 or 1)
+SCHEDULER = _int('QUANTTP_SCHEDULER', 1)
+# Bytes per round and class weight unit, and the largest piece read at once
+SCHED_QUANTUM = _int('QUANTTP_SCHED_QUANTUM', 4096)
+# New pieces are only started while fewer bytes than this are being read per deviceId
+SCHED_MAX_IN_FLIGHT = _int('QUANTTP_SCHED_MAX_IN_FLIGHT', 16 * 1024)
+# Priority classes and their weights, must include "normal"
+SCHED_CLASSES = _str('QUANTTP_SCHED_CLASSES', 'high:8,normal:4,low:1')
+# Known clients as key:class[:bytes per second], comma separated
+SCHED_CLIENTS = _str('QUANTTP_SCHED_CLIENTS', '')
+# Rate limit in bytes/sec for clients without their own, 0 for no limit
+SCHED_DEFAULT_RATE = _int('QUANTTP_SCHED_DEFAULT_RATE', 0)
+# Seconds of unused rate a client may save up for a burst
+SCHED_BURST = _float('QUANTTP_SCHED_BURST', 1.0)
+
+# Virtual devices ----------------------------------------------
+
+# deviceId=ANY requests of at least this many bytes are split across all devices
+ANY_SPLIT_THRESHOLD = _int('QUANTTP_ANY_SPLIT_THRESHOLD', 256 * 1024)
+
+
+# Streaming ----------------------------------------------
+
+# Responses larger than this many bytes of entropy are sent as chunked streams
+STREAM_THRESHOLD = _int('QUANTTP_STREAM_THRESHOLD', 1024 * 1024)
+# Number of bytes read from the device and encoded per streamed chunk
+STREAM_CHUNK_SIZE = _int('QUANTTP_STREAM_CHUNK_SIZE', 64 * 1024)
+# Chunks read ahead in parallel while a chunk is being sent
+STREAM_PREFETCH = _int('QUANTTP_STREAM_PREFETCH', 2)
+
+
+# Batch requests ----------------------------------------------
+
+# Maximum number of draws in one POST /api/json/batch
+BATCH_MAX_DRAWS = _int('QUANTTP_BATCH_MAX_DRAWS', 256)
+# Maximum bytes of entropy one batch may draw, batches are never streamed
+BATCH_MAX_BYTES = _int('QUANTTP_BATCH_MAX_BYTES', 1024 * 1024)
+
+
+# WebSocket ----------------------------------------------
+
+# Number of values drawn per device read by SUBSCRIBEINT32/UNIFORM/NORMAL
+SUBSCRIBE_READ_VALUES = _int('QUANTTP_SUBSCRIBE_READ_VALUES', 256)
+# Default number of comma separated values per SUBSCRIBEINT32/UNIFORM/NORMAL frame
+WS_BATCH_SIZE = _int('QUANTTP_WS_BATCH_SIZE', 1)
+# Largest batch of values a subscription may ask for per frame
+WS_MAX_BATCH = _int('QUANTTP_WS_MAX_BATCH', 65536)
+# Largest chunk in bytes per SUBSCRIBEBYTES/SUBSCRIBEHEX frame
+WS_MAX_CHUNK = _int('QUANTTP_WS_MAX_CHUNK', 1024 * 1024)
+# Maximum concurrent subscriptions per device, 0 for no limit
+WS_MAX_SUBSCRIPTIONS_PER_DEVICE = _int('QUANTTP_WS_MAX_SUBSCRIPTIONS_PER_DEVICE', 64)
+# Kernel send buffer size for WebSocket connections in bytes, 0 keeps the OS default
+WS_SEND_BUFFER = _int('QUANTTP_WS_SEND_BUFFER', 0)
+
+
+# Local transport ----------------------------------------------
+
+# Directory for the shared-memory rings, e.g. /dev/shm/quanttp, empty to disable them
+LOCAL_SHM_DIR = _str('QUANTTP_LOCAL_SHM_DIR', '')
+# Size of each device's ring in bytes
+LOCAL_SHM_SIZE = _int('QUANTTP_LOCAL_SHM_SIZE', 4 * 1024 * 1024)
+# Bytes read from the device and published per write into a ring
+LOCAL_SHM_READ_SIZE = _int('QUANTTP_LOCAL_SHM_READ_SIZE', 64 * 1024)
+# Seconds between checks for free space in a full ring
+LOCAL_SHM_POLL_INTERVAL = _float('QUANTTP_LOCAL_SHM_POLL_INTERVAL', 0.001)
+# Group, by name or id, whose members may map the rings, empty for the server's user only
+LOCAL_SHM_GROUP = _str('QUANTTP_LOCAL_SHM_GROUP', '')
+# Path of the Unix domain socket serving the WebSocket commands, empty to disable it
+LOCAL_SOCKET = _str('QUANTTP_LOCAL_SOCKET', '')
+# Fair-share scheduler client key of the shared-memory rings
+LOCAL_CLIENT_KEY = _str('QUANTTP_LOCAL_CLIENT_KEY', 'local')
+
+
+# Serving engine ----------------------------------------------
+
+# "pywsgi" serves the API with Flask on gevent, "asyncio" with the ASGI engine on uvicorn
+ENGINE = _str('QUANTTP_ENGINE', 'pywsgi')
+# asyncio engine: worker processes sharing the port, the first one owns the generators
+WORKERS = _int('QUANTTP_WORKERS', 1)
+
+
+# Gateway ----------------------------------------------
+
+# Keep-alive connections, and worker threads, per upstream pod
+GATEWAY_CONNECTIONS = _int('QUANTTP_GATEWAY_CONNECTIONS', 8)
+# Seconds before an upstream request counts as failed
+GATEWAY_TIMEOUT = _float('QUANTTP_GATEWAY_TIMEOUT', 10)
+# Seconds between upstream inventory and health polls
+GATEWAY_REFRESH_INTERVAL = _float('QUANTTP_GATEWAY_REFRESH_INTERVAL', 5)
+# Reads up to this many bytes use the persistent WebSocket instead of HTTP
+GATEWAY_WS_MAX_READ = _int('QUANTTP_GATEWAY_WS_MAX_READ', 4096)
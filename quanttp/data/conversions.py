@@ -0,0 +1,64 @@
+##
+ # Conversions from raw device bytes to numeric values
+ #
+ # int32   : 4 bytes, little-endian two's complement
+ # uniform : 8 bytes, the top 53 bits of a little-endian uint64 scaled to [0, 1)
+ # normal  : 16 bytes, two uniforms combined with the Box-Muller transform
+ #
+ # The *_array functions convert a whole buffer in one NumPy pass. The single
+ # value functions are the first element of the same conversion, so element i
+ # of int32_array(buf) equals int32(buf[4*i:4*i+4]), and likewise for uniform
+ # (8 bytes per value) and normal (16 bytes per value). One read of
+ # SIZE * length bytes gives exactly the values that length separate draws of
+ # SIZE bytes would have given, in the same order.
+ #
+ # How this differs from libmeterfeeder's MF_Rand* functions:
+ #
+ # MF_RandInt32   : the same, 4 bytes read as a little-endian int32
+ # MF_RandUniform : 6 bytes read as a little-endian 48-bit integer and divided
+ #                  by 2^48, so its values are multiples of 2^-48 where ours
+ #                  are multiples of 2^-53
+ # MF_RandNormal  : two MF_RandUniform draws u1 and u2 (12 bytes), each plus
+ #                  2^-49, give sqrt(-2 log(u1)) * cos(2 pi u2). Ours uses two
+ #                  53-bit uniforms (16 bytes) and log(1 - u1) to keep away from
+ #                  log(0). Both use only the cos branch of Box-Muller, so each
+ #                  value costs two uniforms.
+ #
+ # The same bytes therefore give the same int32 but a different uniform or
+ # normal than the library would.
+ ##
+
+import numpy
+
+INT32_SIZE = 4
+UNIFORM_SIZE = 8
+NORMAL_SIZE = 16
+
+_UNIFORM_SCALE = 2.0 ** -53
+
+
+def int32(data):
+    return int(int32_array(data[0:INT32_SIZE])[0])
+
+
+def uniform(data):
+    return float(uniform_array(data[0:UNIFORM_SIZE])[0])
+
+
+def normal(data):
+    return float(normal_array(data[0:NORMAL_SIZE])[0])
+
+
+def int32_array(data):
+    return numpy.frombuffer(data, dtype='<i4', count=len(data) // INT32_SIZE)
+
+
+def uniform_array(data):
+    words = numpy.frombuffer(data, dtype='<u8', count=len(data) // UNIFORM_SIZE)
+    return (words >> numpy.uint64(11)).astype(numpy.float64) * _UNIFORM_SCALE
+
+
+def normal_array(data):
+    # 1 - u keeps the argument of log() in (0, 1]
+    pairs = uniform_array(data[0:len(data) // NORMAL_SIZE * NORMAL_SIZE]).reshape(-1, 2)
+    return numpy.sqrt(-2.0 * numpy.log(1.0 - pairs[:, 0])) * numpy.cos(2.0 * numpy.pi * pairs[:, 1])
@@ -0,0 +1,208 @@
+##
+ # Device fault recovery
+ #
+ # A generator is quarantined when a call reports an error in its error
+ # buffer twice in a row, or when a read runs past its deadline of
+ # RECOVERY_READ_TIMEOUT seconds plus the time the read takes at
+ # RECOVERY_MIN_RATE bytes/sec, which catches hung calls as well as stalled
+ # byte rates. A quarantined generator gets no more calls and is left out of
+ # the device list, so requests fail over to the healthy ones.
+ #
+ # A background thread recovers it with MF_Reset, MF_Initialize when the reset
+ # fails, and a probe read. The first attempt is made RECOVERY_BACKOFF seconds
+ # after the fault, and the wait doubles after every failed attempt up to
+ # RECOVERY_MAX_BACKOFF. A failed MF_Initialize at startup is retried the same
+ # way under the name BACKEND.
+ #
+ # OK          : in use
+ # QUARANTINED : waiting for the next recovery attempt
+ # RECOVERING  : a recovery attempt is running
+ ##
+
+import itertools
+import threading
+import time
+
+from quanttp import config, metrics
+
+OK = 'OK'
+QUARANTINED = 'QUARANTINED'
+RECOVERING = 'RECOVERING'
+
+# Name of the backend as a whole while MF_Initialize fails
+BACKEND = 'backend'
+
+# Seconds between checks for reads past their deadline
+_WATCHDOG_INTERVAL = 0.5
+
+
+class DeviceUnavailable(IOError):
+    # The generator is quarantined, or the read timed out
+    pass
+
+
+class DeviceState:
+
+    def __init__(self):
+        self.state = OK
+        self.reason = None
+        self.since = None
+        self.nextAttempt = 0.0
+        self.backoff = 0.0
+        self.attempts = 0
+        self.lastError = None
+        self.quarantines = 0
+        self.recoveries = 0
+        self.lastRecoverySeconds = None
+
+
+class DeviceRecovery:
+
+    def __init__(self, recover,
+                 backoff=config.RECOVERY_BACKOFF,
+                 maxBackoff=config.RECOVERY_MAX_BACKOFF,
+                 readTimeout=config.RECOVERY_READ_TIMEOUT,
+                 minRate=config.RECOVERY_MIN_RATE):
+        # recover(name) makes one recovery attempt and raises if it failed
+        self._recover = recover
+        self._backoff = backoff
+        self._maxBackoff = maxBackoff
+        self._readTimeout = readTimeout
+        self._minRate = minRate
+        self._devices = {}
+        # Calls in progress: token -> (deviceId, deadline)
+        self._calls = {}
+        self._tokens = itertools.count()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._listeners = []
+        self._running = False
+
+    def addListener(self, listener):
+        # listener(name, state) is called whenever a generator is quarantined or recovered
+        self._listeners.append(listener)
+
+    def _start(self):
+        # The watchdog thread, started by the first call or fault
+        if not self._running:
+            self._running = True
+            threading.Thread(target=self._run, name='device-recovery', daemon=True).start()
+
+    def timeout(self, length=0):
+        # Seconds a call reading length bytes may take
+        return self._readTimeout + (length / self._minRate if self._minRate > 0 else 0)
+
+    def begin(self, deviceId, length=0):
+        # Registers a call with the watchdog, refused while quarantined
+        with self._lock:
+            device = self._devices.get(deviceId)
+            if device is not None and device.state != OK:
+                raise DeviceUnavailable(deviceId + ' is quarantined: ' + device.reason)
+            self._start()
+            token = next(self._tokens)
+            self._calls[token] = (deviceId, time.monotonic() + self.timeout(length))
+        return token
+
+    def end(self, token):
+        with self._lock:
+            deviceId, deadline = self._calls.pop(token)
+        if time.monotonic() > deadline:
+            self.quarantine(deviceId, 'read stalled')
+
+    def quarantine(self, name, reason):
+        with self._lock:
+            device = self._devices.setdefault(name, DeviceState())
+            if device.state != OK:
+                return
+            device.state = QUARANTINED
+            device.reason = reason
+            device.since = time.monotonic()
+            device.backoff = self._backoff
+            device.nextAttempt = device.since + device.backoff
+            device.attempts = 0
+            device.lastError = None
+            device.quarantines += 1
+            self._start()
+        metrics.DEVICE_QUARANTINES.inc(name)
+        print("device recovery:", name, QUARANTINED, reason)
+        self._notify(name, QUARANTINED)
+        self._wake.set()
+
+    def quarantined(self, name):
+        device = self._devices.get(name)
+        return device is not None and device.state != OK
+
+    def retryNow(self):
+        # After a manual reset, every quarantined generator gets an attempt right away
+        with self._lock:
+            for device in self._devices.values():
+                if device.state == QUARANTINED:
+                    device.nextAttempt = 0.0
+        self._wake.set()
+
+    def report(self, name):
+        device = self._devices.get(name)
+        if device is None:
+            return {"state": OK, "quarantines": 0}
+        report = {"state": device.state, "quarantines": device.quarantines, "recoveries": device.recoveries,
+                  "lastRecoverySeconds": None if device.lastRecoverySeconds is None else round(device.lastRecoverySeconds, 3)}
+        if device.state != OK:
+            now = time.monotonic()
+            report.update({"reason": device.reason, "quarantinedSeconds": round(now - device.since, 3),
+                           "attempts": device.attempts, "lastError": device.lastError,
+                           "nextAttemptSeconds": round(max(device.nextAttempt - now, 0), 3)})
+        return report
+
+    def reports(self):
+        return {name: self.report(name) for name in sorted(self._devices)}
+
+    def states(self):
+        return {name: device.state for name, device in list(self._devices.items())}
+
+    def _notify(self, name, state):
+        for listener in self._listeners:
+            listener(name, state)
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                stalled = {deviceId for deviceId, deadline in self._calls.values() if now > deadline}
+                due = [name for name, device in self._devices.items()
+                       if device.state == QUARANTINED and device.nextAttempt <= now]
+                waits = [device.nextAttempt - now for device in self._devices.values() if device.state == QUARANTINED]
+            for deviceId in stalled:
+                self.quarantine(deviceId, 'read timed out')
+            for name in due:
+                # On a thread of its own, so that the watchdog keeps running
+                # while an attempt waits for the generators to be idle
+                with self._lock:
+                    self._devices[name].state = RECOVERING
+                threading.Thread(target=self._attempt, args=(name,), name='device-recovery-' + name, daemon=True).start()
+            self._wake.wait(max(min(waits + [_WATCHDOG_INTERVAL]), 0))
+            self._wake.clear()
+
+    def _attempt(self, name):
+        device = self._devices[name]
+        start = time.monotonic()
+        try:
+            self._recover(name)
+        except Exception as e:
+            with self._lock:
+                device.state = QUARANTINED
+                device.attempts += 1
+                device.lastError = str(e)
+                device.backoff = min(device.backoff * 2, self._maxBackoff)
+                device.nextAttempt = time.monotonic() + device.backoff
+            metrics.DEVICE_RECOVERY_SECONDS.observe(time.monotonic() - start, name, 'failed')
+            print("device recovery:", name, "attempt", device.attempts, "failed:", e)
+            # The watchdog waits for the next attempt from here
+            self._wake.set()
+            return
+        with self._lock:
+            device.state = OK
+            device.recoveries += 1
+            device.lastRecoverySeconds = time.monotonic() - device.since
+        metrics.DEVICE_RECOVERY_SECONDS.observe(time.monotonic() - start, name, 'recovered')
+        print("device recovery:", name, OK, "after %.3f seconds" % device.lastRecoverySeconds)
+        self._notify(name, OK)
@@ -0,0 +1,82 @@
+##
+ # Cached device registry
+ #
+ # Enumerating generators touches the USB bus, so the list is cached and
+ # refreshed by a background thread every few seconds, or right away after a
+ # reset. Listeners are told about every change, which is how hot-plugged
+ # generators get their entropy pool. Generators that failed their health
+ # tests are left out until they pass again after a reset.
+ ##
+
+import threading
+
+from quanttp import config
+from quanttp.data.multi_device import VIRTUAL_DEVICE_IDS
+
+
+class DeviceRegistry:
+
+    def __init__(self, mf_wrapper, interval=config.DEVICE_REFRESH_INTERVAL):
+        self._mf_wrapper = mf_wrapper
+        self._interval = interval
+        self._generators = []
+        self._deviceIds = []
+        self._csv = ''
+        self._listeners = []
+        self._wake = threading.Event()
+        self._running = False
+
+    def addListener(self, listener):
+        # listener(deviceIds) is called with the new list after every change
+        self._listeners.append(listener)
+
+    def start(self):
+        if self._running:
+            return
+        self.refresh()
+        self._running = True
+        threading.Thread(target=self._run, name='device-registry', daemon=True).start()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+
+    def requestRefresh(self):
+        self._wake.set()
+
+    def refresh(self):
+        health = self._mf_wrapper.health
+        generators = [generator for generator in self._mf_wrapper.deviceIds(True)
+                      if not health.failed(generator.split("|")[0])]
+        if generators == self._generators:
+            return
+        deviceIds = [generator.split("|")[0] for generator in generators]
+        # Swap in complete values, readers never see a half-updated list
+        self._generators = generators
+        self._deviceIds = deviceIds
+        self._csv = ','.join(deviceIds)
+        for listener in self._listeners:
+            listener(deviceIds)
+
+    def _run(self):
+        while self._running:
+            self._wake.wait(self._interval if self._interval > 0 else None)
+            self._wake.clear()
+            if not self._running:
+                break
+            try:
+                self.refresh()
+            except Exception as e:
+                print("device registry refresh failed:", e)
+
+    def generators(self):
+        return self._generators
+
+    def deviceIds(self):
+        return self._deviceIds
+
+    def csv(self):
+        return self._csv
+
+    def isValid(self, deviceId):
+        return deviceId in self._deviceIds or deviceId in VIRTUAL_DEVICE_IDS
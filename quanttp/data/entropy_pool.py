@@ -0,0 +1,155 @@
+##
+ # Per-device entropy pool
+ #
+ # A background reader keeps a bounded ring buffer per generator filled with
+ # large MF_GetBytes reads, so that requests are served from memory instead of
+ # waiting for a USB round-trip. Every byte leaves the pool exactly once.
+ ##
+
+import threading
+import time
+
+from quanttp import config
+
+
+class EntropyPool:
+
+    def __init__(self, mf_wrapper, deviceId, capacity, lowWatermark, highWatermark, readSize):
+        if not 0 <= lowWatermark <= highWatermark <= capacity:
+            raise ValueError('pool watermarks must satisfy 0 <= low <= high <= capacity')
+        self._mf_wrapper = mf_wrapper
+        self._deviceId = deviceId
+        self._capacity = capacity
+        self._lowWatermark = lowWatermark
+        self._highWatermark = highWatermark
+        self._readSize = readSize
+
+        self._buffer = bytearray(capacity)
+        self._start = 0
+        self._size = 0
+        # Bumped by clear() so that a read that was in flight is discarded
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._refill.set()
+        self._thread = threading.Thread(target=self._run, name='entropy-pool-' + self._deviceId, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._refill.set()
+
+    def available(self):
+        return self._size
+
+    def take(self, length):
+        with self._lock:
+            n = min(length, self._size)
+            end = self._start + n
+            if end <= self._capacity:
+                data = bytes(self._buffer[self._start:end])
+            else:
+                data = bytes(self._buffer[self._start:]) + bytes(self._buffer[:end - self._capacity])
+            self._start = end % self._capacity
+            self._size -= n
+            if self._size < self._lowWatermark:
+                self._refill.set()
+        if n < length:
+            # Pool ran dry, read the remainder straight from the device
+            data += self._mf_wrapper.randbytes(self._deviceId, length - n)
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._start = 0
+            self._size = 0
+            self._generation += 1
+            self._refill.set()
+
+    def _put(self, chunk, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            n = min(len(chunk), self._capacity - self._size)
+            end = (self._start + self._size) % self._capacity
+            first = min(n, self._capacity - end)
+            self._buffer[end:end + first] = chunk[:first]
+            self._buffer[:n - first] = chunk[first:n]
+            self._size += n
+
+    def _run(self):
+        while self._running:
+            self._refill.wait()
+            self._refill.clear()
+            while self._running and self._size < self._highWatermark:
+                generation = self._generation
+                try:
+                    chunk = self._mf_wrapper.randbytes(self._deviceId, min(self._readSize, self._highWatermark - self._size))
+                except Exception as e:
+                    print("entropy pool", self._deviceId, "read failed:", e)
+                    time.sleep(1)
+                    continue
+                self._put(chunk, generation)
+
+
+class EntropyPools:
+
+    def __init__(self, mf_wrapper,
+                 capacity=config.POOL_CAPACITY,
+                 lowWatermark=config.POOL_LOW_WATERMARK,
+                 highWatermark=config.POOL_HIGH_WATERMARK,
+                 readSize=config.POOL_READ_SIZE):
+        self._mf_wrapper = mf_wrapper
+        self._capacity = capacity
+        self._lowWatermark = lowWatermark
+        self._highWatermark = highWatermark
+        self._readSize = readSize
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def sync(self, deviceIds):
+        # Start pools for new generators and stop those of removed ones
+        with self._lock:
+            for deviceId in deviceIds:
+                if deviceId not in self._pools:
+                    pool = EntropyPool(self._mf_wrapper, deviceId, self._capacity,
+                                       self._lowWatermark, self._highWatermark, self._readSize)
+                    pool.start()
+                    self._pools[deviceId] = pool
+            for deviceId in [d for d in self._pools if d not in deviceIds]:
+                self._pools.pop(deviceId).stop()
+
+    def stop(self):
+        for pool in list(self._pools.values()):
+            pool.stop()
+
+    def deviceIds(self):
+        return list(self._pools)
+
+    def levels(self):
+        return {deviceId: pool.available() for deviceId, pool in list(self._pools.items())}
+
+    def randbytes(self, deviceId, length):
+        pool = self._pools.get(deviceId)
+        if pool is None:
+            # Not an enumerated generator, let the device report the error
+            return self._mf_wrapper.randbytes(deviceId, length)
+        return pool.take(length)
+
+    def clear(self, deviceId):
+        pool = self._pools.get(deviceId)
+        if pool is not None:
+            pool.clear()
+        self._mf_wrapper.clear(deviceId)
+
+    def reset(self):
+        for pool in list(self._pools.values()):
+            pool.clear()
+        self._mf_wrapper.reset()
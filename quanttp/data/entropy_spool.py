@@ -0,0 +1,315 @@
+##
+ # Crash-safe on-disk entropy spool
+ #
+ # A harvester thread per generator fills a memory-mapped ring file of
+ # SPOOL_SIZE bytes with MF_GetBytes output while the generator is otherwise
+ # idle, so that bursts can be served far faster than the generators produce.
+ #
+ # File layout: one header page (magic, capacity, read offset, write offset,
+ # CRC32 of the fields) followed by the ring. Offsets count bytes since the
+ # file was created and only ever grow, the ring position is offset % capacity.
+ #
+ # Consume-once: the read offset is persisted before any byte below it is
+ # handed out, and the write offset only after the bytes below it are on
+ # disk. The persisted read offset runs up to SPOOL_RESERVE bytes ahead of the
+ # bytes actually served, so there is one msync per reservation rather than
+ # per request. After a crash the unserved rest of a reservation is skipped:
+ # bytes may be lost, but none is ever served twice.
+ #
+ # Reads are zero-copy: a request gets a memoryview of the mapped file, and
+ # the harvester does not overwrite that region until every view of it, and
+ # every array or slice made from one, has been released. Only a read that
+ # wraps around the end of the ring is copied.
+ ##
+
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import weakref
+import zlib
+
+import numpy
+
+from quanttp import config, metrics
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, a spool file is not protected against a second server
+    fcntl = None
+
+SPOOL_FIRST = 'spool-first'
+SPOOL_ONLY = 'spool-only'
+LIVE_ONLY = 'live-only'
+MODES = (SPOOL_FIRST, SPOOL_ONLY, LIVE_ONLY)
+
+_MAGIC = b'QTTPSPL1'
+# magic, capacity, read offset, write offset, CRC32 of the preceding fields
+_HEADER = struct.Struct('<8sQQQ')
+_CRC = struct.Struct('<I')
+_PAGE = mmap.PAGESIZE
+
+
+class SpoolEmpty(IOError):
+    # Spool-only mode and the spool holds fewer bytes than requested
+    pass
+
+
+class EntropySpool:
+
+    def __init__(self, mf_wrapper, deviceId, path, capacity, readSize, reserve, sync, idleTime):
+        self._mf_wrapper = mf_wrapper
+        self._deviceId = deviceId
+        # Whole pages, so that flushing the ring never touches the header page
+        self._capacity = -(-capacity // _PAGE) * _PAGE
+        self._readSize = min(readSize, self._capacity)
+        self._reserve = reserve
+        self._sync = sync
+        self._idleTime = idleTime
+
+        self._file = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(self._file)
+                raise IOError(path + ' is in use by another server')
+        if os.fstat(self._file).st_size != _PAGE + self._capacity:
+            os.ftruncate(self._file, _PAGE + self._capacity)
+        self._map = mmap.mmap(self._file, _PAGE + self._capacity)
+
+        self._lock = threading.RLock()
+        self._readOffset, self._writeOffset = self._load()
+        # Persisted read offset, at or above the next byte to serve
+        self._reserved = self._readOffset
+        # Start offsets of the regions handed out and not yet released
+        self._leases = {}
+        self._nextLease = 0
+        self._lastLive = 0.0
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def _load(self):
+        magic, capacity, readOffset, writeOffset = _HEADER.unpack_from(self._map, 0)
+        crc, = _CRC.unpack_from(self._map, _HEADER.size)
+        if (magic != _MAGIC or capacity != self._capacity or crc != zlib.crc32(self._map[:_HEADER.size])
+                or not readOffset <= writeOffset <= readOffset + capacity):
+            # New, resized or damaged: nothing in it can be trusted to be unserved
+            readOffset = writeOffset = 0
+            if magic == _MAGIC:
+                print("entropy spool", self._deviceId, "discarded, header does not match")
+            self._persist(readOffset, writeOffset)
+        return readOffset, writeOffset
+
+    def _persist(self, readOffset, writeOffset):
+        header = _HEADER.pack(_MAGIC, self._capacity, readOffset, writeOffset)
+        self._map[:_HEADER.size + _CRC.size] = header + _CRC.pack(zlib.crc32(header))
+        if self._sync:
+            self._map.flush(0, _PAGE)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._wake.set()
+        self._thread = threading.Thread(target=self._run, name='entropy-spool-' + self._deviceId, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+
+    def close(self):
+        # Unmaps the file and releases it to another server, no view of it
+        # may be left
+        self.stop()
+        if self._thread is not None:
+            self._thread.join()
+        self._map.close()
+        os.close(self._file)
+
+    def available(self):
+        return self._writeOffset - self._readOffset
+
+    def touchLive(self):
+        # The generator is serving requests directly, harvesting waits until idle
+        self._lastLive = time.monotonic()
+
+    def take(self, length, partial=True):
+        # Returns a memoryview of up to length bytes, or of none at all when
+        # partial is False and fewer are spooled
+        with self._lock:
+            n = min(length, self._writeOffset - self._readOffset)
+            if n < length and not partial:
+                n = 0
+            if n == 0:
+                return memoryview(b'')
+            start = self._readOffset
+            self._readOffset += n
+            if self._readOffset > self._reserved:
+                self._reserved = min(self._readOffset + self._reserve, self._writeOffset)
+                self._persist(self._reserved, self._writeOffset)
+            position = start % self._capacity
+            if position + n > self._capacity:
+                first = self._capacity - position
+                data = self._map[_PAGE + position:_PAGE + self._capacity] + self._map[_PAGE:_PAGE + n - first]
+                self._wake.set()
+                metrics.SPOOL_SERVED_BYTES.inc(self._deviceId, amount=n)
+                return memoryview(data)
+            lease = self._nextLease
+            self._nextLease += 1
+            self._leases[lease] = start
+        view = numpy.frombuffer(self._map, dtype=numpy.uint8, count=n, offset=_PAGE + position)
+        weakref.finalize(view, self._release, lease)
+        metrics.SPOOL_SERVED_BYTES.inc(self._deviceId, amount=n)
+        return memoryview(view)
+
+    def _release(self, lease):
+        # Called when the last view of a lease is garbage collected, from any thread
+        with self._lock:
+            del self._leases[lease]
+        self._wake.set()
+
+    def clear(self):
+        with self._lock:
+            self._readOffset = self._reserved = self._writeOffset
+            self._persist(self._reserved, self._writeOffset)
+
+    def _free(self):
+        # Bytes the harvester may write without touching unserved or leased bytes
+        with self._lock:
+            oldest = min(list(self._leases.values()), default=self._readOffset)
+            return oldest + self._capacity - self._writeOffset
+
+    def _run(self):
+        while self._running:
+            idle = self._lastLive + self._idleTime - time.monotonic()
+            if idle > 0:
+                time.sleep(idle)
+                continue
+            if self._free() < self._readSize:
+                # Full, or the free space is still leased out
+                self._wake.wait(self._idleTime or 1)
+                self._wake.clear()
+                continue
+            try:
+                chunk = self._mf_wrapper.randbytes(self._deviceId, self._readSize)
+            except Exception as e:
+                print("entropy spool", self._deviceId, "read failed:", e)
+                time.sleep(1)
+                continue
+            self._append(chunk)
+
+    def _append(self, chunk):
+        # Only this thread writes, and the region is free, so no lock is needed
+        # until the new write offset is published
+        position = self._writeOffset % self._capacity
+        first = min(len(chunk), self._capacity - position)
+        self._map[_PAGE + position:_PAGE + position + first] = chunk[:first]
+        self._map[_PAGE:_PAGE + len(chunk) - first] = chunk[first:]
+        if self._sync:
+            self._flush(position, first)
+            self._flush(0, len(chunk) - first)
+        with self._lock:
+            self._writeOffset += len(chunk)
+            self._persist(self._reserved, self._writeOffset)
+        metrics.SPOOL_HARVESTED_BYTES.inc(self._deviceId, amount=len(chunk))
+
+    def _flush(self, position, length):
+        if length > 0:
+            start = position // _PAGE * _PAGE
+            self._map.flush(_PAGE + start, position + length - start)
+
+
+class EntropySpools:
+    # Serves reads from the spools first, the rest from the live source
+
+    def __init__(self, live, mf_wrapper,
+                 directory=config.SPOOL_DIR,
+                 mode=config.SPOOL_MODE,
+                 capacity=config.SPOOL_SIZE,
+                 readSize=config.SPOOL_READ_SIZE,
+                 reserve=config.SPOOL_RESERVE,
+                 sync=config.SPOOL_SYNC,
+                 idleTime=config.SPOOL_IDLE_TIME):
+        if mode not in MODES:
+            raise ValueError('spool mode must be one of ' + ', '.join(MODES))
+        os.makedirs(directory, exist_ok=True)
+        self._live = live
+        self._mf_wrapper = mf_wrapper
+        self._directory = directory
+        self._mode = mode
+        self._capacity = capacity
+        self._readSize = readSize
+        self._reserve = reserve
+        self._sync = sync
+        self._idleTime = idleTime
+        self._spools = {}
+        self._lock = threading.Lock()
+
+    def sync(self, deviceIds):
+        # Harvest for attached generators only. Spools of removed generators
+        # stay mapped, their bytes are served again once they come back.
+        with self._lock:
+            for deviceId in deviceIds:
+                spool = self._spools.get(deviceId)
+                if spool is None:
+                    path = os.path.join(self._directory, re.sub(r'[^A-Za-z0-9_.-]', '_', deviceId) + '.spool')
+                    try:
+                        spool = self._spools[deviceId] = EntropySpool(
+                            self._mf_wrapper, deviceId, path, self._capacity, self._readSize,
+                            self._reserve, self._sync, self._idleTime)
+                    except (OSError, ValueError) as e:
+                        print("entropy spool", deviceId, "unavailable:", e)
+                        continue
+                spool.start()
+            for deviceId, spool in self._spools.items():
+                if deviceId not in deviceIds:
+                    spool.stop()
+
+    def stop(self):
+        for spool in list(self._spools.values()):
+            spool.stop()
+
+    def close(self):
+        with self._lock:
+            for spool in self._spools.values():
+                spool.close()
+            self._spools.clear()
+
+    def levels(self):
+        return {deviceId: spool.available() for deviceId, spool in list(self._spools.items())}
+
+    def randbytes(self, deviceId, length):
+        spool = self._spools.get(deviceId)
+        if spool is None:
+            return self._live.randbytes(deviceId, length)
+        if self._mode == LIVE_ONLY:
+            spool.touchLive()
+            return self._live.randbytes(deviceId, length)
+        if self._mode == SPOOL_ONLY:
+            data = spool.take(length, partial=False)
+            if len(data) < length:
+                raise SpoolEmpty('the spool of ' + deviceId + ' holds fewer than ' + str(length) + ' bytes')
+            return data
+        data = spool.take(length)
+        if len(data) == length:
+            return data
+        spool.touchLive()
+        live = self._live.randbytes(deviceId, length - len(data))
+        return live if len(data) == 0 else b''.join((data, live))
+
+    def clear(self, deviceId):
+        spool = self._spools.get(deviceId)
+        if spool is not None:
+            spool.clear()
+        self._live.clear(deviceId)
+
+    def reset(self):
+        # The spooled bytes passed the health tests when they were harvested,
+        # so they survive a device reset
+        self._live.reset()
@@ -0,0 +1,221 @@
+##
+ # Continuous health tests
+ #
+ # Every byte read from a generator is checked before it is handed out:
+ #
+ # * SP 800-90B repetition count test (RCT): fails when one byte value repeats
+ #   too many times in a row
+ # * SP 800-90B adaptive proportion test (APT): fails when the first byte of a
+ #   512 byte window occurs too often in that window
+ # * Monobit and chi-square statistics over windows of HEALTH_WINDOW bytes:
+ #   flag a bias in the bits or in the byte distribution
+ #
+ # Cutoffs follow SP 800-90B section 4.4 for 8-bit samples with an assessed
+ # min-entropy of HEALTH_MIN_ENTROPY bits per byte and a false positive rate of
+ # 2^-HEALTH_ALPHA_EXPONENT. Each test runs over whole read buffers with NumPy
+ # and carries its state from one buffer to the next.
+ #
+ # OK       : all tests pass
+ # DEGRADED : the last statistics window was biased, clears with a good window
+ # FAILED   : RCT or APT failed, the device is not used until the next reset
+ #
+ # UNAVAILABLE is the status of ANY and XOR while no generator is usable.
+ ##
+
+import math
+import threading
+
+import numpy
+
+from quanttp import config, metrics
+
+OK = 'OK'
+DEGRADED = 'DEGRADED'
+FAILED = 'FAILED'
+UNAVAILABLE = 'UNAVAILABLE'
+SEVERITY = {OK: 0, DEGRADED: 1, FAILED: 2, UNAVAILABLE: 3}
+
+APT_WINDOW = 512
+
+_POPCOUNT = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.int64)
+
+
+def rct_cutoff(minEntropy, alphaExponent):
+    return 1 + math.ceil(alphaExponent / minEntropy)
+
+
+def apt_cutoff(minEntropy, alphaExponent, window=APT_WINDOW):
+    # 1 + CRITBINOM(W, 2^-H, 1 - alpha): the smallest count whose upper tail
+    # probability is at most alpha
+    p = 2.0 ** -minEntropy
+    logAlpha = -alphaExponent * math.log(2)
+    logPmf = [math.lgamma(window + 1) - math.lgamma(k + 1) - math.lgamma(window - k + 1)
+              + k * math.log(p) + (window - k) * math.log1p(-p) for k in range(window + 1)]
+    tail = 0.0
+    for k in range(window, -1, -1):
+        tail += math.exp(logPmf[k])
+        if tail > 0 and math.log(tail) > logAlpha:
+            # P(X >= k) exceeds alpha, so k + 1 is the first failing count
+            return k + 1
+    return 1
+
+
+def worst(statuses):
+    return max(statuses, key=SEVERITY.get, default=OK)
+
+
+class HealthTests:
+
+    def __init__(self, minEntropy, alphaExponent, window, zLimit):
+        self.rctCutoff = rct_cutoff(minEntropy, alphaExponent)
+        self.aptCutoff = apt_cutoff(minEntropy, alphaExponent)
+        self._window = window
+        self._zLimit = zLimit
+        self.reset()
+
+    def reset(self):
+        self.status = OK
+        self.failure = None
+        self._rctValue = -1
+        self._rctRun = 0
+        self._aptPending = numpy.empty(0, dtype=numpy.uint8)
+        self._histogram = numpy.zeros(256, dtype=numpy.int64)
+        self.monobitZ = 0.0
+        self.chiSquareZ = 0.0
+
+    def update(self, data):
+        # Returns the status after data, data must not be used once FAILED
+        samples = numpy.frombuffer(data, dtype=numpy.uint8)
+        if len(samples) == 0 or self.status == FAILED:
+            return self.status
+        if self._repetitionCount(samples):
+            self._fail('repetition count')
+        elif self._adaptiveProportion(samples):
+            self._fail('adaptive proportion')
+        else:
+            self._statistics(samples)
+        return self.status
+
+    def _fail(self, test):
+        self.status = FAILED
+        self.failure = test
+
+    def _repetitionCount(self, samples):
+        # Positions i where samples[i] == samples[i + 1] are rare, so only
+        # those are turned into runs
+        repeats = numpy.flatnonzero(samples[1:] == samples[:-1])
+        carried = self._rctRun if samples[0] == self._rctValue else 0
+        if len(repeats) == 0:
+            longest = 1 + carried
+            lastRun = 1 + carried if len(samples) == 1 else 1
+        else:
+            breaks = numpy.flatnonzero(numpy.diff(repeats) != 1)
+            first = numpy.concatenate(([0], breaks + 1))
+            last = numpy.concatenate((breaks, [len(repeats) - 1]))
+            runs = repeats[last] - repeats[first] + 2
+            if repeats[0] == 0:
+                runs[0] += carried
+            longest = max(int(runs.max()), 1 + carried)
+            lastRun = int(runs[-1]) if repeats[-1] == len(samples) - 2 else 1
+        self._rctValue = samples[-1]
+        self._rctRun = lastRun
+        return longest >= self.rctCutoff
+
+    def _adaptiveProportion(self, samples):
+        if len(self._aptPending) > 0:
+            samples = numpy.concatenate((self._aptPending, samples))
+        full = len(samples) // APT_WINDOW * APT_WINDOW
+        self._aptPending = samples[full:].copy()
+        if full == 0:
+            return False
+        windows = samples[:full].reshape(-1, APT_WINDOW)
+        counts = numpy.count_nonzero(windows == windows[:, :1], axis=1)
+        return counts.max() >= self.aptCutoff
+
+    def _statistics(self, samples):
+        self._histogram += numpy.bincount(samples, minlength=256)
+        n = int(self._histogram.sum())
+        if n < self._window:
+            return
+        bits = 8 * n
+        ones = int(self._histogram @ _POPCOUNT)
+        self.monobitZ = (2 * ones - bits) / math.sqrt(bits)
+        # Chi-square with 255 degrees of freedom, as a z-score (Wilson-Hilferty)
+        expected = n / 256
+        chiSquare = float(((self._histogram - expected) ** 2).sum() / expected)
+        df = 255
+        self.chiSquareZ = ((chiSquare / df) ** (1 / 3) - (1 - 2 / (9 * df))) / math.sqrt(2 / (9 * df))
+        self._histogram[:] = 0
+        biased = abs(self.monobitZ) > self._zLimit or self.chiSquareZ > self._zLimit
+        self.status = DEGRADED if biased else OK
+
+
+class HealthMonitor:
+
+    def __init__(self,
+                 minEntropy=config.HEALTH_MIN_ENTROPY,
+                 alphaExponent=config.HEALTH_ALPHA_EXPONENT,
+                 window=config.HEALTH_WINDOW,
+                 zLimit=config.HEALTH_Z_LIMIT):
+        self._minEntropy = minEntropy
+        self._alphaExponent = alphaExponent
+        self._window = window
+        self._zLimit = zLimit
+        self._tests = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def addListener(self, listener):
+        # listener(deviceId, status) is called whenever a device's status changes
+        self._listeners.append(listener)
+
+    def _device(self, deviceId):
+        tests = self._tests.get(deviceId)
+        if tests is None:
+            with self._lock:
+                tests = self._tests.get(deviceId)
+                if tests is None:
+                    tests = HealthTests(self._minEntropy, self._alphaExponent, self._window, self._zLimit)
+                    self._locks[deviceId] = threading.Lock()
+                    self._tests[deviceId] = tests
+        return tests, self._locks[deviceId]
+
+    def observe(self, deviceId, data):
+        tests, lock = self._device(deviceId)
+        with lock:
+            before = tests.status
+            status = tests.update(data)
+        if status != before:
+            if status == FAILED:
+                metrics.HEALTH_FAILURES.inc(tests.failure, deviceId)
+            print("health tests:", deviceId, status, tests.failure or '')
+            for listener in self._listeners:
+                listener(deviceId, status)
+        return status
+
+    def reset(self):
+        for deviceId, tests in list(self._tests.items()):
+            with self._locks[deviceId]:
+                before = tests.status
+                tests.reset()
+            if before != OK:
+                for listener in self._listeners:
+                    listener(deviceId, OK)
+
+    def status(self, deviceId):
+        tests = self._tests.get(deviceId)
+        return OK if tests is None else tests.status
+
+    def failed(self, deviceId):
+        return self.status(deviceId) == FAILED
+
+    def report(self, deviceId):
+        tests = self._tests.get(deviceId)
+        if tests is None:
+            return {"status": OK}
+        return {"status": tests.status, "failure": tests.failure,
+                "monobitZ": round(tests.monobitZ, 3), "chiSquareZ": round(tests.chiSquareZ, 3)}
+
+    def statuses(self):
+        return {deviceId: tests.status for deviceId, tests in list(self._tests.items())}
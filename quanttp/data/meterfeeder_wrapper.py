@@ -7,115 +7,314 @@
 from platform import os
 from sys import platform
 from ctypes import *
+import threading
+import time
+
+from gevent import get_hub, Timeout
+from gevent.threadpool import ThreadPool
+
+from quanttp import config, metrics
+from quanttp.data.device_recovery import DeviceRecovery, DeviceUnavailable, BACKEND
+from quanttp.data.health_tests import HealthMonitor, FAILED, worst
+from quanttp.data.simulated_backend import SimulatedMeterFeeder
 
 cdll = LibraryLoader(CDLL)
 
-class MeterFeederWrapper:
+# Seconds between checks whether a generator that a waiting request is queued
+# on has been quarantined
+_QUARANTINE_POLL = 0.5
+# Bytes read to check that a recovered generator delivers again
+_PROBE_SIZE = 1024
+
+def loadMeterFeeder():
+    if platform == "linux" or platform == "linux2":
+        # Linux
+        meterfeeder = cdll.LoadLibrary(os.getcwd() + '/libmeterfeeder.so')
+    elif platform == "darwin":
+        # OS X
+        meterfeeder = cdll.LoadLibrary(os.getcwd() + '/libmeterfeeder.dylib')
+    elif platform == "win32":
+        # Windows
+        meterfeeder = cdll.LoadLibrary(os.getcwd() + '/meterfeeder.dll')
+
+    # Declare function bridging
+    meterfeeder.MF_Initialize.argtypes = c_char_p,
+    meterfeeder.MF_Initialize.restype = c_int
 
-    def __init__(self):
-        if platform == "linux" or platform == "linux2":
-            # Linux
-            self._meterfeeder = cdll.LoadLibrary(os.getcwd() + '/libmeterfeeder.so')
-        elif platform == "darwin":
-            # OS X
-            self._meterfeeder = cdll.LoadLibrary(os.getcwd() + '/libmeterfeeder.dylib')
-        elif platform == "win32":
-            # Windows
-            self._meterfeeder = cdll.LoadLibrary(os.getcwd() + '/meterfeeder.dll')
+    meterfeeder.MF_GetNumberGenerators.restype = c_int
 
-        # Declare function bridging
-        self._meterfeeder.MF_Initialize.argtypes = c_char_p,
-        self._meterfeeder.MF_Initialize.restype = c_int
-        
-        self._meterfeeder.MF_GetNumberGenerators.restype = c_int
+    meterfeeder.MF_GetListGenerators.argtypes = [POINTER(c_char_p)]
 
-        self._meterfeeder.MF_GetListGenerators.argtypes = [POINTER(c_char_p)]
+    meterfeeder.MF_GetBytes.argtypes = c_int, POINTER(c_ubyte), c_char_p, c_char_p,
 
-        self._meterfeeder.MF_GetBytes.argtypes = c_int, POINTER(c_ubyte), c_char_p, c_char_p,
+    meterfeeder.MF_RandInt32.argtypes = c_char_p, c_char_p,
+    meterfeeder.MF_RandInt32.restype = c_int
 
-        self._meterfeeder.MF_RandInt32.argtypes = c_char_p, c_char_p,
-        self._meterfeeder.MF_RandInt32.restype = c_int
+    meterfeeder.MF_RandUniform.argtypes = c_char_p, c_char_p,
+    meterfeeder.MF_RandUniform.restype = c_double
 
-        self._meterfeeder.MF_RandUniform.argtypes = c_char_p, c_char_p,
-        self._meterfeeder.MF_RandUniform.restype = c_double
+    meterfeeder.MF_RandNormal.argtypes = c_char_p, c_char_p,
+    meterfeeder.MF_RandNormal.restype = c_double
 
-        self._meterfeeder.MF_RandNormal.argtypes = c_char_p, c_char_p,
-        self._meterfeeder.MF_RandNormal.restype = c_double
+    meterfeeder.MF_Clear.argtypes = c_char_p, c_char_p,
+    meterfeeder.MF_Clear.restype = c_bool
 
-        self._meterfeeder.MF_Clear.argtypes = c_char_p, c_char_p,
-        self._meterfeeder.MF_Clear.restype = c_bool
+    meterfeeder.MF_Reset.argtypes = c_char_p,
+    meterfeeder.MF_Reset.restype = c_int
 
-        self._meterfeeder.MF_Reset.argtypes = c_char_p,
-        self._meterfeeder.MF_Reset.restype = c_int
+    return meterfeeder
 
+class MeterFeederWrapper:
+
+    def __init__(self, backend=None):
+        # The backend is anything exposing the MF_* functions of libmeterfeeder
+        # with the same arguments, e.g. the simulated generators
+        if backend is None:
+            if config.BACKEND == 'simulated':
+                backend = SimulatedMeterFeeder()
+            elif config.BACKEND == 'meterfeeder':
+                backend = loadMeterFeeder()
+            else:
+                raise ValueError('unknown backend ' + config.BACKEND)
+        self._meterfeeder = backend
+        # Continuous health tests on every byte read with MF_GetBytes
+        self.health = HealthMonitor()
+        # Quarantines failing generators and recovers them in the background
+        self.recovery = DeviceRecovery(self._recover)
+
+        # Only used by MF_Initialize, every other call gets its own buffer
         self._medErrorReason = create_string_buffer(256)
 
-        # Initialize Meter Feeder
-        result = self._meterfeeder.MF_Initialize(self._medErrorReason)
+        self._registryLock = threading.Lock()
+        # One MF_Reset at a time
+        self._resetLock = threading.Lock()
+        self._deviceLocks = {}
+        self._deviceExecutors = {}
+
+        # Initialize Meter Feeder, retried in the background until it succeeds.
+        # Until then no generators are listed.
+        self._initialized = False
+        try:
+            self._initialize()
+        except IOError as e:
+            print(e)
+            self.recovery.quarantine(BACKEND, str(e))
+
+    def _initialize(self):
+        self._medErrorReason.value = b''
+        result = self._mf('MF_Initialize', BACKEND, self._medErrorReason)
         if (len(self._medErrorReason.value) > 0):
-            print(self._medErrorReason.value)
-            exit(result)
+            raise IOError('MF_Initialize failed with ' + str(result) + ': ' + str(self._medErrorReason.value, 'utf-8', 'replace'))
+        self._initialized = True
 
-    def deviceIds(self, returnAsList):
+    def _generators(self):
         # Get the list of connected devices
-        numGenerators = self._meterfeeder.MF_GetNumberGenerators()
+        if not self._initialized:
+            return []
+        numGenerators = self._mf('MF_GetNumberGenerators', BACKEND, errorBuffer=False)
         generatorsListBuffers = [create_string_buffer(58) for i in range(numGenerators)]
         generatorsListBufferPointers = (c_char_p*numGenerators)(*map(addressof, generatorsListBuffers))
-        self._meterfeeder.MF_GetListGenerators(generatorsListBufferPointers)
-        generatorsList = [str(s.value, 'utf-8') for s in generatorsListBuffers]
-        
+        self._mf('MF_GetListGenerators', BACKEND, generatorsListBufferPointers, errorBuffer=False)
+        return [str(s.value, 'utf-8') for s in generatorsListBuffers]
+
+    def deviceIds(self, returnAsList):
+        # Quarantined generators are left out until they have recovered
+        generatorsList = [generator for generator in self._generators()
+                          if not self.recovery.quarantined(generator.split("|")[0])]
+
         if returnAsList:
             return generatorsList
+        return ','.join(generator.split("|")[0] for generator in generatorsList)
 
-        deviceIdsCsvList = ""
-        for i in range(numGenerators):
-            if i < numGenerators - 1:
-                deviceIdsCsvList += generatorsList[i].split("|")[0] + ","
-            else:
-                deviceIdsCsvList += generatorsList[i].split("|")[0]
-        return deviceIdsCsvList
+    def _call(self, deviceId, length, function, *args):
+        # Calls from the gevent hub (the main thread) are handed to the device's
+        # worker thread so that a slow USB read only blocks the calling greenlet.
+        # Background threads, including the workers themselves, call directly.
+        if self.recovery.quarantined(deviceId):
+            raise DeviceUnavailable(deviceId + ' is quarantined')
+        if threading.current_thread() is not threading.main_thread():
+            return self._locked(deviceId, length, function, *args)
+        result = self._deviceExecutor(deviceId).spawn(self._locked, deviceId, length, function, *args)
+        while True:
+            try:
+                return result.get(timeout=_QUARANTINE_POLL)
+            except Timeout:
+                # The call, or one it is queued behind, hung and the watchdog
+                # quarantined the generator: fail over instead of waiting
+                if self.recovery.quarantined(deviceId):
+                    raise DeviceUnavailable(deviceId + ' is quarantined')
 
-    def randint32(self, deviceId):
+    def _locked(self, deviceId, length, function, *args):
+        with self._deviceLock(deviceId):
+            # The watchdog's deadline starts once the call has the device
+            token = self.recovery.begin(deviceId, length)
+            try:
+                return function(*args)
+            finally:
+                self.recovery.end(token)
+
+    def _deviceLock(self, deviceId):
+        lock = self._deviceLocks.get(deviceId)
+        if lock is None:
+            with self._registryLock:
+                lock = self._deviceLocks.setdefault(deviceId, threading.Lock())
+        return lock
+
+    def _deviceExecutor(self, deviceId):
+        executor = self._deviceExecutors.get(deviceId)
+        if executor is None:
+            with self._registryLock:
+                executor = self._deviceExecutors.get(deviceId)
+                if executor is None:
+                    executor = ThreadPool(1)
+                    self._deviceExecutors[deviceId] = executor
+        return executor
+
+    def _mf(self, function, deviceId, *args, errorBuffer=True):
+        # Timed call into the backend, the last argument is the error buffer
+        # unless errorBuffer is False. Calls for no one generator are
+        # labelled BACKEND.
+        start = time.perf_counter()
+        failed = True
         try:
-            return self._meterfeeder.MF_RandInt32(deviceId.encode("utf-8"), self._medErrorReason)
-        except:
-            self._meterfeeder.MF_Reset()
-            return self._meterfeeder.MF_RandInt32(deviceId.encode("utf-8"), self._medErrorReason)
+            result = getattr(self._meterfeeder, function)(*args)
+            failed = errorBuffer and len(args[-1].value) > 0
+            return result
+        finally:
+            metrics.MF_CALL_SECONDS.observe(time.perf_counter() - start, function, deviceId)
+            if failed:
+                metrics.MF_ERRORS.inc(function, deviceId)
+
+    def _mfReset(self, errorReason):
+        metrics.MF_RESETS.inc()
+        return self._mf('MF_Reset', BACKEND, errorReason)
+
+    def _checked(self, function, deviceId, *args):
+        # Retries once after an error, the generator is quarantined when the
+        # retry fails as well
+        for attempt in range(2):
+            errorReason = create_string_buffer(256)
+            try:
+                result = self._mf(function, deviceId, *args, errorReason)
+                if len(errorReason.value) == 0:
+                    return result
+                error = str(errorReason.value, 'utf-8', 'replace')
+            except Exception as e:
+                error = str(e)
+        self.recovery.quarantine(deviceId, function + ': ' + error)
+        raise DeviceUnavailable(deviceId + ' failed: ' + error)
+
+    def randint32(self, deviceId):
+        return self._call(deviceId, 4, self._randint32, deviceId)
+
+    def _randint32(self, deviceId):
+        return self._checked('MF_RandInt32', deviceId, deviceId.encode("utf-8"))
 
     def randuniform(self, deviceId):
-        try:
-            return self._meterfeeder.MF_RandUniform(deviceId.encode("utf-8"), self._medErrorReason)
-        except:
-            self._meterfeeder.MF_Reset()
-            return self._meterfeeder.MF_RandUniform(deviceId.encode("utf-8"), self._medErrorReason)
+        return self._call(deviceId, 8, self._randuniform, deviceId)
+
+    def _randuniform(self, deviceId):
+        return self._checked('MF_RandUniform', deviceId, deviceId.encode("utf-8"))
 
     def randnormal(self, deviceId):
-        try:
-            return self._meterfeeder.MF_RandNormal(deviceId.encode("utf-8"), self._medErrorReason)
-        except:
-            self._meterfeeder.MF_Reset()
-            return self._meterfeeder.MF_RandNormal(deviceId.encode("utf-8"), self._medErrorReason)
+        return self._call(deviceId, 8, self._randnormal, deviceId)
+
+    def _randnormal(self, deviceId):
+        return self._checked('MF_RandNormal', deviceId, deviceId.encode("utf-8"))
 
     def randbytes(self, deviceId, length):
+        return self._call(deviceId, length, self._randbytes, deviceId, length)
+
+    def _randbytes(self, deviceId, length):
         barray = bytearray(length)
         ubuffer = (c_ubyte * length).from_buffer(barray)
-        try:
-            self._meterfeeder.MF_GetBytes(length, ubuffer, deviceId.encode("utf-8"), self._medErrorReason)
-            return barray
-        except:
-            self._meterfeeder.MF_Reset()
-            self._meterfeeder.MF_GetBytes(length, ubuffer, deviceId.encode("utf-8"), self._medErrorReason)
-            return barray
+        self._checked('MF_GetBytes', deviceId, length, ubuffer, deviceId.encode("utf-8"))
+        metrics.DEVICE_READ_BYTES.inc(deviceId, amount=length)
+        if config.HEALTH_TESTS and self.health.observe(deviceId, barray) == FAILED:
+            # Never hand out bytes from a generator that failed its health tests
+            raise DeviceUnavailable(deviceId + ' failed its health tests')
+        return barray
 
     def clear(self, deviceId):
-        if self._meterfeeder.MF_Clear(deviceId.encode("utf-8"), self._medErrorReason) == False:
-            print("unable to clear", deviceId, ": ", self._medErrorReason.value)
+        self._call(deviceId, 0, self._clear, deviceId)
+
+    def _clear(self, deviceId):
+        errorReason = create_string_buffer(256)
+        if self._mf('MF_Clear', deviceId, deviceId.encode("utf-8"), errorReason) == False:
+            print("unable to clear", deviceId, ": ", errorReason.value)
 
     def reset(self):
-        result = self._meterfeeder.MF_Reset(self._medErrorReason)
-        if (len(self._medErrorReason.value) > 0):
-            print(self._medErrorReason)
-            exit(result)
+        if threading.current_thread() is not threading.main_thread():
+            return self._reset()
+        return get_hub().threadpool.apply(self._reset)
+
+    def _reset(self):
+        self._resetAll()
+        # Generators get a fresh start after a reset
+        self.health.reset()
+        self.recovery.retryNow()
+
+    def _resetAll(self):
+        # MF_Reset affects every generator, so wait for all of them to be idle.
+        # The device of a quarantined generator may be held by a hung call,
+        # which is what the reset has to break.
+        with self._resetLock:
+            held = []
+            for deviceId in sorted(self._deviceLocks):
+                lock = self._deviceLock(deviceId)
+                while not lock.acquire(timeout=_QUARANTINE_POLL):
+                    if self.recovery.quarantined(deviceId):
+                        lock = None
+                        break
+                if lock is not None:
+                    held.append(lock)
+            try:
+                errorReason = create_string_buffer(256)
+                result = self._mfReset(errorReason)
+                if len(errorReason.value) > 0:
+                    print("MF_Reset failed with", result, ":", str(errorReason.value, 'utf-8', 'replace'))
+                if len(errorReason.value) > 0 or not self._initialized:
+                    # Re-initialize when the reset fails or MF_Initialize never succeeded
+                    self._initialize()
+            finally:
+                for lock in held:
+                    lock.release()
+
+    def _recover(self, name):
+        # One recovery attempt, on a thread of its own. Raises if it failed.
+        self._resetAll()
+        if name == BACKEND:
+            return
+        if name not in [generator.split("|")[0] for generator in self._generators()]:
+            raise IOError(name + ' is not connected')
+        # A probe read, on a thread of its own in case it hangs as well
+        errors = []
+        probe = threading.Thread(target=self._probe, args=(name, errors), name='device-probe-' + name, daemon=True)
+        probe.start()
+        probe.join(_QUARANTINE_POLL + self.recovery.timeout(_PROBE_SIZE))
+        if probe.is_alive():
+            raise IOError('probe read timed out')
+        if len(errors) > 0:
+            raise IOError('probe read failed: ' + errors[0])
+
+    def _probe(self, deviceId, errors):
+        lock = self._deviceLock(deviceId)
+        if not lock.acquire(timeout=_QUARANTINE_POLL):
+            errors.append('a previous call is still hung')
+            return
+        try:
+            errorReason = create_string_buffer(256)
+            ubuffer = (c_ubyte * _PROBE_SIZE)()
+            self._mf('MF_GetBytes', deviceId, _PROBE_SIZE, ubuffer, deviceId.encode("utf-8"), errorReason)
+            if len(errorReason.value) > 0:
+                errors.append(str(errorReason.value, 'utf-8', 'replace'))
+        except Exception as e:
+            errors.append(str(e))
+        finally:
+            lock.release()
 
-    def status(self):
-        return "ONLINE"
+    def status(self, deviceId=None):
+        # A generator's health status, or the worst of all generators
+        if deviceId is None:
+            return worst(self.health.statuses().values())
+        return self.health.status(deviceId)
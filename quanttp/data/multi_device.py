@@ -0,0 +1,120 @@
+##
+ # Virtual devices spanning every attached generator
+ #
+ # ANY : each request goes to the generator expected to finish it first, and
+ #       large requests are split across all generators and read in parallel.
+ #       A read that fails with an IOError is retried on the next generator.
+ # XOR : every generator is read in parallel and the streams are XOR-combined
+ #
+ # Both raise DeviceUnavailable while every generator is failed or quarantined.
+ ##
+
+import time
+
+import gevent
+import numpy
+
+from quanttp import config, metrics
+from quanttp.data.device_recovery import DeviceUnavailable
+
+ANY = 'ANY'
+XOR = 'XOR'
+VIRTUAL_DEVICE_IDS = (ANY, XOR)
+
+# Weight of the newest sample in the per-device throughput estimate
+_RATE_SMOOTHING = 0.2
+
+
+class MultiDeviceRouter:
+
+    def __init__(self, source, deviceIds, splitThreshold=config.ANY_SPLIT_THRESHOLD):
+        self._source = source
+        self._deviceIds = deviceIds
+        self._splitThreshold = splitThreshold
+        self._inFlight = {}
+        self._rates = {}
+
+    @property
+    def source(self):
+        return self._source
+
+    def randbytes(self, deviceId, length, read=None):
+        # read(deviceId, length) reads from one real device, by default the
+        # source. The scheduler passes its own, so that it routes first and
+        # then queues each device's part with that device's other requests.
+        read = read or self._source.randbytes
+        if deviceId == ANY:
+            return self._randbytesAny(length, read)
+        if deviceId == XOR:
+            return self._randbytesXor(length, read)
+        return self._read(read, deviceId, length)
+
+    def clear(self, deviceId):
+        for realDeviceId in (self._deviceIds() if deviceId in VIRTUAL_DEVICE_IDS else [deviceId]):
+            self._source.clear(realDeviceId)
+
+    def reset(self):
+        self._source.reset()
+
+    def _devices(self):
+        deviceIds = self._deviceIds()
+        if len(deviceIds) == 0:
+            raise DeviceUnavailable('no devices available')
+        return deviceIds
+
+    def _rate(self, deviceId):
+        # Devices without measurements yet are assumed to be as fast as the best one
+        return self._rates.get(deviceId) or max(self._rates.values(), default=1.0)
+
+    def _read(self, read, deviceId, length):
+        self._inFlight[deviceId] = self._inFlight.get(deviceId, 0) + length
+        start = time.perf_counter()
+        try:
+            data = read(deviceId, length)
+        finally:
+            self._inFlight[deviceId] -= length
+        metrics.DEVICE_DELIVERED_BYTES.inc(deviceId, amount=length)
+        elapsed = time.perf_counter() - start
+        if elapsed > 0:
+            rate = length / elapsed
+            previous = self._rates.get(deviceId)
+            self._rates[deviceId] = rate if previous is None else previous + _RATE_SMOOTHING * (rate - previous)
+        return data
+
+    def _parallel(self, read, reads):
+        greenlets = [gevent.spawn(self._read, read, deviceId, length) for deviceId, length in reads]
+        gevent.joinall(greenlets, raise_error=True)
+        return [greenlet.value for greenlet in greenlets]
+
+    def _randbytesAny(self, length, read):
+        deviceIds = self._devices()
+        if length < self._splitThreshold or len(deviceIds) == 1:
+            return self._readAny(read, deviceIds, length)
+
+        # Split in proportion to each device's throughput
+        rates = [self._rate(deviceId) for deviceId in deviceIds]
+        total = sum(rates)
+        lengths = [int(length * rate / total) for rate in rates]
+        lengths[0] += length - sum(lengths)
+        greenlets = [gevent.spawn(self._readAny, read, deviceIds, n, deviceId) for deviceId, n in zip(deviceIds, lengths) if n > 0]
+        gevent.joinall(greenlets, raise_error=True)
+        return b''.join(greenlet.value for greenlet in greenlets)
+
+    def _readAny(self, read, deviceIds, length, preferred=None):
+        # Try the preferred device, then the others in the order they are
+        # expected to finish this request
+        candidates = sorted(deviceIds, key=lambda d: (d != preferred, (self._inFlight.get(d, 0) + length) / self._rate(d)))
+        error = None
+        for deviceId in candidates:
+            try:
+                return self._read(read, deviceId, length)
+            except IOError as e:
+                error = e
+        raise error
+
+    def _randbytesXor(self, length, read):
+        streams = self._parallel(read, [(deviceId, length) for deviceId in self._devices()])
+        combined = numpy.frombuffer(streams[0], dtype=numpy.uint8).copy()
+        for stream in streams[1:]:
+            numpy.bitwise_xor(combined, numpy.frombuffer(stream, dtype=numpy.uint8), out=combined)
+        return combined.tobytes()
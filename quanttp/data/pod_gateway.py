@@ -0,0 +1,260 @@
+##
+ # Pod federation gateway
+ #
+ # Stands in for MeterFeederWrapper when quanttp runs as a gateway: its
+ # generators are the generators of a set of upstream Pod Entropy Servers. The
+ # device registry, ANY/XOR routing, coalescing, scheduling and every endpoint
+ # run on top of it unchanged, so the gateway speaks the same API as a pod.
+ #
+ # Blocking upstream I/O runs on a thread pool per pod. Each worker keeps its
+ # own keep-alive HTTP session and persistent WebSocket connection. Small
+ # reads go over the WebSocket with RANDBYTES, larger ones over HTTP. A pod
+ # that cannot be reached is marked down and its generators drop out until it
+ # answers the next inventory poll.
+ ##
+
+import ast
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from gevent.threadpool import ThreadPool
+
+from quanttp import config
+from quanttp.data.health_tests import OK, FAILED, worst
+from quanttp.wsclient import WebSocketClient, WebSocketClosed
+
+UNREACHABLE = 'pod unreachable'
+
+
+class UpstreamError(IOError):
+    # The pod answered, but with an error status
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+class UpstreamPod:
+
+    def __init__(self, url, connections, timeout, wsMaxRead):
+        self.url = url.rstrip('/')
+        self.up = False
+        self.generators = []
+        self.health = {}
+        # Requests the pod reported in flight at the last poll
+        self.reportedLoad = 0
+        # Bytes the gateway is currently reading from the pod
+        self.inFlight = 0
+        self._timeout = timeout
+        self._wsMaxRead = wsMaxRead
+        self._wsUrl = 'ws' + self.url[len('http'):] + '/ws'
+        self._executor = ThreadPool(connections)
+        self._local = threading.local()
+
+    def _call(self, function, *args):
+        # Same rule as MeterFeederWrapper: the gevent hub hands blocking I/O to
+        # the pod's workers, other threads call directly
+        if threading.current_thread() is not threading.main_thread():
+            return function(*args)
+        return self._executor.apply(function, args)
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _get(self, path, params=None):
+        response = self._session().get(self.url + path, params=params, timeout=self._timeout)
+        if response.status_code >= 400:
+            raise UpstreamError(self.url + path + ' returned ' + str(response.status_code) + ': ' + response.text[:200],
+                                response.status_code)
+        return response
+
+    def poll(self):
+        # Called off the hub by the device registry thread
+        generators = ast.literal_eval(self._get('/api/json/devices').text)['devices']
+        # Older pods answer /api/status with 400, the body is still JSON
+        response = self._session().get(self.url + '/api/status', timeout=self._timeout)
+        try:
+            status = response.json()
+        except ValueError:
+            status = {}
+        self.generators = generators
+        self.health = status.get('health', {})
+        self.reportedLoad = status.get('load', {}).get('requestsInFlight', 0)
+        self.up = True
+
+    def randbytes(self, deviceId, length):
+        self.inFlight += length
+        try:
+            return self._call(self._randbytes, deviceId, length)
+        finally:
+            self.inFlight -= length
+
+    def _randbytes(self, deviceId, length):
+        if length <= self._wsMaxRead:
+            data = self._randbytesWebSocket(deviceId, length)
+            if data is not None:
+                return data
+        return self._get('/api/randbytes', {'deviceId': deviceId, 'length': length}).content
+
+    def _randbytesWebSocket(self, deviceId, length):
+        # Returns None when the WebSocket path fails, the caller then uses HTTP
+        websocket = getattr(self._local, 'websocket', None)
+        try:
+            if websocket is None or websocket.closed:
+                websocket = self._local.websocket = WebSocketClient(self._wsUrl, self._timeout)
+            websocket.send('RANDBYTES ' + deviceId + ' ' + str(length))
+            data = websocket.receive()
+            if isinstance(data, bytes) and len(data) == length:
+                return data
+        except (OSError, WebSocketClosed):
+            pass
+        # A refused command gets no reply, so never reuse the connection after a miss
+        if websocket is not None:
+            try:
+                websocket.close()
+            except (OSError, WebSocketClosed):
+                pass
+        self._local.websocket = None
+        return None
+
+    def clear(self, deviceId):
+        self._call(self._get, '/api/clear', {'deviceId': deviceId})
+
+    def reset(self):
+        self._call(self._get, '/api/reset')
+
+
+class GatewayHealth:
+    # The health status each pod reports for its generators. Generators of a
+    # pod that cannot be reached are FAILED.
+
+    def __init__(self, gateway):
+        self._gateway = gateway
+        self._listeners = []
+        self._statuses = {}
+
+    def addListener(self, listener):
+        self._listeners.append(listener)
+
+    def update(self):
+        statuses = {}
+        for pod in self._gateway.pods:
+            for generator in pod.generators:
+                deviceId = generator.split("|")[0]
+                status = pod.health.get(deviceId, {}).get('status', OK) if pod.up else FAILED
+                # A generator listed by several pods is as healthy as its best copy
+                if statuses.get(deviceId) != OK:
+                    statuses[deviceId] = status
+        previous, self._statuses = self._statuses, statuses
+        for deviceId, status in statuses.items():
+            if previous.get(deviceId, OK) != status:
+                for listener in self._listeners:
+                    listener(deviceId, status)
+
+    def reset(self):
+        pass
+
+    def status(self, deviceId):
+        return self._statuses.get(deviceId, OK)
+
+    def failed(self, deviceId):
+        return self.status(deviceId) == FAILED
+
+    def statuses(self):
+        return dict(self._statuses)
+
+    def report(self, deviceId):
+        for pod in self._gateway.pods:
+            if any(generator.split("|")[0] == deviceId for generator in pod.generators):
+                if not pod.up:
+                    return {"status": FAILED, "failure": UNREACHABLE, "pod": pod.url}
+                return dict(pod.health.get(deviceId, {"status": OK}), pod=pod.url)
+        return {"status": OK}
+
+
+class PodGateway:
+
+    def __init__(self, urls,
+                 connections=config.GATEWAY_CONNECTIONS,
+                 timeout=config.GATEWAY_TIMEOUT,
+                 wsMaxRead=config.GATEWAY_WS_MAX_READ):
+        if len(urls) == 0:
+            raise ValueError('a gateway needs at least one upstream pod')
+        self.pods = [UpstreamPod(url, connections, timeout, wsMaxRead) for url in urls]
+        self.health = GatewayHealth(self)
+        self._pollExecutor = ThreadPoolExecutor(max_workers=len(self.pods))
+
+    def deviceIds(self, returnAsList):
+        # Polls every pod in parallel, the device registry calls this from its
+        # own thread and caches the result
+        for pod, error in zip(self.pods, self._pollExecutor.map(self._poll, self.pods)):
+            if error is not None:
+                if pod.up:
+                    print("upstream pod", pod.url, "is down:", error)
+                pod.up = False
+        self.health.update()
+        generators = []
+        for pod in self.pods:
+            if pod.up:
+                generators.extend(g for g in pod.generators if g not in generators)
+        if returnAsList:
+            return generators
+        return ','.join(generator.split("|")[0] for generator in generators)
+
+    def _poll(self, pod):
+        try:
+            pod.poll()
+            return None
+        except (OSError, ValueError, SyntaxError, KeyError, requests.RequestException) as e:
+            return e
+
+    def _podsFor(self, deviceId):
+        pods = [pod for pod in self.pods if pod.up and any(g.split("|")[0] == deviceId for g in pod.generators)]
+        if len(pods) == 0:
+            raise ValueError('device ' + deviceId + ' is not available on any upstream pod')
+        # Least loaded first, by the gateway's own reads and the pod's reported requests
+        return sorted(pods, key=lambda pod: (pod.inFlight, pod.reportedLoad))
+
+    def _down(self, pod, error):
+        print("upstream pod", pod.url, "failed:", error)
+        pod.up = False
+        self.health.update()
+
+    def randbytes(self, deviceId, length):
+        error = None
+        for pod in self._podsFor(deviceId):
+            try:
+                return pod.randbytes(deviceId, length)
+            except UpstreamError as e:
+                # Refused, e.g. rate limited or the generator just failed there.
+                # 503 is a generator quarantined by a pod that is otherwise fine.
+                if e.status >= 500 and e.status != 503:
+                    self._down(pod, e)
+                error = e
+            except (OSError, requests.RequestException) as e:
+                # Fail over to the next pod listing this generator, if any
+                self._down(pod, e)
+                error = e
+        raise IOError('device ' + deviceId + ' failed on every upstream pod: ' + str(error))
+
+    def clear(self, deviceId):
+        for pod in self._podsFor(deviceId):
+            pod.clear(deviceId)
+
+    def reset(self):
+        for pod in self.pods:
+            if pod.up:
+                try:
+                    pod.reset()
+                except (OSError, requests.RequestException) as e:
+                    self._down(pod, e)
+
+    def status(self, deviceId=None):
+        if deviceId is None:
+            return worst(self.health.statuses().values())
+        return self.health.status(deviceId)
+
@@ -0,0 +1,74 @@
+##
+ # Request coalescing
+ #
+ # Small reads that reach the device while others for the same generator are
+ # pending are collected for up to COALESCE_WINDOW seconds, or until
+ # COALESCE_MAX_BYTES are pending, and served by one MF_GetBytes call. Each
+ # waiter gets its own disjoint slice of the result, so no byte is handed out
+ # twice. Only reads from the gevent hub are coalesced; background threads and
+ # large reads go straight to the device.
+ ##
+
+import threading
+
+import gevent
+from gevent.event import AsyncResult
+
+from quanttp import config, metrics
+
+
+class _Batch:
+
+    def __init__(self):
+        self.size = 0
+        self.requests = 0
+        self.flushed = False
+        self.result = AsyncResult()
+
+
+class RequestCoalescer:
+
+    def __init__(self, source,
+                 window=config.COALESCE_WINDOW,
+                 maxBytes=config.COALESCE_MAX_BYTES,
+                 maxRequest=config.COALESCE_MAX_REQUEST):
+        self._source = source
+        self._window = window
+        self._maxBytes = maxBytes
+        self._maxRequest = maxRequest
+        self._batches = {}
+
+    def randbytes(self, deviceId, length):
+        if length > self._maxRequest or threading.current_thread() is not threading.main_thread():
+            return self._source.randbytes(deviceId, length)
+
+        batch = self._batches.get(deviceId)
+        if batch is None:
+            batch = self._batches[deviceId] = _Batch()
+            gevent.spawn_later(self._window, self._flush, deviceId, batch)
+        offset = batch.size
+        batch.size += length
+        batch.requests += 1
+        if batch.size >= self._maxBytes:
+            # Full, read it now instead of waiting for the window to close
+            self._flush(deviceId, batch)
+        return batch.result.get()[offset:offset + length]
+
+    def clear(self, deviceId):
+        self._source.clear(deviceId)
+
+    def reset(self):
+        self._source.reset()
+
+    def _flush(self, deviceId, batch):
+        if batch.flushed:
+            return
+        batch.flushed = True
+        # Requests arriving from now on start the next batch
+        if self._batches.get(deviceId) is batch:
+            del self._batches[deviceId]
+        metrics.COALESCED_REQUESTS.observe(batch.requests, deviceId)
+        try:
+            batch.result.set(self._source.randbytes(deviceId, batch.size))
+        except Exception as e:
+            batch.result.set_exception(e)
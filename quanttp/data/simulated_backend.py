@@ -0,0 +1,159 @@
+##
+ # Simulated MeterFeeder backend
+ #
+ # Implements the MF_* functions of libmeterfeeder with the same arguments, so
+ # MeterFeederWrapper can run without ComScire hardware. Every generator streams
+ # NumPy pseudo-random bytes at a configurable rate with per-call latency and
+ # jitter. Errors, stalls, disconnects and stuck outputs can be injected at
+ # random. A disconnected generator is no longer listed and fails every call
+ # until MF_Reset, a stuck one repeats the same byte until MF_Reset. A failing
+ # one stays listed and fails every call, MF_Reset does not fix it.
+ ##
+
+import threading
+import time
+from ctypes import POINTER, c_void_p, cast, memmove
+
+import numpy
+
+from quanttp import config
+from quanttp.data import conversions
+
+
+class SimulatedGenerator:
+
+    def __init__(self, serialNumber, seed=None):
+        self.serialNumber = serialNumber
+        self.description = 'Simulated ' + serialNumber
+        self.connected = True
+        self.stuck = False
+        self.failing = False
+        self.random = numpy.random.default_rng(seed)
+
+
+class SimulatedMeterFeeder:
+
+    def __init__(self,
+                 devices=config.SIM_DEVICES,
+                 firstSerial=config.SIM_FIRST_SERIAL,
+                 rate=config.SIM_RATE,
+                 latency=config.SIM_LATENCY,
+                 jitter=config.SIM_JITTER,
+                 errorRate=config.SIM_ERROR_RATE,
+                 stallRate=config.SIM_STALL_RATE,
+                 stallTime=config.SIM_STALL_TIME,
+                 disconnectRate=config.SIM_DISCONNECT_RATE,
+                 stuckRate=config.SIM_STUCK_RATE,
+                 seed=None):
+        self._rate = rate
+        self._latency = latency
+        self._jitter = jitter
+        self._errorRate = errorRate
+        self._stallRate = stallRate
+        self._stallTime = stallTime
+        self._disconnectRate = disconnectRate
+        self._stuckRate = stuckRate
+        self._faults = numpy.random.default_rng(seed)
+        self._faultLock = threading.Lock()
+        self._generators = {}
+        for i in range(devices):
+            serialNumber = 'SIM%05d' % (firstSerial + i)
+            self._generators[serialNumber] = SimulatedGenerator(serialNumber, None if seed is None else seed + i + 1)
+
+    # Fault injection ----------------------------------------------
+
+    def disconnect(self, serialNumber):
+        self._generators[serialNumber].connected = False
+
+    def stick(self, serialNumber):
+        self._generators[serialNumber].stuck = True
+
+    def fail(self, serialNumber, failing=True):
+        self._generators[serialNumber].failing = failing
+
+    def _chance(self):
+        with self._faultLock:
+            return self._faults.random()
+
+    def _generator(self, deviceId, errorReason):
+        generator = self._generators.get(deviceId.decode('utf-8'))
+        if generator is None or not generator.connected:
+            errorReason.value = b'Device not found: ' + deviceId
+            return None
+        if generator.failing:
+            errorReason.value = b'Simulated failure: ' + deviceId
+            return None
+        if self._disconnectRate > 0 and self._chance() < self._disconnectRate:
+            generator.connected = False
+            errorReason.value = b'Simulated disconnect: ' + deviceId
+            return None
+        if self._errorRate > 0 and self._chance() < self._errorRate:
+            errorReason.value = b'Simulated read error: ' + deviceId
+            return None
+        return generator
+
+    def _wait(self, length):
+        delay = self._latency
+        if self._jitter > 0:
+            delay += self._jitter * self._chance()
+        if self._rate > 0:
+            delay += length / self._rate
+        if self._stallRate > 0 and self._chance() < self._stallRate:
+            delay += self._stallTime
+        if delay > 0:
+            time.sleep(delay)
+
+    def _read(self, length, deviceId, errorReason):
+        generator = self._generator(deviceId, errorReason)
+        if generator is None:
+            return None
+        self._wait(length)
+        if self._stuckRate > 0 and self._chance() < self._stuckRate:
+            generator.stuck = True
+        if generator.stuck:
+            return bytes(length)
+        return generator.random.bytes(length)
+
+    # MF_* functions ----------------------------------------------
+
+    def MF_Initialize(self, errorReason):
+        if len(self._generators) == 0:
+            errorReason.value = b'Error creating device info list. Check if generators are connected.'
+            return 0
+        return 1
+
+    def MF_GetNumberGenerators(self):
+        return len([g for g in self._generators.values() if g.connected])
+
+    def MF_GetListGenerators(self, generatorsList):
+        addresses = cast(generatorsList, POINTER(c_void_p))
+        connected = [g for g in self._generators.values() if g.connected]
+        for i, generator in enumerate(connected):
+            entry = (generator.serialNumber + '|' + generator.description).encode('utf-8') + b'\0'
+            memmove(addresses[i], entry, len(entry))
+
+    def MF_GetBytes(self, length, buffer, deviceId, errorReason):
+        data = self._read(length, deviceId, errorReason)
+        if data is not None:
+            memmove(buffer, data, length)
+
+    def MF_RandInt32(self, deviceId, errorReason):
+        data = self._read(conversions.INT32_SIZE, deviceId, errorReason)
+        return 0 if data is None else conversions.int32(data)
+
+    def MF_RandUniform(self, deviceId, errorReason):
+        data = self._read(conversions.UNIFORM_SIZE, deviceId, errorReason)
+        return 0.0 if data is None else conversions.uniform(data)
+
+    def MF_RandNormal(self, deviceId, errorReason):
+        data = self._read(conversions.NORMAL_SIZE, deviceId, errorReason)
+        return 0.0 if data is None else conversions.normal(data)
+
+    def MF_Clear(self, deviceId, errorReason):
+        return self._generator(deviceId, errorReason) is not None
+
+    def MF_Reset(self, errorReason):
+        for generator in self._generators.values():
+            generator.connected = True
+            generator.stuck = False
+        return 1
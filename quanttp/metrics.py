@@ -0,0 +1,273 @@
+##
+ # Prometheus-style metrics
+ #
+ # Recording never takes a lock: every thread writes to its own shard and the
+ # shards are only summed when /metrics is scraped. Greenlets share their
+ # thread's shard, which is safe because they cannot switch in the middle of
+ # an update.
+ ##
+
+import bisect
+import threading
+import time
+import weakref
+
+# Latency buckets in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets for counts of requests
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class _Shards:
+    # merge(base, shard) adds a shard into base. The shards of threads that
+    # have exited are merged into a base shard and dropped, so that short-lived
+    # threads such as recovery attempts do not leave one behind each.
+
+    def __init__(self, merge):
+        self._merge = merge
+        self._local = threading.local()
+        self._base = {}
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            # Once per thread, never on the hot path
+            shard = {}
+            with self._lock:
+                self._fold()
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+            self._local.shard = shard
+            return shard
+
+    def _fold(self):
+        live = []
+        for reference, shard in self._shards:
+            thread = reference()
+            if thread is None or not thread.is_alive():
+                self._merge(self._base, shard)
+            else:
+                live.append((reference, shard))
+        self._shards = live
+
+    def all(self):
+        with self._lock:
+            self._fold()
+            return [self._base] + [shard for thread, shard in self._shards]
+
+
+def _addValues(base, shard):
+    for labelValues, value in list(shard.items()):
+        base[labelValues] = base.get(labelValues, 0) + value
+
+
+def _addBuckets(base, shard):
+    for labelValues, data in list(shard.items()):
+        total = base.get(labelValues)
+        if total is None:
+            base[labelValues] = list(data)
+        else:
+            for i, value in enumerate(data):
+                total[i] += value
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._shards = _Shards(_addValues)
+
+    def inc(self, *labelValues, amount=1):
+        shard = self._shards.get()
+        shard[labelValues] = shard.get(labelValues, 0) + amount
+
+    def values(self):
+        totals = {}
+        for shard in self._shards.all():
+            _addValues(totals, shard)
+        return totals
+
+    def samples(self):
+        values = self.values()
+        if len(self.labels) == 0 and len(values) == 0:
+            values = {(): 0}
+        for labelValues, value in sorted(values.items()):
+            yield self.name + _labels(self.labels, labelValues), value
+
+
+class Gauge(Counter):
+    # Changed with inc()/dec(), the shards hold deltas that sum to the value
+
+    type = 'gauge'
+
+    def dec(self, *labelValues, amount=1):
+        self.inc(*labelValues, amount=-amount)
+
+
+class GaugeFunction:
+    # Evaluated at scrape time, function returns {labelValues: value}
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labels, function):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._function = function
+
+    def samples(self):
+        for labelValues, value in sorted(self._function().items()):
+            yield self.name + _labels(self.labels, labelValues), value
+
+
+class Histogram:
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._buckets = tuple(buckets)
+        self._shards = _Shards(_addBuckets)
+
+    def observe(self, value, *labelValues):
+        shard = self._shards.get()
+        data = shard.get(labelValues)
+        if data is None:
+            # Per-bucket counts followed by the sum of observations
+            data = shard[labelValues] = [0] * (len(self._buckets) + 1) + [0.0]
+        data[bisect.bisect_left(self._buckets, value)] += 1
+        data[-1] += value
+
+    def time(self, *labelValues):
+        return _Timer(self, labelValues)
+
+    def samples(self):
+        totals = {}
+        for shard in self._shards.all():
+            _addBuckets(totals, shard)
+        for labelValues, data in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float('inf'),), data):
+                cumulative += count
+                yield self.name + '_bucket' + _labels(self.labels, labelValues, 'le="%s"' % _number(bound)), cumulative
+            yield self.name + '_sum' + _labels(self.labels, labelValues), data[-1]
+            yield self.name + '_count' + _labels(self.labels, labelValues), cumulative
+
+
+class _Timer:
+
+    def __init__(self, histogram, labelValues):
+        self._histogram = histogram
+        self._labelValues = labelValues
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start, *self._labelValues)
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, value in metric.samples():
+                lines.append('%s %s' % (name, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class RateTracker:
+    # Turns a counter into a per-second rate over the time since the last scrape
+
+    def __init__(self, counter):
+        self._counter = counter
+        self._last = {}
+        self._lastTime = time.monotonic()
+        self._rates = {}
+
+    def rates(self):
+        now = time.monotonic()
+        elapsed = now - self._lastTime
+        if elapsed > 0:
+            current = self._counter.values()
+            self._rates = {labelValues: (value - self._last.get(labelValues, 0)) / elapsed for labelValues, value in current.items()}
+            self._last = current
+            self._lastTime = now
+        return self._rates
+
+
+REGISTRY = Registry()
+
+DEVICE_READ_BYTES = REGISTRY.register(Counter(
+    'quanttp_device_read_bytes_total', 'Bytes read from the generator with MF_GetBytes', ('device',)))
+DEVICE_DELIVERED_BYTES = REGISTRY.register(Counter(
+    'quanttp_device_delivered_bytes_total', 'Bytes handed out to clients per generator', ('device',)))
+_DELIVERED_RATE = RateTracker(DEVICE_DELIVERED_BYTES)
+DEVICE_DELIVERED_BYTES_PER_SECOND = REGISTRY.register(GaugeFunction(
+    'quanttp_device_delivered_bytes_per_second', 'Bytes handed out per second since the previous scrape', ('device',),
+    _DELIVERED_RATE.rates))
+MF_CALL_SECONDS = REGISTRY.register(Histogram(
+    'quanttp_mf_call_seconds', 'Latency of libmeterfeeder calls', ('function', 'device')))
+MF_ERRORS = REGISTRY.register(Counter(
+    'quanttp_mf_errors_total', 'libmeterfeeder calls that raised or reported an error', ('function', 'device')))
+MF_RESETS = REGISTRY.register(Counter(
+    'quanttp_mf_resets_total', 'Calls to MF_Reset'))
+DEVICE_QUARANTINES = REGISTRY.register(Counter(
+    'quanttp_device_quarantines_total', 'Generators quarantined after an error, timeout or stall', ('device',)))
+DEVICE_RECOVERY_SECONDS = REGISTRY.register(Histogram(
+    'quanttp_device_recovery_seconds', 'Duration of device recovery attempts', ('device', 'result')))
+SPOOL_HARVESTED_BYTES = REGISTRY.register(Counter(
+    'quanttp_spool_harvested_bytes_total', 'Bytes written to the entropy spool', ('device',)))
+SPOOL_SERVED_BYTES = REGISTRY.register(Counter(
+    'quanttp_spool_served_bytes_total', 'Bytes served from the entropy spool', ('device',)))
+COALESCED_REQUESTS = REGISTRY.register(Histogram(
+    'quanttp_coalesced_requests', 'Requests served by each coalesced device read', ('device',), COUNT_BUCKETS))
+SCHED_REJECTED = REGISTRY.register(Counter(
+    'quanttp_sched_rejected_total', 'Requests refused because the client was over its rate limit', ('class',)))
+HEALTH_FAILURES = REGISTRY.register(Counter(
+    'quanttp_health_failures_total', 'Generators that failed a continuous health test', ('test', 'device')))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'quanttp_http_request_seconds', 'HTTP request latency until the response body is sent', ('route', 'status')))
+HTTP_REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    'quanttp_http_requests_in_flight', 'HTTP requests being processed', ('route',)))
+WS_CONNECTIONS = REGISTRY.register(Gauge(
+    'quanttp_ws_connections', 'Open WebSocket connections'))
+LOCAL_CONNECTIONS = REGISTRY.register(Gauge(
+    'quanttp_local_connections', 'Open Unix domain socket connections'))
+WS_COMMAND_SECONDS = REGISTRY.register(Histogram(
+    'quanttp_ws_command_seconds', 'WebSocket command latency', ('command',)))
@@ -0,0 +1,302 @@
+##
+ # Fair-share scheduler
+ #
+ # Requests are queued per generator and per client and served by deficit
+ # round-robin: every round each waiting client may read QUANTUM bytes times
+ # the weight of its priority class. Large requests are read in pieces of at
+ # most QUANTUM bytes, so a bulk consumer cannot hold the device. As in
+ # FQ-CoDel, a client that was idle goes ahead of the backlogged ones for its
+ # first quantum, which keeps small interactive requests fast while bulk
+ # consumers saturate the device. A client whose queue runs empty keeps its
+ # place at the end of the round, so that one reading back-to-back does not
+ # count as idle. ANY and XOR requests are routed to the
+ # generators first, and each generator's part is queued there, so a large
+ # ANY request is still split across the generators.
+ #
+ # Clients may also have a rate limit in bytes/sec. The limit is a token
+ # bucket that may be overdrawn by one request, so requests of any size are
+ # admitted, and a client in debt is refused until the debt is paid off.
+ # Requests that fail are not charged.
+ #
+ # Only the API keys of QUANTTP_SCHED_CLIENTS identify a client, other
+ # clients are known by their address. A key of the caller's choosing could
+ # be changed on every request for a fresh bucket and a new flow.
+ ##
+
+import collections
+import math
+import time
+
+import gevent
+from gevent.event import AsyncResult
+
+from quanttp import config, metrics
+
+DEFAULT_CLASS = 'normal'
+
+# Full token buckets are dropped when there are this many, or twice as many
+# as after the last sweep
+_SWEEP_AT = 1024
+
+
+class QuotaExceeded(Exception):
+
+    def __init__(self, retryAfter):
+        super().__init__('rate limit exceeded, retry after %d seconds' % retryAfter)
+        self.retryAfter = retryAfter
+
+
+def parse_classes(text):
+    # "high:8,normal:4,low:1" -> {'high': 8, 'normal': 4, 'low': 1}
+    classes = {}
+    for entry in text.split(','):
+        if entry.strip():
+            name, weight = entry.strip().split(':')
+            classes[name] = int(weight)
+    if DEFAULT_CLASS not in classes:
+        raise ValueError('scheduler classes must include ' + DEFAULT_CLASS)
+    return classes
+
+
+def parse_clients(text, classes):
+    # "alice:high:1048576,bob:low" -> {'alice': ('high', 1048576), 'bob': ('low', None)}
+    clients = {}
+    for entry in text.split(','):
+        if entry.strip():
+            fields = entry.strip().split(':')
+            if fields[1] not in classes:
+                raise ValueError('unknown scheduler class ' + fields[1])
+            clients[fields[0]] = (fields[1], int(fields[2]) if len(fields) > 2 else None)
+    return clients
+
+
+class _Bucket:
+
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._capacity = rate * burst
+        self._tokens = self._capacity
+        self._last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+    @property
+    def full(self):
+        # A full bucket is no different from a new one
+        self._refill()
+        return self._tokens >= self._capacity
+
+    def retryAfter(self):
+        # 0 when the client may start a request, else seconds until it may
+        self._refill()
+        return 0 if self._tokens >= 0 else -self._tokens / self._rate
+
+    def charge(self, length):
+        self._tokens -= length
+
+    def refund(self, length):
+        self._tokens += length
+
+
+class _Request:
+
+    def __init__(self, length):
+        self.remaining = length
+        self.parts = []
+        self.outstanding = 0
+        self.failed = False
+        self.result = AsyncResult()
+
+
+class _Flow:
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.deficit = 0
+        self.requests = collections.deque()
+
+
+class _DeviceQueue:
+
+    def __init__(self):
+        # Flows with waiting requests in round-robin order, flows that just
+        # became active are served first
+        self.new = collections.OrderedDict()
+        self.old = collections.OrderedDict()
+        self.inFlight = 0
+
+
+class FairScheduler:
+
+    def __init__(self, source,
+                 quantum=config.SCHED_QUANTUM,
+                 maxInFlight=config.SCHED_MAX_IN_FLIGHT,
+                 classes=None,
+                 clients=None,
+                 defaultRate=config.SCHED_DEFAULT_RATE,
+                 burst=config.SCHED_BURST):
+        # source is the MultiDeviceRouter, the pieces are read from the
+        # generators behind it
+        self._source = source
+        self._deviceSource = source.source
+        self._quantum = quantum
+        self._maxInFlight = maxInFlight
+        self._classes = parse_classes(config.SCHED_CLASSES) if classes is None else classes
+        self._clients = parse_clients(config.SCHED_CLIENTS, self._classes) if clients is None else clients
+        self._defaultRate = defaultRate
+        self._burst = burst
+        self._buckets = {}
+        self._sweepAt = _SWEEP_AT
+        self._devices = {}
+
+    def client(self, clientKey, wait=False):
+        return ClientSource(self, clientKey, wait)
+
+    def clear(self, deviceId):
+        self._source.clear(deviceId)
+
+    def reset(self):
+        self._source.reset()
+
+    def knownClient(self, apiKey):
+        return apiKey in self._clients
+
+    def priorityClass(self, clientKey):
+        return self._clients.get(clientKey, (DEFAULT_CLASS, None))[0]
+
+    def queued(self):
+        queued = {}
+        for deviceId, device in list(self._devices.items()):
+            flows = list(device.new.values()) + list(device.old.values())
+            queued[deviceId] = sum(request.remaining for flow in flows for request in flow.requests)
+        return queued
+
+    def _bucket(self, clientKey):
+        bucket = self._buckets.get(clientKey)
+        if bucket is None:
+            rate = self._clients.get(clientKey, (DEFAULT_CLASS, None))[1]
+            rate = self._defaultRate if rate is None else rate
+            if rate <= 0:
+                return None
+            if len(self._buckets) >= self._sweepAt:
+                self._buckets = {key: b for key, b in self._buckets.items() if not b.full}
+                self._sweepAt = max(_SWEEP_AT, 2 * len(self._buckets))
+            bucket = self._buckets[clientKey] = _Bucket(rate, self._burst)
+        return bucket
+
+    def admit(self, clientKey, wait):
+        bucket = self._bucket(clientKey)
+        if bucket is None:
+            return
+        retryAfter = bucket.retryAfter()
+        while retryAfter > 0:
+            if not wait:
+                metrics.SCHED_REJECTED.inc(self.priorityClass(clientKey))
+                raise QuotaExceeded(math.ceil(retryAfter))
+            gevent.sleep(retryAfter)
+            retryAfter = bucket.retryAfter()
+
+    def randbytes(self, clientKey, deviceId, length):
+        # Charged up front, so that concurrent requests see the debt
+        bucket = self._bucket(clientKey)
+        if bucket is not None:
+            bucket.charge(length)
+        try:
+            # The router picks the generators and accounts for the request,
+            # and passes each generator's part back to be queued
+            return self._source.randbytes(deviceId, length, lambda realDeviceId, n: self._queue(clientKey, realDeviceId, n))
+        except Exception:
+            if bucket is not None:
+                bucket.refund(length)
+            raise
+
+    def _queue(self, clientKey, deviceId, length):
+        device = self._devices.get(deviceId)
+        if device is None:
+            device = self._devices[deviceId] = _DeviceQueue()
+        flow = device.new.get(clientKey) or device.old.get(clientKey)
+        if flow is None:
+            flow = device.new[clientKey] = _Flow(self._classes[self.priorityClass(clientKey)])
+            flow.deficit = self._quantum * flow.weight
+        request = _Request(length)
+        flow.requests.append(request)
+        self._dispatch(deviceId, device)
+        return request.result.get()
+
+    def _dispatch(self, deviceId, device):
+        # Bounding the bytes in flight keeps the device's own queue short.
+        # Flows that just became active may always start their first quantum,
+        # so many small requests can be in flight at once and get coalesced.
+        while device.new or (device.old and device.inFlight < self._maxInFlight):
+            flows = device.new if device.new else device.old
+            clientKey, flow = next(iter(flows.items()))
+            if not flow.requests:
+                # Ran empty a round ago and still is, idle flows do not bank credit
+                del flows[clientKey]
+                continue
+            request = flow.requests[0]
+            piece = min(self._quantum, request.remaining)
+            if flow.deficit < piece:
+                # Used up its share of this round
+                flow.deficit += self._quantum * flow.weight
+                del flows[clientKey]
+                device.old[clientKey] = flow
+                continue
+            flow.deficit -= piece
+            request.remaining -= piece
+            if request.remaining == 0:
+                flow.requests.popleft()
+                if not flow.requests:
+                    # Kept for one round, a client coming straight back with
+                    # its next request is not a new flow
+                    del flows[clientKey]
+                    device.old[clientKey] = flow
+            device.inFlight += piece
+            request.outstanding += 1
+            request.parts.append(None)
+            gevent.spawn(self._read, deviceId, device, request, len(request.parts) - 1, piece)
+
+    def _read(self, deviceId, device, request, index, length):
+        try:
+            if not request.failed:
+                request.parts[index] = self._deviceSource.randbytes(deviceId, length)
+        except Exception as e:
+            request.failed = True
+            request.result.set_exception(e)
+        finally:
+            device.inFlight -= length
+            request.outstanding -= 1
+            if request.remaining == 0 and request.outstanding == 0 and not request.failed:
+                # A single piece is passed on as is, it may be a zero-copy view
+                request.result.set(request.parts[0] if len(request.parts) == 1 else b''.join(request.parts))
+            self._dispatch(deviceId, device)
+
+
+class ClientSource:
+    # The entropy source seen by one client. REST requests are admitted once
+    # and refused while over quota, subscriptions (wait=True) are slowed down
+    # to the client's rate instead.
+
+    def __init__(self, scheduler, clientKey, wait=False):
+        self._scheduler = scheduler
+        self._clientKey = clientKey
+        self._wait = wait
+        self._admitted = False
+
+    def admit(self):
+        if not self._admitted or self._wait:
+            self._scheduler.admit(self._clientKey, self._wait)
+            self._admitted = True
+
+    def randbytes(self, deviceId, length):
+        self.admit()
+        return self._scheduler.randbytes(self._clientKey, deviceId, length)
+
+    def clear(self, deviceId):
+        self._scheduler.clear(deviceId)
+
+    def reset(self):
+        self._scheduler.reset()
@@ -0,0 +1,320 @@
+##
+ # Shared-memory entropy rings for clients on the same host
+ #
+ # The server publishes each attached generator's stream into a ring file
+ # under QUANTTP_LOCAL_SHM_DIR, normally on /dev/shm, and local clients map
+ # the same file. A client claims a disjoint region of unclaimed bytes under
+ # an flock of the ring file and reads it in place, with no HTTP, no encoding
+ # and no socket copy. As with the REST API, every byte goes to exactly one
+ # client.
+ #
+ # Layout: a header page with the magic, capacity, write offset (bytes
+ # published), read offset (bytes claimed), a closed flag and a table of
+ # leases, followed by the ring. A lease holds the pid and start offset of a
+ # region that is claimed but still being read. The server does not overwrite
+ # a region until its lease is released, or its process has died.
+ #
+ #   from quanttp.shmring import ShmClient
+ #
+ #   client = ShmClient('QWR4E001')
+ #   data = client.randbytes(32)            # a copy
+ #   with client.claim(1024 * 1024) as view:  # zero-copy, valid inside the block
+ #       values = numpy.frombuffer(view, dtype='<u4')
+ ##
+
+import contextlib
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+import gevent
+
+from quanttp import config
+
+try:
+    import fcntl
+    import grp
+except ImportError:
+    # Windows, the local transport needs flock
+    fcntl = None
+
+DEFAULT_DIRECTORY = '/dev/shm/quanttp'
+
+_MAGIC = b'QTTPSHM1'
+# magic, capacity, write offset, read offset, closed
+_HEADER = struct.Struct('<8sQQQQ')
+# pid (0 for a free slot), start offset
+_LEASE = struct.Struct('<QQ')
+_LEASES_AT = 64
+LEASES = 64
+_PAGE = mmap.PAGESIZE
+
+
+def ring_path(directory, deviceId):
+    return os.path.join(directory, re.sub(r'[^A-Za-z0-9_.-]', '_', deviceId) + '.ring')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ShmRing:
+    # capacity creates a new ring (the server), without it an existing ring
+    # is opened (a client). A new ring is readable by its owner only, or also
+    # by the members of group.
+
+    def __init__(self, path, capacity=None, group=None):
+        if fcntl is None:
+            raise OSError('shared-memory rings need fcntl.flock')
+        self.path = path
+        if capacity is not None:
+            capacity = -(-capacity // _PAGE) * _PAGE
+            # Set up under another name and renamed into place, so clients
+            # never see a half-initialized ring. Clients still mapping the
+            # previous ring find it closed.
+            self._file = os.open(path + '.new', os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            # Anyone who can map the ring can read bytes still due to other
+            # clients, so no access for others whatever the umask
+            if group:
+                os.fchown(self._file, -1, int(group) if group.isdigit() else grp.getgrnam(group).gr_gid)
+            os.fchmod(self._file, 0o660 if group else 0o600)
+            os.ftruncate(self._file, _PAGE + capacity)
+            self._map = mmap.mmap(self._file, _PAGE + capacity)
+            _HEADER.pack_into(self._map, 0, _MAGIC, capacity, 0, 0, 0)
+            os.replace(path + '.new', path)
+        else:
+            self._file = os.open(path, os.O_RDWR)
+            self._map = mmap.mmap(self._file, 0)
+            if len(self._map) < _PAGE or self._header()[0] != _MAGIC or self._header()[1] != len(self._map) - _PAGE:
+                self.close()
+                raise ValueError(path + ' is not an entropy ring')
+            capacity = self._header()[1]
+        self.capacity = capacity
+        # flock does not exclude threads sharing the file descriptor
+        self._threadLock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._threadLock:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def _header(self):
+        return _HEADER.unpack_from(self._map, 0)
+
+    def _setOffsets(self, writeOffset, readOffset):
+        struct.pack_into('<QQ', self._map, 16, writeOffset, readOffset)
+
+    def _lease(self, slot):
+        return _LEASE.unpack_from(self._map, _LEASES_AT + slot * _LEASE.size)
+
+    def _setLease(self, slot, pid, start):
+        _LEASE.pack_into(self._map, _LEASES_AT + slot * _LEASE.size, pid, start)
+
+    def available(self):
+        magic, capacity, writeOffset, readOffset, closed = self._header()
+        return writeOffset - readOffset
+
+    @property
+    def closed(self):
+        return self._header()[4] != 0
+
+    # Server ----------------------------------------------
+
+    def free(self, needed):
+        # Bytes that may be published without touching unclaimed or leased bytes
+        with self._locked():
+            magic, capacity, writeOffset, readOffset, closed = self._header()
+            leases = [(slot,) + self._lease(slot) for slot in range(LEASES)]
+            leases = [lease for lease in leases if lease[1] != 0]
+            free = min([start for slot, pid, start in leases], default=readOffset) + capacity - writeOffset
+            if free < needed:
+                # Leases of readers that died without releasing them
+                for slot, pid, start in leases:
+                    if not _alive(pid):
+                        self._setLease(slot, 0, 0)
+                leases = [lease for lease in leases if self._lease(lease[0])[0] != 0]
+                free = min([start for slot, pid, start in leases], default=readOffset) + capacity - writeOffset
+            return free
+
+    def publish(self, data):
+        # Only the server writes, and free() said the region is not in use
+        writeOffset = self._header()[2]
+        position = writeOffset % self.capacity
+        first = min(len(data), self.capacity - position)
+        self._map[_PAGE + position:_PAGE + position + first] = data[:first]
+        self._map[_PAGE:_PAGE + len(data) - first] = data[first:]
+        with self._locked():
+            readOffset = self._header()[3]
+            self._setOffsets(writeOffset + len(data), readOffset)
+
+    def shutdown(self):
+        with self._locked():
+            struct.pack_into('<Q', self._map, 32, 1)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    # Client ----------------------------------------------
+
+    def claim(self, length):
+        # Returns (slot, view) for a zero-copy claim, (None, bytes) for a copy
+        # or None while fewer than length bytes are published
+        with self._locked():
+            magic, capacity, writeOffset, readOffset, closed = self._header()
+            if writeOffset - readOffset < length:
+                return None
+            self._setOffsets(writeOffset, readOffset + length)
+            position = readOffset % capacity
+            if position + length <= capacity:
+                for slot in range(LEASES):
+                    if self._lease(slot)[0] == 0:
+                        self._setLease(slot, os.getpid(), readOffset)
+                        return slot, memoryview(self._map)[_PAGE + position:_PAGE + position + length]
+            # Wraps around, or every lease is taken: copy while the server
+            # cannot reuse the region
+            first = min(length, capacity - position)
+            data = self._map[_PAGE + position:_PAGE + position + first] + self._map[_PAGE:_PAGE + length - first]
+            return None, data
+
+    def release(self, slot):
+        with self._locked():
+            self._setLease(slot, 0, 0)
+
+    def close(self):
+        self._map.close()
+        os.close(self._file)
+
+
+class ShmPublisher:
+    # Keeps a ring per attached generator filled from source, as one client
+    # of the fair-share scheduler. Runs as greenlets on the gevent hub.
+
+    def __init__(self, source, deviceIds,
+                 directory=config.LOCAL_SHM_DIR,
+                 capacity=config.LOCAL_SHM_SIZE,
+                 readSize=config.LOCAL_SHM_READ_SIZE,
+                 pollInterval=config.LOCAL_SHM_POLL_INTERVAL,
+                 group=config.LOCAL_SHM_GROUP):
+        os.makedirs(directory, exist_ok=True)
+        self._source = source
+        self._deviceIds = deviceIds
+        self._directory = directory
+        self._capacity = capacity
+        self._readSize = min(readSize, capacity // 2)
+        self._pollInterval = pollInterval
+        self._group = group
+        self._rings = {}
+        self._greenlets = {}
+
+    def start(self):
+        gevent.spawn(self._run)
+
+    def levels(self):
+        return {deviceId: ring.available() for deviceId, ring in list(self._rings.items())}
+
+    def _run(self):
+        while True:
+            deviceIds = self._deviceIds()
+            for deviceId in deviceIds:
+                if deviceId not in self._rings:
+                    try:
+                        ring = ShmRing(ring_path(self._directory, deviceId), self._capacity, self._group)
+                    except (OSError, ValueError) as e:
+                        print("shared-memory ring", deviceId, "unavailable:", e)
+                        continue
+                    self._rings[deviceId] = ring
+                    self._greenlets[deviceId] = gevent.spawn(self._publish, deviceId, ring)
+            for deviceId in [d for d in self._rings if d not in deviceIds]:
+                self._greenlets.pop(deviceId).kill(block=False)
+                self._rings.pop(deviceId).shutdown()
+            gevent.sleep(1)
+
+    def _publish(self, deviceId, ring):
+        while True:
+            if ring.free(self._readSize) < self._readSize:
+                gevent.sleep(self._pollInterval)
+                continue
+            try:
+                ring.publish(self._source.randbytes(deviceId, self._readSize))
+            except Exception as e:
+                print("shared-memory ring", deviceId, "read failed:", e)
+                gevent.sleep(1)
+
+    def shutdown(self):
+        for greenlet in self._greenlets.values():
+            greenlet.kill(block=False)
+        for ring in self._rings.values():
+            ring.shutdown()
+
+
+class ShmClient:
+
+    def __init__(self, deviceId, directory=None, timeout=10.0):
+        self._ring = ShmRing(ring_path(directory or config.LOCAL_SHM_DIR or DEFAULT_DIRECTORY, deviceId))
+        self._timeout = timeout
+
+    def available(self):
+        return self._ring.available()
+
+    def _claim(self, length):
+        if not 0 < length <= self._ring.capacity // 2:
+            raise ValueError('length must be between 1 and %d' % (self._ring.capacity // 2))
+        deadline = time.monotonic() + self._timeout
+        delay = 0.00005
+        while True:
+            claimed = self._ring.claim(length)
+            if claimed is not None:
+                return claimed
+            if self._ring.closed:
+                raise IOError('the server closed ' + self._ring.path + ', reconnect')
+            if time.monotonic() >= deadline:
+                raise TimeoutError('fewer than %d bytes were published within %.1f seconds' % (length, self._timeout))
+            # The server refills within a read, back off up to 5 ms
+            time.sleep(delay)
+            delay = min(delay * 2, 0.005)
+
+    @contextlib.contextmanager
+    def claim(self, length):
+        # A memoryview of the shared memory itself. The server may reuse the
+        # region after the block, so neither the view nor arrays made from
+        # it may be used there.
+        slot, view = self._claim(length)
+        if slot is None:
+            view = memoryview(view)
+        try:
+            yield view
+        finally:
+            if slot is not None:
+                try:
+                    view.release()
+                except BufferError:
+                    # Still exported to an array, it cannot be invalidated
+                    pass
+                self._ring.release(slot)
+
+    def randbytes(self, length):
+        slot, view = self._claim(length)
+        if slot is None:
+            return view
+        try:
+            return bytes(view)
+        finally:
+            view.release()
+            self._ring.release(slot)
+
+    def close(self):
+        self._ring.close()
@@ -0,0 +1,96 @@
+##
+ # Incremental encoders for large responses
+ #
+ # Entropy is read from the device in fixed-size chunks and every chunk is
+ # encoded as soon as it arrives, so memory stays bounded by the chunk size and
+ # the first bytes go out before the whole request has been read.
+ ##
+
+import base64
+import collections
+import json
+
+import gevent
+
+from quanttp import config
+
+
+def chunks(source, deviceId, length, chunkSize, prefetch=None):
+    # Up to prefetch further chunks are read in parallel while one is being
+    # sent, which spreads ANY streams over several generators or pods
+    prefetch = config.STREAM_PREFETCH if prefetch is None else prefetch
+    remaining = length
+    if prefetch <= 0:
+        while remaining > 0:
+            n = min(chunkSize, remaining)
+            yield source.randbytes(deviceId, n)
+            remaining -= n
+        return
+    pending = collections.deque()
+    try:
+        while remaining > 0 or pending:
+            while remaining > 0 and len(pending) <= prefetch:
+                n = min(chunkSize, remaining)
+                pending.append(gevent.spawn(source.randbytes, deviceId, n))
+                remaining -= n
+            yield pending.popleft().get()
+    finally:
+        # The client went away, stop reading on its behalf
+        gevent.killall(pending, block=False)
+
+
+def hex_stream(byteChunks):
+    for chunk in byteChunks:
+        yield chunk.hex()
+
+
+def base64_stream(byteChunks):
+    # Only whole 3-byte groups are encoded so that no padding appears mid-stream
+    carry = b''
+    for chunk in byteChunks:
+        data = carry + chunk
+        cut = len(data) - len(data) % 3
+        if cut > 0:
+            yield base64.b64encode(data[:cut]).decode('utf-8')
+        carry = data[cut:]
+    if len(carry) > 0:
+        yield base64.b64encode(carry).decode('utf-8')
+
+
+def encode_hex(data):
+    return data.hex()
+
+
+def encode_base64(data):
+    return base64.b64encode(data).decode('utf-8')
+
+
+_STREAM_ENCODERS = {encode_hex: hex_stream, encode_base64: base64_stream}
+
+
+def json_string_array(source, deviceId, length, size, encode, chunkSize):
+    # Elements are separated the same way json.dumps separates list items
+    if size <= chunkSize:
+        perChunk = chunkSize // size
+        done = 0
+        while done < length:
+            n = min(perChunk, length - done)
+            data = source.randbytes(deviceId, n * size)
+            items = ', '.join('"' + encode(data[i * size:(i + 1) * size]) + '"' for i in range(n))
+            yield items if done == 0 else ', ' + items
+            done += n
+    else:
+        # A single element is larger than a chunk, stream inside the string
+        for x in range(length):
+            yield '"' if x == 0 else ', "'
+            for piece in _STREAM_ENCODERS[encode](chunks(source, deviceId, size, chunkSize)):
+                yield piece
+            yield '"'
+
+
+def json_envelope(meta, data):
+    # Produces the same text as json.dumps(dict(meta, data=[...], success=True))
+    yield json.dumps(meta)[:-1] + ', "data": ['
+    for piece in data:
+        yield piece
+    yield '], "success": true}'
@@ -0,0 +1,188 @@
+##
+ # WebSocket subscription engine
+ #
+ # Each connection runs at most one cooperative subscription task. The task
+ # produces a frame, sends it and only then produces the next one, so when the
+ # client stops reading and the socket's send buffer fills up, send() blocks
+ # the task and the device is no longer read on its behalf.
+ ##
+
+import socket
+import threading
+
+import gevent
+import gevent.lock
+from geventwebsocket.exceptions import WebSocketError
+
+from quanttp import config, wire
+
+WS_COMMANDS = ('DEVICES', 'RANDINT32', 'RANDUNIFORM', 'RANDNORMAL', 'RANDBYTES',
+               'SUBSCRIBEINT32', 'SUBSCRIBEUNIFORM', 'SUBSCRIBENORMAL', 'SUBSCRIBEBYTES', 'SUBSCRIBEHEX',
+               'SUBSCRIBEINT32BIN', 'SUBSCRIBEUNIFORMBIN', 'SUBSCRIBENORMALBIN',
+               'UNSUBSCRIBE', 'CLEAR')
+
+
+class TooLarge(ValueError):
+    # The message is the frame sent back to the client
+    pass
+
+
+def batch_size(text):
+    batch = int(text)
+    if batch < 1:
+        raise ValueError()
+    if batch > config.WS_MAX_BATCH:
+        raise TooLarge('BATCH TOO LARGE ' + str(config.WS_MAX_BATCH))
+    return batch
+
+
+def chunk_size(text):
+    chunk = int(text)
+    if chunk < 1:
+        raise ValueError()
+    if chunk > config.WS_MAX_CHUNK:
+        raise TooLarge('CHUNK TOO LARGE ' + str(config.WS_MAX_CHUNK))
+    return chunk
+
+
+class SubscriptionLimiter:
+
+    def __init__(self, maxPerDevice):
+        self._maxPerDevice = maxPerDevice
+        self._counts = {}
+        # Shared by the hub and, with the asyncio engine, the event loop thread
+        self._lock = threading.Lock()
+
+    def acquire(self, deviceId):
+        with self._lock:
+            count = self._counts.get(deviceId, 0)
+            if self._maxPerDevice > 0 and count >= self._maxPerDevice:
+                return False
+            self._counts[deviceId] = count + 1
+            return True
+
+    def release(self, deviceId):
+        with self._lock:
+            count = self._counts.get(deviceId, 0) - 1
+            if count > 0:
+                self._counts[deviceId] = count
+            else:
+                self._counts.pop(deviceId, None)
+
+    def counts(self):
+        return dict(self._counts)
+
+    def active(self, deviceId=None):
+        if deviceId is None:
+            return sum(self._counts.values())
+        return self._counts.get(deviceId, 0)
+
+
+class Connection:
+
+    def __init__(self, websocket, limiter, sendBuffer=0, clientKey=None):
+        self._websocket = websocket
+        self.clientKey = clientKey
+        self._limiter = limiter
+        self._sendLock = gevent.lock.Semaphore()
+        self._task = None
+        if sendBuffer > 0:
+            # A small kernel send buffer makes backpressure kick in early
+            try:
+                websocket.handler.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sendBuffer)
+            except (AttributeError, OSError):
+                pass
+
+    @property
+    def closed(self):
+        return self._websocket.closed
+
+    def receive(self):
+        return self._websocket.receive()
+
+    def send(self, message):
+        with self._sendLock:
+            self._websocket.send(message)
+
+    def close(self, code=1000, message=''):
+        self.unsubscribe()
+        self._websocket.close(code=code, message=message)
+
+    def subscribe(self, deviceId, frames):
+        # Like before, a second SUBSCRIBE while one is running is ignored
+        if self._task is not None:
+            return True
+        if not self._limiter.acquire(deviceId):
+            return False
+        self._task = gevent.spawn(self._run, deviceId, frames)
+        return True
+
+    def unsubscribe(self):
+        self._task = None
+
+    def _run(self, deviceId, frames):
+        try:
+            for frame in frames:
+                with self._sendLock:
+                    # Checked under the send lock so nothing follows UNSUBSCRIBED
+                    if self._task is not gevent.getcurrent() or self._websocket.closed:
+                        break
+                    self._websocket.send(frame)
+        except (WebSocketError, OSError):
+            pass
+        except Exception as e:
+            self.close(code=1011, message=str(e))
+        finally:
+            frames.close()
+            self._limiter.release(deviceId)
+            if self._task is gevent.getcurrent():
+                self._task = None
+
+
+# A framer is the number of bytes to read from the device at a time, and a
+# function making the frames of one read
+
+def value_framer(convert, size, batch, readValues):
+    # A whole number of frames per read, so that no value is left over
+    readValues = -(-max(batch, readValues) // batch) * batch
+
+    def frames(data):
+        values = convert(data).tolist()
+        for i in range(0, readValues, batch):
+            yield ','.join([str(value) for value in values[i:i + batch]])
+    return size * readValues, frames
+
+
+def packed_framer(convert, size, batch, readValues, dtype):
+    # Binary frames of batch little-endian values, decodable with numpy.frombuffer
+    readValues = -(-max(batch, readValues) // batch) * batch
+
+    def frames(data):
+        data = wire.pack(convert(data), dtype)
+        itemSize = len(data) // readValues
+        for i in range(0, readValues, batch):
+            yield data[i * itemSize:(i + batch) * itemSize]
+    return size * readValues, frames
+
+
+def byte_framer(chunk, encode=None):
+    def frames(data):
+        yield data if encode is None else encode(data)
+    return chunk, frames
+
+
+def frames(source, deviceId, readSize, framer):
+    while True:
+        yield from framer(source.randbytes(deviceId, readSize))
+
+
+def value_frames(source, deviceId, convert, size, batch, readValues):
+    return frames(source, deviceId, *value_framer(convert, size, batch, readValues))
+
+
+def packed_frames(source, deviceId, convert, size, batch, readValues, dtype):
+    return frames(source, deviceId, *packed_framer(convert, size, batch, readValues, dtype))
+
+
+def byte_frames(source, deviceId, chunk, encode=None):
+    return frames(source, deviceId, *byte_framer(chunk, encode))
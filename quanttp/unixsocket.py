@@ -0,0 +1,150 @@
+##
+ # WebSocket command protocol over a Unix domain socket
+ #
+ # Local clients send the same commands as over /ws and get the same replies,
+ # without HTTP, the WebSocket handshake or frame masking:
+ #
+ # client to server : one command per line, e.g. "RANDBYTES QWR4E001 1024\n"
+ # server to client : frames of a 1 byte opcode (1 text, 2 binary, 8 close),
+ #                    the 4 byte little-endian payload length and the payload.
+ #                    A close frame holds a 2 byte code and the reason.
+ #
+ #   from quanttp.unixsocket import UnixSocketClient
+ #
+ #   client = UnixSocketClient('/run/quanttp.sock')
+ #   client.send('RANDBYTES QWR4E001 1024')
+ #   data = client.receive()
+ ##
+
+import os
+import socket
+import struct
+
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+
+_FRAME = struct.Struct('<BI')
+_CODE = struct.Struct('<H')
+# Longest command line accepted, commands are a few words
+MAX_COMMAND = 4096
+# Smaller payloads are sent in one write together with the frame header
+_COALESCE = 16 * 1024
+
+
+class UnixSocketClosed(Exception):
+    pass
+
+
+def listen(path):
+    # A stale socket file from a previous run would make bind() fail
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(128)
+    # gevent's StreamServer waits for connections on the hub, never in accept()
+    listener.setblocking(False)
+    return listener
+
+
+def peer_key(sock):
+    # The connecting user, as the fair-share scheduler's client key
+    try:
+        pid, uid, gid = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+        return 'uid:' + str(uid)
+    except (AttributeError, OSError):
+        return 'unix'
+
+
+def _frame(opcode, payload):
+    header = _FRAME.pack(opcode, len(payload))
+    if len(payload) < _COALESCE:
+        return [header + payload]
+    return [header, payload]
+
+
+class UnixSocketConnection:
+    # Server side. Offers the parts of a geventwebsocket WebSocket that
+    # subscriptions.Connection and the command handler use.
+
+    def __init__(self, sock):
+        self._socket = sock
+        self._reader = sock.makefile('rb')
+        self.closed = False
+
+    def receive(self):
+        try:
+            line = self._reader.readline(MAX_COMMAND)
+        except OSError:
+            line = b''
+        if not line:
+            self.closed = True
+            return None
+        return line.decode('utf-8', 'replace')
+
+    def send(self, message):
+        if self.closed:
+            raise OSError('connection closed')
+        if isinstance(message, str):
+            frames = _frame(OPCODE_TEXT, message.encode('utf-8'))
+        else:
+            frames = _frame(OPCODE_BINARY, message)
+        try:
+            for frame in frames:
+                self._socket.sendall(frame)
+        except OSError:
+            self.closed = True
+            raise
+
+    def close(self, code=1000, message=''):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            for frame in _frame(OPCODE_CLOSE, _CODE.pack(code) + message.encode('utf-8')):
+                self._socket.sendall(frame)
+        except OSError:
+            pass
+        self._reader.close()
+        self._socket.close()
+
+
+class UnixSocketClient:
+
+    def __init__(self, path, timeout=None):
+        self.closed = False
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(path)
+        self._reader = self._socket.makefile('rb')
+
+    def _read(self, n):
+        data = self._reader.read(n)
+        if len(data) < n:
+            self.closed = True
+            raise UnixSocketClosed('connection closed')
+        return data
+
+    def send(self, command):
+        if '\n' in command:
+            raise ValueError('a command must be a single line')
+        self._socket.sendall(command.encode('utf-8') + b'\n')
+
+    def receive(self):
+        opcode, length = _FRAME.unpack(self._read(_FRAME.size))
+        payload = self._read(length)
+        if opcode == OPCODE_TEXT:
+            return payload.decode('utf-8')
+        if opcode == OPCODE_BINARY:
+            return payload
+        self.closed = True
+        code = _CODE.unpack(payload[:_CODE.size])[0] if len(payload) >= _CODE.size else 1005
+        raise UnixSocketClosed('%d %s' % (code, payload[_CODE.size:].decode('utf-8', 'replace')))
+
+    def close(self):
+        self.closed = True
+        self._reader.close()
+        self._socket.close()
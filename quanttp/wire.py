@@ -0,0 +1,71 @@
+##
+ # Wire formats for numeric arrays
+ #
+ # json    : the JSON API, values formatted as text
+ # binary  : the packed little-endian array only, metadata in X-Quanttp-* headers
+ # msgpack : MessagePack map with the JSON API metadata, data as a bin field
+ # cbor    : CBOR map with the JSON API metadata, data as a byte string
+ #
+ # Packed data decodes with numpy.frombuffer(data, dtype) where dtype is
+ # '<i4' for int32 and '<f8' (or '<f4' when dtype=float32 was requested) for
+ # uniform and normal.
+ ##
+
+import numpy
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+MIMETYPES = {
+    'json': 'application/json',
+    'binary': 'application/octet-stream',
+    'msgpack': 'application/msgpack',
+    'cbor': 'application/cbor',
+}
+# Checked in this order when negotiating with the Accept header
+_ACCEPTED = [('application/json', 'json'), ('application/octet-stream', 'binary'),
+             ('application/msgpack', 'msgpack'), ('application/x-msgpack', 'msgpack'), ('application/cbor', 'cbor')]
+
+_DTYPES = {
+    'int32': {None: '<i4', 'int32': '<i4'},
+    'uniform': {None: '<f8', 'float64': '<f8', 'float32': '<f4'},
+    'normal': {None: '<f8', 'float64': '<f8', 'float32': '<f4'},
+}
+
+
+def negotiate(format, acceptMimetypes):
+    # An explicit format= wins over the Accept header
+    if format is None:
+        best = acceptMimetypes.best_match([mimetype for mimetype, name in _ACCEPTED])
+        format = dict(_ACCEPTED).get(best, 'json')
+    if format not in MIMETYPES:
+        raise ValueError('format must be one of ' + ', '.join(MIMETYPES))
+    if format == 'msgpack' and msgpack is None:
+        raise ValueError('msgpack format requires the msgpack package')
+    if format == 'cbor' and cbor2 is None:
+        raise ValueError('cbor format requires the cbor2 package')
+    return format
+
+
+def dtype(name, requested):
+    dtypes = _DTYPES[name]
+    if requested not in dtypes:
+        raise ValueError('dtype must be one of ' + ', '.join(d for d in dtypes if d is not None) + ' for ' + name)
+    return dtypes[requested]
+
+
+def pack(array, dtype):
+    return numpy.ascontiguousarray(array, dtype=dtype).tobytes()
+
+
+def envelope(format, fields):
+    if format == 'msgpack':
+        return msgpack.packb(fields, use_bin_type=True)
+    return cbor2.dumps(fields)
@@ -0,0 +1,275 @@
+##
+ # asyncio worker processes
+ #
+ # With QUANTTP_ENGINE=asyncio and QUANTTP_WORKERS > 1 the server forks that
+ # many workers sharing the listening socket, and restarts any that exit.
+ # Worker 0 owns the generators, so that every generator is read by one
+ # process only. The other workers run in gateway mode against a private
+ # socket of worker 0 for the device list, health, clear and reset.
+ #
+ # Their reads are forwarded to worker 0 over a Unix domain socket, together
+ # with the client key, wait flag and whether the request is to be admitted.
+ # Worker 0 admits and schedules them as if its own client had made them, so
+ # rate limits and fair sharing hold across all workers.
+ #
+ # worker to worker 0 : "<admit> <wait> <length> <deviceId> <clientKey>\n",
+ #                      flags 0 or 1, deviceId and clientKey URL-quoted.
+ #                      Length 0 only admits.
+ # worker 0 to worker : a 1 byte status, the 4 byte little-endian payload
+ #                      length and the payload, the bytes or the error.
+ ##
+
+import os
+import shutil
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import gevent
+import gevent.socket
+from gevent.server import StreamServer
+
+from quanttp import config, unixsocket
+from quanttp.scheduler import QuotaExceeded, parse_classes, parse_clients
+from quanttp.data.device_recovery import DeviceUnavailable
+from quanttp.data.entropy_spool import SpoolEmpty
+
+_REPLY = struct.Struct('<BI')
+
+OK = 0
+RATE_LIMITED = 1
+UNAVAILABLE = 2
+SPOOL_EMPTY = 3
+INVALID = 4
+FAILED = 5
+
+# Idle connections to worker 0 kept open per worker
+_MAX_IDLE = 64
+
+
+class _Closed(IOError):
+    # The connection was closed before the reply, the request was not served
+    pass
+
+
+class Worker:
+
+    def __init__(self, index, sockets, ownerUrl, ownerSocket):
+        self.index = index
+        self.sockets = sockets
+        self.ownerUrl = ownerUrl
+        # Unix socket on which worker 0 takes the reads of the others
+        self.ownerSocket = ownerSocket
+
+    @property
+    def owner(self):
+        return self.index == 0
+
+
+def _listen(address):
+    # Accepted sockets inherit IPPROTO_TCP, without it asyncio leaves Nagle on
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(address)
+    listener.listen(2048)
+    return listener
+
+
+def fork_workers(port, workers):
+    # Returns this process's Worker in each worker. The parent stays behind
+    # to restart workers that exit, and never returns.
+    if not hasattr(os, 'fork'):
+        raise OSError('QUANTTP_WORKERS needs os.fork')
+    public = _listen(('0.0.0.0', port))
+    private = _listen(('127.0.0.1', 0))
+    ownerUrl = 'http://127.0.0.1:%d' % private.getsockname()[1]
+    # Only this user may connect, worker 0 trusts the client keys it is sent
+    directory = tempfile.mkdtemp(prefix='quanttp-workers-')
+    ownerSocket = os.path.join(directory, 'owner.sock')
+    parent = os.getpid()
+    children = {}
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Starting", workers, "asyncio workers, worker 0 owns the generators")
+    try:
+        while True:
+            for index in sorted(set(range(workers)) - set(children.values())):
+                pid = os.fork()
+                if pid == 0:
+                    # The siblings are none of this worker's business
+                    children.clear()
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    gevent.reinit()
+                    if index > 0:
+                        private.close()
+                    return Worker(index, [public, private] if index == 0 else [public], ownerUrl, ownerSocket)
+                children[pid] = index
+            pid, status = os.wait()
+            print("worker %s exited with status %d, restarting" % (children.pop(pid, None), status))
+            time.sleep(1)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        if os.getpid() == parent:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+# Worker 0 ----------------------------------------------
+
+def serve_workers(path, read):
+    # read(clientKey, deviceId, length, wait, admit) runs on the hub, one
+    # greenlet per connection
+    def connection(sock, address):
+        reader = sock.makefile('rb')
+        try:
+            while True:
+                line = reader.readline(unixsocket.MAX_COMMAND)
+                if not line:
+                    return
+                admit, wait, length, deviceId, clientKey = line.decode('utf-8').split()
+                try:
+                    status, payload = OK, read(urllib.parse.unquote(clientKey), urllib.parse.unquote(deviceId),
+                                               int(length), wait == '1', admit == '1')
+                except QuotaExceeded as e:
+                    status, payload = RATE_LIMITED, str(e.retryAfter).encode()
+                except DeviceUnavailable as e:
+                    status, payload = UNAVAILABLE, str(e).encode()
+                except SpoolEmpty as e:
+                    status, payload = SPOOL_EMPTY, str(e).encode()
+                except ValueError as e:
+                    status, payload = INVALID, str(e).encode()
+                except Exception as e:
+                    status, payload = FAILED, str(e).encode()
+                sock.sendall(_REPLY.pack(status, len(payload)))
+                sock.sendall(payload)
+        except OSError:
+            pass
+        finally:
+            reader.close()
+            sock.close()
+
+    StreamServer(unixsocket.listen(path), connection).start()
+
+
+# Workers 1..N ----------------------------------------------
+
+class OwnerScheduler:
+    # Stands in for the FairScheduler: every read is admitted and scheduled
+    # by worker 0. source only serves clear and reset.
+
+    def __init__(self, path, source):
+        self._path = path
+        self._source = source
+        self._clients = parse_clients(config.SCHED_CLIENTS, parse_classes(config.SCHED_CLASSES))
+        self._idle = []
+
+    def client(self, clientKey, wait=False):
+        return OwnerClientSource(self, clientKey, wait)
+
+    def knownClient(self, apiKey):
+        return apiKey in self._clients
+
+    def clear(self, deviceId):
+        self._source.clear(deviceId)
+
+    def reset(self):
+        self._source.reset()
+
+    def queued(self):
+        # Queued in worker 0
+        return {}
+
+    def _connect(self):
+        sock = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._path)
+        except OSError:
+            sock.close()
+            raise IOError('worker 0 is not running')
+        return sock, sock.makefile('rb')
+
+    def randbytes(self, clientKey, deviceId, length, wait, admit):
+        request = ('%d %d %d %s %s\n' % (admit, wait, length, urllib.parse.quote(deviceId, safe=''),
+                                          urllib.parse.quote(clientKey or '-', safe=''))).encode('utf-8')
+        if self._idle:
+            try:
+                status, payload = self._request(self._idle.pop(), request)
+            except _Closed:
+                # Worker 0 restarted, none of the idle connections is open
+                for sock, reader in self._idle:
+                    reader.close()
+                    sock.close()
+                self._idle.clear()
+                status, payload = self._request(self._connect(), request)
+        else:
+            status, payload = self._request(self._connect(), request)
+        if status == OK:
+            return payload
+        message = payload.decode('utf-8', 'replace')
+        if status == RATE_LIMITED:
+            raise QuotaExceeded(int(message))
+        if status == UNAVAILABLE:
+            raise DeviceUnavailable(message)
+        if status == SPOOL_EMPTY:
+            raise SpoolEmpty(message)
+        if status == INVALID:
+            raise ValueError(message)
+        raise IOError(message)
+
+    def _request(self, connection, request):
+        sock, reader = connection
+        try:
+            try:
+                sock.sendall(request)
+                header = reader.read(_REPLY.size)
+            except OSError:
+                header = b''
+            if len(header) < _REPLY.size:
+                raise _Closed('worker 0 closed the connection')
+            status, size = _REPLY.unpack(header)
+            payload = reader.read(size)
+            if len(payload) < size:
+                raise IOError('worker 0 closed the connection')
+        except BaseException:
+            reader.close()
+            sock.close()
+            raise
+        if len(self._idle) < _MAX_IDLE:
+            self._idle.append(connection)
+        else:
+            reader.close()
+            sock.close()
+        return status, payload
+
+
+class OwnerClientSource:
+    # ClientSource of a client of worker 0
+
+    def __init__(self, scheduler, clientKey, wait=False):
+        self._scheduler = scheduler
+        self._clientKey = clientKey
+        self._wait = wait
+        self._admitted = False
+
+    def admit(self):
+        if not self._admitted:
+            self._scheduler.randbytes(self._clientKey, 'ANY', 0, self._wait, True)
+            self._admitted = True
+
+    def randbytes(self, deviceId, length):
+        # Subscriptions are admitted, and slowed down, on every read
+        admit = not self._admitted or self._wait
+        self._admitted = True
+        return self._scheduler.randbytes(self._clientKey, deviceId, length, self._wait, admit)
+
+    def clear(self, deviceId):
+        self._scheduler.clear(deviceId)
+
+    def reset(self):
+        self._scheduler.reset()
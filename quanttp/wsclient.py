@@ -0,0 +1,131 @@
+##
+ # Minimal blocking WebSocket client (RFC 6455)
+ #
+ # Just enough to talk to the /ws command protocol of another Pod Entropy
+ # Server without pulling in a client library: text and binary messages,
+ # fragmented messages, ping/pong and close.
+ ##
+
+import base64
+import os
+import socket
+import struct
+from urllib.parse import urlparse
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+
+class WebSocketClosed(Exception):
+    pass
+
+
+class WebSocketClient:
+
+    def __init__(self, url, timeout=None):
+        parsed = urlparse(url)
+        if parsed.scheme != 'ws':
+            raise ValueError('only ws:// URLs are supported')
+        host = parsed.hostname
+        port = parsed.port or 80
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        self.closed = False
+        self._socket = socket.create_connection((host, port), timeout=timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buffer = b''
+        self._handshake(host, port, path)
+
+    def _handshake(self, host, port, path):
+        key = base64.b64encode(os.urandom(16)).decode('utf-8')
+        self._socket.sendall(('GET ' + path + ' HTTP/1.1\r\n'
+                              'Host: ' + host + ':' + str(port) + '\r\n'
+                              'Upgrade: websocket\r\n'
+                              'Connection: Upgrade\r\n'
+                              'Sec-WebSocket-Key: ' + key + '\r\n'
+                              'Sec-WebSocket-Version: 13\r\n\r\n').encode('utf-8'))
+        while b'\r\n\r\n' not in self._buffer:
+            self._fill()
+        header, self._buffer = self._buffer.split(b'\r\n\r\n', 1)
+        status = header.split(b'\r\n', 1)[0]
+        if b' 101 ' not in status + b' ':
+            raise ConnectionError('WebSocket handshake failed: ' + status.decode('utf-8', 'replace'))
+
+    def _fill(self):
+        data = self._socket.recv(65536)
+        if not data:
+            self.closed = True
+            raise WebSocketClosed()
+        self._buffer += data
+
+    def _read(self, n):
+        while len(self._buffer) < n:
+            self._fill()
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def _sendFrame(self, opcode, payload):
+        # Client frames are always masked
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([0x80 | length])
+        elif length < 65536:
+            header += bytes([0x80 | 126]) + struct.pack('!H', length)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack('!Q', length)
+        mask = os.urandom(4)
+        if length > 0:
+            masked = (int.from_bytes(payload, 'little') ^ int.from_bytes(mask * (length // 4 + 1), 'little') & ((1 << (8 * length)) - 1)).to_bytes(length, 'little')
+        else:
+            masked = b''
+        self._socket.sendall(header + mask + masked)
+
+    def send(self, message):
+        if isinstance(message, str):
+            self._sendFrame(OPCODE_TEXT, message.encode('utf-8'))
+        else:
+            self._sendFrame(OPCODE_BINARY, bytes(message))
+
+    def receive(self):
+        fragments = []
+        messageOpcode = None
+        while True:
+            first, second = self._read(2)
+            final = first & 0x80
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', self._read(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self._read(8))[0]
+            payload = self._read(length)
+            if opcode == OPCODE_PING:
+                self._sendFrame(OPCODE_PONG, payload)
+                continue
+            if opcode == OPCODE_PONG:
+                continue
+            if opcode == OPCODE_CLOSE:
+                self.close()
+                raise WebSocketClosed(payload[2:].decode('utf-8', 'replace'))
+            if opcode != OPCODE_CONTINUATION:
+                messageOpcode = opcode
+            fragments.append(payload)
+            if final:
+                message = b''.join(fragments)
+                return message.decode('utf-8') if messageOpcode == OPCODE_TEXT else message
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._sendFrame(OPCODE_CLOSE, struct.pack('!H', 1000))
+        except OSError:
+            pass
+        self._socket.close()
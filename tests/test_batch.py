@@ -0,0 +1,95 @@
+import numpy
+import pytest
+
+from quanttp import batch
+from quanttp.data import conversions
+
+
+def valid_device_id(deviceId):
+    return deviceId in ('SIM00001', 'SIM00002', 'ANY', 'XOR')
+
+
+def parse(specs, maxDraws=8, maxBytes=4096):
+    return batch.parse(specs, valid_device_id, maxDraws, maxBytes)
+
+
+def test_parse():
+    draws = parse([
+        {'format': 'int32', 'deviceId': 'ANY', 'length': 4},
+        {'format': 'normal', 'deviceId': 'SIM00001', 'length': 16, 'dtype': 'float32'},
+        {'format': 'hex', 'deviceId': 'ANY', 'length': 2, 'size': 32},
+    ])
+    assert [draw.byteCount for draw in draws] == [16, 256, 64]
+    assert [draw.dtype for draw in draws] == ['<i4', '<f4', batch.RAW_DTYPE]
+    assert draws[0].size is None and draws[2].size == 32
+    assert batch.deviceIds(draws) == ['ANY', 'SIM00001']
+
+
+@pytest.mark.parametrize('specs, message', [
+    ({'format': 'int32', 'deviceId': 'ANY', 'length': 1}, 'non-empty JSON list'),
+    ([], 'non-empty JSON list'),
+    ([{'format': 'int32', 'deviceId': 'ANY', 'length': 1}] * 9, 'at most 8 draws'),
+    (['int32'], 'draw 0: must be an object'),
+    ([{'format': 'float', 'deviceId': 'ANY', 'length': 1}], 'draw 0: format must be one of'),
+    ([{'deviceId': 'ANY', 'length': 1}], 'draw 0: format must be one of'),
+    ([{'format': 'int32', 'deviceId': 'QWR4E001', 'length': 1}], 'draw 0: deviceId'),
+    ([{'format': 'int32', 'deviceId': 7, 'length': 1}], 'draw 0: deviceId'),
+    ([{'format': 'int32', 'deviceId': 'ANY'}], 'draw 0: length'),
+    ([{'format': 'int32', 'deviceId': 'ANY', 'length': 0}], 'draw 0: length'),
+    ([{'format': 'int32', 'deviceId': 'ANY', 'length': '4'}], 'draw 0: length'),
+    ([{'format': 'int32', 'deviceId': 'ANY', 'length': True}], 'draw 0: length'),
+    ([{'format': 'int32', 'deviceId': 'ANY', 'length': 1.5}], 'draw 0: length'),
+    ([{'format': 'int32', 'deviceId': 'ANY', 'length': 1},
+      {'format': 'hex', 'deviceId': 'ANY', 'length': 1}], 'draw 1: size'),
+    ([{'format': 'int32', 'deviceId': 'ANY', 'length': 1, 'dtype': 'float32'}], 'draw 0: dtype'),
+    ([{'format': 'uniform', 'deviceId': 'ANY', 'length': 513}], 'at most 4096 bytes'),
+])
+def test_parse_rejects(specs, message):
+    with pytest.raises(ValueError, match=message):
+        parse(specs)
+
+
+def test_parse_limit_is_inclusive():
+    assert len(parse([{'format': 'uniform', 'deviceId': 'ANY', 'length': 512}])) == 1
+
+
+class Source:
+
+    def __init__(self):
+        self.reads = []
+
+    def randbytes(self, deviceId, length):
+        self.reads.append((deviceId, length))
+        return bytes(length)
+
+
+def test_read_once_per_device():
+    draws = parse([
+        {'format': 'int32', 'deviceId': 'SIM00001', 'length': 2},
+        {'format': 'hex', 'deviceId': 'SIM00002', 'length': 3, 'size': 2},
+        {'format': 'uniform', 'deviceId': 'SIM00001', 'length': 1},
+    ])
+    source = Source()
+    batch.read(source, draws)
+    assert sorted(source.reads) == [('SIM00001', 16), ('SIM00002', 6)]
+
+
+def test_draws_get_disjoint_slices_in_order():
+    specs = [
+        {'format': 'int32', 'deviceId': 'SIM00001', 'length': 2},
+        {'format': 'base64', 'deviceId': 'SIM00001', 'length': 2, 'size': 3},
+        {'format': 'normal', 'deviceId': 'SIM00001', 'length': 1},
+    ]
+    data = bytes(range(30))
+
+    class Fixed:
+        def randbytes(self, deviceId, length):
+            assert length == len(data)
+            return data
+
+    draws = parse(specs)
+    batch.read(Fixed(), draws)
+    assert numpy.array_equal(draws[0].values(), conversions.int32_array(data[0:8]))
+    assert draws[1].values() == ['CAkK', 'CwwN']
+    assert numpy.array_equal(draws[2].values(), conversions.normal_array(data[14:30]))
+    assert draws[2].packed() == conversions.normal_array(data[14:30]).astype('<f8').tobytes()
@@ -0,0 +1,44 @@
+import numpy
+import pytest
+
+from quanttp.data import conversions
+
+DATA = numpy.random.default_rng(1).bytes(4096)
+
+
+@pytest.mark.parametrize('array, scalar, size', [
+    (conversions.int32_array, conversions.int32, conversions.INT32_SIZE),
+    (conversions.uniform_array, conversions.uniform, conversions.UNIFORM_SIZE),
+    (conversions.normal_array, conversions.normal, conversions.NORMAL_SIZE),
+])
+def test_array_matches_scalar(array, scalar, size):
+    values = array(DATA)
+    assert len(values) == len(DATA) // size
+    assert values.tolist() == [scalar(DATA[i * size:(i + 1) * size]) for i in range(len(values))]
+
+
+def test_int32():
+    assert conversions.int32(b'\x01\x00\x00\x00') == 1
+    assert conversions.int32(b'\xff\xff\xff\xff') == -1
+    assert conversions.int32(b'\x00\x00\x00\x80') == -2 ** 31
+
+
+def test_uniform_uses_the_top_53_bits():
+    assert conversions.uniform(bytes(8)) == 0.0
+    assert conversions.uniform(b'\xff' * 8) == 1 - 2.0 ** -53
+    # The low 11 bits are dropped
+    assert conversions.uniform(b'\xff\x07' + bytes(6)) == 0.0
+    assert conversions.uniform(b'\x00\x08' + bytes(6)) == 2.0 ** -53
+
+
+def test_normal_is_box_muller_cos_branch():
+    u1 = conversions.uniform(DATA[0:8])
+    u2 = conversions.uniform(DATA[8:16])
+    assert conversions.normal(DATA) == numpy.sqrt(-2 * numpy.log(1 - u1)) * numpy.cos(2 * numpy.pi * u2)
+    # u1 of 0 gives 0, not log(0)
+    assert conversions.normal(bytes(16)) == 0.0
+
+
+def test_partial_values_are_dropped():
+    assert len(conversions.normal_array(DATA[:40])) == 2
+    assert len(conversions.uniform_array(DATA[:15])) == 1
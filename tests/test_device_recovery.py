@@ -0,0 +1,71 @@
+import time
+
+import pytest
+
+from quanttp.data.device_recovery import OK, QUARANTINED, DeviceRecovery, DeviceUnavailable
+from quanttp.data.meterfeeder_wrapper import MeterFeederWrapper
+from quanttp.data.simulated_backend import SimulatedMeterFeeder
+
+
+def wrapper(backoff=0.05, maxBackoff=0.2, readTimeout=1.0, **faults):
+    # Two simulated generators without delays, recovery attempts are recorded
+    backend = SimulatedMeterFeeder(devices=2, rate=0, latency=0, jitter=0, seed=1, **faults)
+    mf = MeterFeederWrapper(backend)
+    mf.attempts = []
+
+    def recover(name):
+        mf.attempts.append(time.monotonic())
+        mf._recover(name)
+
+    mf.recovery = DeviceRecovery(recover, backoff=backoff, maxBackoff=maxBackoff, readTimeout=readTimeout, minRate=0)
+    return backend, mf
+
+
+def wait_for(condition, timeout=3):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_failing_generator_is_quarantined():
+    backend, mf = wrapper(backoff=10)
+    assert mf.deviceIds(False) == 'SIM00001,SIM00002'
+    backend.fail('SIM00001')
+    with pytest.raises(DeviceUnavailable):
+        mf.randbytes('SIM00001', 100)
+    assert mf.recovery.states() == {'SIM00001': QUARANTINED}
+    assert mf.deviceIds(False) == 'SIM00002'
+    # No more calls reach it, the other generator is still used
+    with pytest.raises(DeviceUnavailable, match='quarantined'):
+        mf.randbytes('SIM00001', 100)
+    assert len(mf.randbytes('SIM00002', 100)) == 100
+
+
+def test_stalled_read_is_quarantined():
+    backend, mf = wrapper(backoff=10, readTimeout=0.05, stallRate=1.0, stallTime=0.2)
+    mf.randbytes('SIM00001', 100)
+    assert mf.recovery.states() == {'SIM00001': QUARANTINED}
+    assert mf.recovery.report('SIM00001')['reason'] == 'read stalled'
+
+
+def test_recovery_backs_off_and_brings_the_generator_back():
+    backend, mf = wrapper()
+    backend.fail('SIM00001')
+    quarantined = time.monotonic()
+    with pytest.raises(DeviceUnavailable):
+        mf.randbytes('SIM00001', 100)
+    wait_for(lambda: len(mf.attempts) == 4)
+    report = mf.recovery.report('SIM00001')
+    assert report['state'] == QUARANTINED and report['lastError'].startswith('probe read failed')
+    # Waits of 0.05, 0.1 and 0.2 seconds, then capped at 0.2
+    waits = [b - a for a, b in zip([quarantined] + mf.attempts, mf.attempts)]
+    for wait, backoff in zip(waits, [0.05, 0.1, 0.2, 0.2]):
+        assert backoff <= wait < backoff + 0.1
+    assert 'SIM00001' not in mf.deviceIds(True)
+    # Back once a probe read succeeds
+    backend.fail('SIM00001', False)
+    wait_for(lambda: mf.recovery.states()['SIM00001'] == OK)
+    assert mf.recovery.report('SIM00001')['recoveries'] == 1
+    assert mf.deviceIds(False) == 'SIM00001,SIM00002'
+    assert len(mf.randbytes('SIM00001', 100)) == 100
@@ -0,0 +1,151 @@
+import threading
+import time
+
+import numpy
+import pytest
+
+from quanttp.data.entropy_pool import EntropyPool, EntropyPools
+
+
+class Device:
+    # Hands out consecutive 4 byte counters, so every byte can be traced
+
+    def __init__(self):
+        self.offset = 0
+        self.reads = []
+        self.lock = threading.Lock()
+
+    def randbytes(self, deviceId, length):
+        with self.lock:
+            self.reads.append(length)
+            start = self.offset
+            self.offset += length
+        return counters(start, length)
+
+    def clear(self, deviceId):
+        pass
+
+    def reset(self):
+        pass
+
+
+def counters(start, length):
+    return numpy.arange(start // 4, (start + length) // 4, dtype='<u4').tobytes()
+
+
+def pool(device, capacity=64, low=16, high=48, readSize=16):
+    # Not started, the tests fill it themselves
+    return EntropyPool(device, 'SIM00001', capacity, low, high, readSize)
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_watermarks_are_checked():
+    with pytest.raises(ValueError):
+        EntropyPool(Device(), 'SIM00001', 64, 48, 16, 16)
+    with pytest.raises(ValueError):
+        EntropyPool(Device(), 'SIM00001', 64, 16, 128, 16)
+
+
+def test_take_in_order():
+    p = pool(Device())
+    p._put(counters(0, 40), p._generation)
+    assert p.available() == 40
+    assert p.take(8) == counters(0, 8)
+    assert p.take(32) == counters(8, 32)
+    assert p.available() == 0
+
+
+def test_wrap_around():
+    p = pool(Device())
+    p._put(counters(0, 48), p._generation)
+    assert p.take(40) == counters(0, 40)
+    # Written across the end of the buffer, and read back across it
+    p._put(counters(48, 48), p._generation)
+    assert p.available() == 56
+    assert p.take(56) == counters(40, 56)
+
+
+def test_put_stops_at_capacity():
+    p = pool(Device())
+    p._put(counters(0, 48), p._generation)
+    p._put(counters(48, 48), p._generation)
+    assert p.available() == 64
+    assert p.take(64) == counters(0, 64)
+
+
+def test_dry_pool_reads_the_rest_from_the_device():
+    device = Device()
+    device.offset = 1000
+    p = pool(device)
+    p._put(counters(0, 8), p._generation)
+    assert p.take(20) == counters(0, 8) + counters(1000, 12)
+    assert device.reads == [12]
+    assert p.take(4) == counters(1012, 4)
+
+
+def test_take_below_low_watermark_wakes_the_reader():
+    p = pool(Device())
+    p._put(counters(0, 40), p._generation)
+    p._refill.clear()
+    p.take(20)
+    assert not p._refill.is_set()
+    p.take(8)
+    assert p._refill.is_set()
+
+
+def test_clear_discards_pooled_bytes():
+    device = Device()
+    device.offset = 1000
+    p = pool(device)
+    p._put(counters(0, 40), p._generation)
+    p.clear()
+    assert p.available() == 0
+    assert p.take(4) == counters(1000, 4)
+
+
+def test_clear_discards_a_read_in_flight():
+    p = pool(Device())
+    generation = p._generation
+    p.clear()
+    # The reader's chunk was read before the clear
+    p._put(counters(0, 16), generation)
+    assert p.available() == 0
+    p._put(counters(16, 16), p._generation)
+    assert p.take(16) == counters(16, 16)
+
+
+def test_reader_fills_to_high_watermark_and_serves_each_byte_once():
+    device = Device()
+    p = pool(device)
+    p.start()
+    try:
+        wait_for(lambda: p.available() == 48)
+        served = []
+        for i in range(200):
+            served.append(p.take(12))
+        wait_for(lambda: p.available() == 48)
+    finally:
+        p.stop()
+    values = numpy.frombuffer(b''.join(served), dtype='<u4')
+    # Every value once, the pooled bytes are the next ones
+    assert numpy.array_equal(numpy.sort(values), numpy.arange(len(values)))
+    assert device.offset == len(values) * 4 + 48
+
+
+def test_pools_follow_the_device_list():
+    device = Device()
+    pools = EntropyPools(device, 64, 16, 48, 16)
+    pools.sync(['SIM00001', 'SIM00002'])
+    try:
+        assert sorted(pools.deviceIds()) == ['SIM00001', 'SIM00002']
+        wait_for(lambda: pools.levels() == {'SIM00001': 48, 'SIM00002': 48})
+        pools.sync(['SIM00002'])
+        assert pools.deviceIds() == ['SIM00002']
+    finally:
+        pools.stop()
@@ -0,0 +1,136 @@
+import gc
+import os
+
+import pytest
+
+from quanttp.data.entropy_spool import _PAGE, SPOOL_ONLY, EntropySpool, EntropySpools, SpoolEmpty
+
+
+def spool(path, capacity=2 * _PAGE, reserve=100):
+    # The harvester is not started, the tests append themselves
+    return EntropySpool(None, 'SIM00001', str(path), capacity, _PAGE, reserve, False, 0)
+
+
+def pattern(n, start=0):
+    return bytes((start + i) % 251 for i in range(n))
+
+
+def test_new_spool_is_empty(tmp_path):
+    s = spool(tmp_path / 'a.spool')
+    assert s.available() == 0
+    assert len(s.take(10)) == 0
+    s.close()
+    assert os.path.getsize(tmp_path / 'a.spool') == 3 * _PAGE
+
+
+def test_take_serves_each_byte_once(tmp_path):
+    s = spool(tmp_path / 'a.spool')
+    data = pattern(1000)
+    s._append(data)
+    assert s.available() == 1000
+    assert bytes(s.take(300)) == data[:300]
+    assert bytes(s.take(300)) == data[300:600]
+    assert bytes(s.take(1000)) == data[600:]
+    assert s.available() == 0
+    gc.collect()
+    s.close()
+
+
+def test_take_not_partial(tmp_path):
+    s = spool(tmp_path / 'a.spool')
+    s._append(pattern(100))
+    assert len(s.take(200, partial=False)) == 0
+    assert s.available() == 100
+    s.close()
+
+
+def test_offsets_survive_reopen(tmp_path):
+    s = spool(tmp_path / 'a.spool')
+    data = pattern(1000)
+    s._append(data)
+    assert bytes(s.take(10)) == data[:10]
+    gc.collect()
+    # Closed without any further bookkeeping, as a crash would leave it
+    s.close()
+    s = spool(tmp_path / 'a.spool')
+    # The rest of the reservation is skipped, nothing is served twice
+    assert s.available() == 1000 - 110
+    assert bytes(s.take(10)) == data[110:120]
+    gc.collect()
+    s.close()
+
+
+def test_damaged_header_discards_spool(tmp_path):
+    s = spool(tmp_path / 'a.spool')
+    s._append(pattern(1000))
+    s.close()
+    with open(tmp_path / 'a.spool', 'r+b') as f:
+        f.seek(20)
+        f.write(b'\xff')
+    s = spool(tmp_path / 'a.spool')
+    assert s.available() == 0
+    s.close()
+
+
+def test_resized_spool_is_discarded(tmp_path):
+    s = spool(tmp_path / 'a.spool')
+    s._append(pattern(1000))
+    s.close()
+    s = spool(tmp_path / 'a.spool', capacity=4 * _PAGE)
+    assert s.available() == 0
+    s.close()
+
+
+def test_wrap_around(tmp_path):
+    s = spool(tmp_path / 'a.spool', capacity=_PAGE)
+    s._append(pattern(3000))
+    assert len(s.take(3000)) == 3000
+    gc.collect()
+    data = pattern(3000, 7)
+    s._append(data)
+    assert bytes(s.take(3000)) == data
+    gc.collect()
+    s.close()
+
+
+def test_leased_bytes_are_not_overwritten(tmp_path):
+    s = spool(tmp_path / 'a.spool', capacity=_PAGE)
+    s._append(pattern(_PAGE))
+    view = s.take(1000)
+    rest = s.take(_PAGE - 1000)
+    # Everything is served, but still in use
+    assert s._free() == 0
+    del view
+    gc.collect()
+    assert s._free() == 1000
+    del rest
+    gc.collect()
+    assert s._free() == _PAGE
+    s.close()
+
+
+def test_file_in_use(tmp_path):
+    s = spool(tmp_path / 'a.spool')
+    with pytest.raises(IOError):
+        spool(tmp_path / 'a.spool')
+    s.close()
+
+
+class Live:
+
+    def randbytes(self, deviceId, length):
+        return b'\x00' * length
+
+    def clear(self, deviceId):
+        pass
+
+
+def test_spool_only_raises_when_empty(tmp_path):
+    spools = EntropySpools(Live(), None, str(tmp_path), SPOOL_ONLY)
+    spools._spools['SIM00001'] = s = spool(tmp_path / 'a.spool')
+    s._append(pattern(5))
+    with pytest.raises(SpoolEmpty):
+        spools.randbytes('SIM00001', 10)
+    assert bytes(spools.randbytes('SIM00001', 5)) == pattern(5)
+    gc.collect()
+    spools.close()
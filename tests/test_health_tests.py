@@ -0,0 +1,96 @@
+import numpy
+
+from quanttp.data.health_tests import APT_WINDOW, DEGRADED, FAILED, OK, HealthTests, apt_cutoff, rct_cutoff
+
+
+def health_tests(minEntropy=8.0, alphaExponent=20):
+    # A statistics window no test here fills
+    return HealthTests(minEntropy, alphaExponent, 1 << 30, 5.0)
+
+
+def distinct(n, start=0):
+    # No value repeats, and each occurs at most twice per APT window
+    return bytes((start + i) % 256 for i in range(n))
+
+
+def apt_window(count):
+    # A window starting with count zeros, spread out so that the RCT does not
+    # fire, the other values are 1 to 255
+    window = bytearray(1 + i % 255 for i in range(APT_WINDOW))
+    for i in range(count):
+        window[i * 2] = 0
+    return bytes(window)
+
+
+def test_rct_cutoff():
+    # SP 800-90B section 4.4.1
+    assert rct_cutoff(1, 20) == 21
+    assert rct_cutoff(8, 20) == 4
+
+
+def test_apt_cutoff():
+    # SP 800-90B section 4.4.2, table 2 for non-binary samples
+    for minEntropy, cutoff in ((0.5, 410), (1, 311), (2, 177), (4, 62), (8, 13)):
+        assert apt_cutoff(minEntropy, 20) == cutoff
+
+
+def test_rct_fails_at_cutoff():
+    health = health_tests()
+    assert health.rctCutoff == 4
+    assert health.update(distinct(10) + b'\x07' * 3 + distinct(10, 100)) == OK
+    assert health.update(distinct(10) + b'\x07' * 4 + distinct(10, 100)) == FAILED
+    assert health.failure == 'repetition count'
+
+
+def test_rct_run_carries_over_reads():
+    health = health_tests()
+    assert health.update(distinct(5, 10) + b'\x07' * 2) == OK
+    assert health.update(b'\x07') == OK
+    assert health.update(b'\x07' + distinct(5, 20)) == FAILED
+
+
+def test_rct_run_carries_over_single_byte_reads():
+    health = health_tests()
+    for i in range(3):
+        assert health.update(b'\x07') == OK
+    assert health.update(b'\x07') == FAILED
+
+
+def test_rct_run_ends_at_another_value():
+    health = health_tests()
+    assert health.update(b'\x07' * 3) == OK
+    assert health.update(b'\x08' + b'\x07' * 3) == OK
+
+
+def test_apt_fails_at_cutoff():
+    cutoff = apt_cutoff(8, 20)
+    for count, status in ((cutoff - 1, OK), (cutoff, FAILED)):
+        health = health_tests()
+        assert health.update(apt_window(count)) == status
+
+
+def test_apt_window_spans_reads():
+    window = apt_window(apt_cutoff(8, 20))
+    health = health_tests()
+    assert health.update(window[:100]) == OK
+    assert health.update(window[100:]) == FAILED
+    assert health.failure == 'adaptive proportion'
+
+
+def test_failed_until_reset():
+    health = health_tests()
+    assert health.update(b'\x07' * 4) == FAILED
+    assert health.update(distinct(100)) == FAILED
+    health.reset()
+    assert health.update(distinct(100)) == OK
+
+
+def test_statistics_flag_bias():
+    # Low enough a min-entropy for the RCT and APT to pass 16 values
+    health = HealthTests(1.0, 40, 64 * 1024, 5.0)
+    rng = numpy.random.default_rng(1)
+    # Low bits always set, far too many ones
+    biased = rng.integers(0, 256, 64 * 1024, dtype=numpy.uint8) | 0x0f
+    assert health.update(rng.integers(0, 256, 64 * 1024, dtype=numpy.uint8).tobytes()) == OK
+    assert health.update(biased.tobytes()) == DEGRADED
+    assert health.update(rng.integers(0, 256, 64 * 1024, dtype=numpy.uint8).tobytes()) == OK
@@ -0,0 +1,105 @@
+import gevent
+import numpy
+import pytest
+
+from quanttp.data.device_recovery import DeviceUnavailable
+from quanttp.data.multi_device import ANY, XOR, MultiDeviceRouter
+
+
+class Source:
+    # Device n returns bytes of value n, at rates[deviceId] bytes per second
+
+    def __init__(self, rates, failing=()):
+        self.rates = rates
+        self.failing = set(failing)
+        self.reads = []
+
+    def randbytes(self, deviceId, length):
+        self.reads.append((deviceId, length))
+        if deviceId in self.failing:
+            raise IOError(deviceId + ' failed')
+        gevent.sleep(length / self.rates[deviceId])
+        return bytes([int(deviceId[-1])]) * length
+
+    def clear(self, deviceId):
+        pass
+
+
+def router(source, splitThreshold=1000):
+    return MultiDeviceRouter(source, lambda: sorted(source.rates), splitThreshold)
+
+
+def test_any_small_read_goes_to_one_device():
+    source = Source({'SIM00001': 1e6, 'SIM00002': 1e6})
+    assert len(router(source).randbytes(ANY, 100)) == 100
+    assert len(source.reads) == 1
+
+
+def test_any_splits_in_proportion_to_throughput():
+    source = Source({'SIM00001': 1e6, 'SIM00002': 3e6})
+    r = router(source)
+    # Learn the rates
+    r.randbytes('SIM00001', 10000)
+    r.randbytes('SIM00002', 10000)
+    source.reads.clear()
+    data = r.randbytes(ANY, 40000)
+    assert len(data) == 40000
+    lengths = dict(source.reads)
+    assert lengths['SIM00001'] == pytest.approx(10000, rel=0.2)
+    assert lengths['SIM00002'] == pytest.approx(30000, rel=0.2)
+    # The parts are joined in device order
+    assert data == b'\x01' * lengths['SIM00001'] + b'\x02' * lengths['SIM00002']
+
+
+def test_any_splits_evenly_without_measurements():
+    source = Source({'SIM00001': 1e6, 'SIM00002': 1e6})
+    router(source).randbytes(ANY, 10000)
+    assert sorted(source.reads) == [('SIM00001', 5000), ('SIM00002', 5000)]
+
+
+@pytest.mark.parametrize('length', [100, 10000])
+def test_any_fails_over(length):
+    source = Source({'SIM00001': 1e6, 'SIM00002': 1e6}, failing=['SIM00001'])
+    assert router(source).randbytes(ANY, length) == b'\x02' * length
+
+
+def test_any_fails_when_every_device_fails():
+    source = Source({'SIM00001': 1e6, 'SIM00002': 1e6}, failing=['SIM00001', 'SIM00002'])
+    with pytest.raises(IOError):
+        router(source).randbytes(ANY, 100)
+
+
+def test_xor_combines_one_read_per_device():
+    source = Source({'SIM00001': 1e6, 'SIM00002': 1e6, 'SIM00004': 1e6})
+    data = router(source).randbytes(XOR, 1000)
+    assert data == bytes([1 ^ 2 ^ 4]) * 1000
+    assert sorted(source.reads) == [('SIM00001', 1000), ('SIM00002', 1000), ('SIM00004', 1000)]
+
+
+def test_xor_of_random_streams():
+    streams = {'SIM00001': numpy.random.default_rng(1).bytes(1000), 'SIM00002': numpy.random.default_rng(2).bytes(1000)}
+
+    class Streams:
+        def randbytes(self, deviceId, length):
+            return streams[deviceId]
+
+    data = MultiDeviceRouter(Streams(), lambda: sorted(streams)).randbytes(XOR, 1000)
+    assert data == bytes(a ^ b for a, b in zip(streams['SIM00001'], streams['SIM00002']))
+
+
+@pytest.mark.parametrize('deviceId', [ANY, XOR])
+def test_no_devices_is_unavailable(deviceId):
+    with pytest.raises(DeviceUnavailable):
+        MultiDeviceRouter(Source({}), lambda: []).randbytes(deviceId, 100)
+
+
+def test_read_function_gets_real_devices():
+    source = Source({'SIM00001': 1e6, 'SIM00002': 1e6})
+    reads = []
+
+    def read(deviceId, length):
+        reads.append(deviceId)
+        return source.randbytes(deviceId, length)
+
+    router(source).randbytes(XOR, 10, read)
+    assert sorted(reads) == ['SIM00001', 'SIM00002']
@@ -0,0 +1,136 @@
+import threading
+
+import gevent
+import numpy
+import pytest
+
+from quanttp.data.request_coalescer import RequestCoalescer
+
+STREAM = numpy.random.default_rng(1).bytes(1 << 20)
+
+
+class Device:
+    # Hands out consecutive bytes of stream
+
+    def __init__(self, delay=0.001, failing=False, stream=STREAM):
+        self.delay = delay
+        self.failing = failing
+        self.stream = stream
+        self.offset = 0
+        self.reads = []
+
+    def randbytes(self, deviceId, length):
+        self.reads.append(length)
+        gevent.sleep(self.delay)
+        if self.failing:
+            raise IOError('read failed')
+        data = self.stream[self.offset:self.offset + length]
+        self.offset += length
+        return data
+
+    def clear(self, deviceId):
+        pass
+
+
+def coalescer(device, window=0.01, maxBytes=4096, maxRequest=1024):
+    return RequestCoalescer(device, window, maxBytes, maxRequest)
+
+
+def test_concurrent_reads_share_one_device_read():
+    device = Device()
+    c = coalescer(device)
+    greenlets = [gevent.spawn(c.randbytes, 'SIM00001', 10 + i) for i in range(20)]
+    gevent.joinall(greenlets, raise_error=True)
+    assert device.reads == [sum(10 + i for i in range(20))]
+    # Disjoint slices in the order of the requests, together the whole read
+    assert b''.join(greenlet.value for greenlet in greenlets) == STREAM[:device.offset]
+    assert [len(greenlet.value) for greenlet in greenlets] == [10 + i for i in range(20)]
+
+
+def test_no_byte_is_served_twice():
+    # A stream of distinct 4 byte counters, read in multiples of 4 bytes
+    device = Device(delay=0.0005, stream=numpy.arange(1 << 16, dtype='<u4').tobytes())
+    c = coalescer(device, window=0.001, maxBytes=512)
+    served = []
+
+    def client(length):
+        for i in range(20):
+            served.append(numpy.frombuffer(c.randbytes('SIM00001', length), dtype='<u4'))
+
+    gevent.joinall([gevent.spawn(client, length) for length in (4, 8, 64, 100, 300)], raise_error=True)
+    assert len(device.reads) > 1
+    values = numpy.sort(numpy.concatenate(served))
+    assert numpy.array_equal(values, numpy.arange(device.offset // 4))
+
+
+def test_window_flushes_a_partial_batch():
+    device = Device(delay=0)
+    c = coalescer(device, window=0.05)
+    greenlet = gevent.spawn(c.randbytes, 'SIM00001', 100)
+    gevent.sleep(0.02)
+    assert device.reads == [] and not greenlet.ready()
+    greenlet.join(1)
+    assert device.reads == [100]
+    assert greenlet.value == STREAM[:100]
+
+
+def test_max_bytes_flushes_before_the_window():
+    device = Device(delay=0)
+    c = coalescer(device, window=10, maxBytes=1000)
+    greenlets = [gevent.spawn(c.randbytes, 'SIM00001', 250) for i in range(4)]
+    gevent.joinall(greenlets, timeout=1, raise_error=True)
+    assert all(greenlet.ready() for greenlet in greenlets)
+    assert device.reads == [1000]
+
+
+def test_requests_after_a_flush_start_the_next_batch():
+    device = Device(delay=0.01)
+    c = coalescer(device, window=10, maxBytes=1000)
+    first = [gevent.spawn(c.randbytes, 'SIM00001', 500) for i in range(2)]
+    gevent.sleep(0.001)
+    second = [gevent.spawn(c.randbytes, 'SIM00001', 500) for i in range(2)]
+    gevent.joinall(first + second, timeout=1, raise_error=True)
+    assert device.reads == [1000, 1000]
+    assert b''.join(greenlet.value for greenlet in first + second) == STREAM[:2000]
+
+
+def test_devices_are_batched_separately():
+    device = Device()
+    c = coalescer(device)
+    gevent.joinall([gevent.spawn(c.randbytes, deviceId, 100) for deviceId in ('SIM00001', 'SIM00002', 'SIM00001')])
+    assert sorted(device.reads) == [100, 200]
+
+
+def test_device_error_reaches_every_waiter():
+    device = Device(failing=True)
+    c = coalescer(device)
+    greenlets = [gevent.spawn(c.randbytes, 'SIM00001', 10) for i in range(5)]
+    gevent.joinall(greenlets)
+    assert len(device.reads) == 1
+    assert all(isinstance(greenlet.exception, IOError) for greenlet in greenlets)
+    # The next batch reads again
+    device.failing = False
+    assert len(c.randbytes('SIM00001', 10)) == 10
+
+
+def test_large_reads_are_not_coalesced():
+    device = Device(delay=0)
+    c = coalescer(device, maxRequest=1024)
+    gevent.joinall([gevent.spawn(c.randbytes, 'SIM00001', 2000) for i in range(3)])
+    assert device.reads == [2000, 2000, 2000]
+
+
+def test_threads_are_not_coalesced():
+    device = Device(delay=0)
+    c = coalescer(device)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(c.randbytes('SIM00001', 10)))
+    thread.start()
+    thread.join()
+    assert device.reads == [10] and results == [STREAM[:10]]
+
+
+@pytest.mark.parametrize('length', [1, 1024])
+def test_single_read(length):
+    device = Device(delay=0)
+    assert coalescer(device).randbytes('SIM00001', length) == STREAM[:length]
@@ -0,0 +1,196 @@
+import gevent
+import pytest
+
+from quanttp import scheduler
+from quanttp.data.multi_device import MultiDeviceRouter
+from quanttp.scheduler import FairScheduler, QuotaExceeded
+
+QUANTUM = 1000
+
+
+class Device:
+    # Reads one at a time per greenlet, and records the bytes in flight
+
+    def __init__(self, delay=0.0001, failing=False):
+        self.delay = delay
+        self.failing = failing
+        self.reads = 0
+        self.inFlight = 0
+        self.peakInFlight = 0
+
+    def randbytes(self, deviceId, length):
+        self.inFlight += length
+        self.peakInFlight = max(self.peakInFlight, self.inFlight)
+        try:
+            gevent.sleep(self.delay)
+            if self.failing:
+                raise IOError('read failed')
+        finally:
+            self.inFlight -= length
+        self.reads += 1
+        return bytes(length)
+
+    def clear(self, deviceId):
+        pass
+
+
+def fair_scheduler(device, maxInFlight=QUANTUM, classes=None, clients=None, defaultRate=0):
+    return FairScheduler(MultiDeviceRouter(device, lambda: ['SIM00001']), quantum=QUANTUM, maxInFlight=maxInFlight,
+                         classes=classes or {'normal': 1}, clients=clients or {}, defaultRate=defaultRate, burst=1.0)
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduler.time, 'monotonic', clock)
+    return clock
+
+
+def test_pieces_are_joined():
+    device = Device()
+    data = fair_scheduler(device).randbytes('alice', 'SIM00001', 2500)
+    assert len(data) == 2500
+    assert device.reads == 3
+
+
+def test_shares_follow_class_weights():
+    device = Device()
+    s = fair_scheduler(device, classes={'high': 3, 'normal': 1}, clients={'alice': ('high', None)})
+    finished = {}
+
+    def read(clientKey):
+        s.randbytes(clientKey, 'SIM00001', 30 * QUANTUM)
+        finished[clientKey] = device.reads
+
+    gevent.joinall([gevent.spawn(read, 'alice'), gevent.spawn(read, 'bob')])
+    # Three pieces of alice's for every one of bob's
+    assert 38 <= finished['alice'] <= 42
+    assert finished['bob'] == 60
+
+
+def test_equal_weights_share_equally():
+    device = Device()
+    s = fair_scheduler(device)
+    finished = {}
+
+    def read(clientKey):
+        s.randbytes(clientKey, 'SIM00001', 30 * QUANTUM)
+        finished[clientKey] = device.reads
+
+    gevent.joinall([gevent.spawn(read, 'alice'), gevent.spawn(read, 'bob')])
+    assert sorted(finished.values()) == [59, 60]
+
+
+def test_small_request_goes_ahead_of_bulk():
+    device = Device()
+    s = fair_scheduler(device)
+    bulk = gevent.spawn(s.randbytes, 'bulk', 'SIM00001', 100 * QUANTUM)
+    gevent.sleep(0.002)
+    start = device.reads
+    assert len(s.randbytes('small', 'SIM00001', 100)) == 100
+    # At most the bulk piece being read finishes first
+    assert device.reads - start <= 2
+    assert not bulk.ready()
+    bulk.kill()
+
+
+def test_back_to_back_client_gets_no_more_than_its_share():
+    device = Device(delay=0)
+    s = fair_scheduler(device)
+    received = [0]
+    done = []
+
+    def sequential():
+        while not done:
+            received[0] += len(s.randbytes('sequential', 'SIM00001', 4 * QUANTUM))
+
+    reader = gevent.spawn(sequential)
+    gevent.sleep(0)
+    s.randbytes('backlogged', 'SIM00001', 200 * QUANTUM)
+    done.append(True)
+    reader.join()
+    assert received[0] <= 200 * QUANTUM
+
+
+def test_emptied_flow_stays_for_one_round():
+    # Slow enough that the round is not over when the request returns
+    device = Device(delay=0.01)
+    s = fair_scheduler(device)
+    backlogged = gevent.spawn(s.randbytes, 'backlogged', 'SIM00001', 5 * QUANTUM)
+    gevent.sleep(0.001)
+    s.randbytes('sequential', 'SIM00001', QUANTUM)
+    queue = s._devices['SIM00001']
+    assert list(queue.old) == ['backlogged', 'sequential'] and not queue.new
+    backlogged.join()
+    # Dropped once a round went by without a request
+    assert 'sequential' not in queue.old
+
+
+def test_max_in_flight():
+    device = Device()
+    s = fair_scheduler(device, maxInFlight=3 * QUANTUM)
+    s.randbytes('alice', 'SIM00001', 20 * QUANTUM)
+    assert device.peakInFlight == 3 * QUANTUM
+
+
+def test_new_flow_may_exceed_max_in_flight_by_its_first_quantum():
+    device = Device()
+    s = fair_scheduler(device, maxInFlight=3 * QUANTUM)
+    alice = gevent.spawn(s.randbytes, 'alice', 'SIM00001', 20 * QUANTUM)
+    gevent.sleep(0)
+    s.randbytes('bob', 'SIM00001', 20 * QUANTUM)
+    alice.join()
+    assert device.peakInFlight == 4 * QUANTUM
+
+
+def test_rate_limit(clock):
+    s = fair_scheduler(Device(), defaultRate=1000)
+    client = s.client('alice')
+    # The bucket holds a second of tokens, one request may overdraw it
+    client.randbytes('SIM00001', 3500)
+    with pytest.raises(QuotaExceeded) as e:
+        s.client('alice').randbytes('SIM00001', 1)
+    assert e.value.retryAfter == 3
+    clock.now += 2.4
+    with pytest.raises(QuotaExceeded) as e:
+        s.client('alice').randbytes('SIM00001', 1)
+    assert e.value.retryAfter == 1
+    clock.now += 0.2
+    s.client('alice').randbytes('SIM00001', 1)
+    # Other clients have their own bucket
+    s.client('bob').randbytes('SIM00001', 1)
+
+
+def test_client_rate_overrides_default(clock):
+    s = fair_scheduler(Device(), clients={'alice': ('normal', 100)}, defaultRate=0)
+    s.client('alice').randbytes('SIM00001', 200)
+    with pytest.raises(QuotaExceeded):
+        s.client('alice').randbytes('SIM00001', 1)
+    for i in range(5):
+        s.client('bob').randbytes('SIM00001', 10000)
+
+
+def test_failed_request_is_not_charged(clock):
+    device = Device(failing=True)
+    s = fair_scheduler(device, defaultRate=1000)
+    with pytest.raises(IOError):
+        s.client('alice').randbytes('SIM00001', 5000)
+    device.failing = False
+    s.client('alice').randbytes('SIM00001', 5000)
+    with pytest.raises(QuotaExceeded):
+        s.client('alice').randbytes('SIM00001', 1)
+
+
+def test_only_listed_keys_are_known():
+    s = fair_scheduler(Device(), clients={'alice': ('normal', None)})
+    assert s.knownClient('alice')
+    assert not s.knownClient('mallory')
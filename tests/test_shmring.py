@@ -0,0 +1,141 @@
+import os
+import stat
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('fcntl')
+
+from quanttp.shmring import _PAGE, LEASES, ShmClient, ShmRing, ring_path
+
+
+def pattern(n, start=0):
+    return bytes((start + i) % 251 for i in range(n))
+
+
+def rings(tmp_path, capacity=_PAGE):
+    path = ring_path(str(tmp_path), 'SIM00001')
+    return ShmRing(path, capacity), ShmRing(path)
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+
+def test_claims_are_disjoint(tmp_path):
+    server, client = rings(tmp_path)
+    data = pattern(1000)
+    server.publish(data)
+    assert client.available() == 1000
+    slot, view = client.claim(300)
+    assert bytes(view) == data[:300]
+    view.release()
+    client.release(slot)
+    slot, view = client.claim(700)
+    assert bytes(view) == data[300:]
+    view.release()
+    client.release(slot)
+    assert client.claim(1) is None
+    client.close()
+    server.close()
+
+
+def test_wrap_around_is_copied(tmp_path):
+    server, client = rings(tmp_path)
+    server.publish(pattern(3000))
+    slot, view = client.claim(3000)
+    view.release()
+    client.release(slot)
+    data = pattern(3000, 7)
+    assert server.free(3000) >= 3000
+    server.publish(data)
+    slot, copied = client.claim(3000)
+    assert slot is None
+    assert copied == data
+    client.close()
+    server.close()
+
+
+def test_lease_holds_region(tmp_path):
+    server, client = rings(tmp_path)
+    server.publish(pattern(_PAGE))
+    slot, view = client.claim(1000)
+    rest, restView = client.claim(_PAGE - 1000)
+    # Everything is claimed, the first region is still being read
+    assert server.free(1) == 0
+    view.release()
+    client.release(slot)
+    assert server.free(1) == 1000
+    restView.release()
+    client.release(rest)
+    assert server.free(1) == _PAGE
+    client.close()
+    server.close()
+
+
+def test_lease_of_dead_reader_is_reclaimed(tmp_path):
+    server, client = rings(tmp_path)
+    server.publish(pattern(_PAGE))
+    slot, view = client.claim(_PAGE)
+    view.release()
+    client._setLease(slot, dead_pid(), 0)
+    # Only reclaimed when the space is needed
+    assert server.free(_PAGE) == _PAGE
+    assert server._lease(slot) == (0, 0)
+    client.close()
+    server.close()
+
+
+def test_claim_copies_when_leases_run_out(tmp_path):
+    server, client = rings(tmp_path)
+    server.publish(pattern(LEASES + 1))
+    claims = [client.claim(1) for i in range(LEASES + 1)]
+    assert all(slot is not None for slot, view in claims[:LEASES])
+    assert claims[-1] == (None, pattern(LEASES + 1)[-1:])
+    for slot, view in claims[:LEASES]:
+        view.release()
+    client.close()
+    server.close()
+
+
+def test_ring_is_private(tmp_path):
+    server, client = rings(tmp_path)
+    assert stat.S_IMODE(os.stat(server.path).st_mode) == 0o600
+    client.close()
+    server.close()
+
+
+def test_ring_for_group(tmp_path):
+    server = ShmRing(ring_path(str(tmp_path), 'SIM00001'), _PAGE, str(os.getgid()))
+    assert stat.S_IMODE(os.stat(server.path).st_mode) == 0o660
+    assert os.stat(server.path).st_gid == os.getgid()
+    server.close()
+
+
+def test_client(tmp_path):
+    server = ShmRing(ring_path(str(tmp_path), 'SIM00001'), _PAGE)
+    data = pattern(1000)
+    server.publish(data)
+    client = ShmClient('SIM00001', str(tmp_path), timeout=0.01)
+    assert client.randbytes(10) == data[:10]
+    with client.claim(90) as view:
+        assert bytes(view) == data[10:100]
+    with pytest.raises(ValueError):
+        client.randbytes(_PAGE)
+    with pytest.raises(TimeoutError):
+        client.randbytes(1000)
+    server.shutdown()
+    with pytest.raises(IOError):
+        client.randbytes(1000)
+    client.close()
+    server.close()
+
+
+def test_not_a_ring(tmp_path):
+    path = tmp_path / 'x.ring'
+    path.write_bytes(b'\x00' * 2 * _PAGE)
+    with pytest.raises(ValueError):
+        ShmRing(str(path))
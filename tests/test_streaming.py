@@ -0,0 +1,64 @@
+import base64
+import json
+
+import pytest
+
+from quanttp import streaming
+
+
+class Source:
+    # Consecutive bytes, so that every read can be told apart
+
+    def __init__(self):
+        self.offset = 0
+        self.reads = []
+
+    def randbytes(self, deviceId, length):
+        data = bytes((self.offset + i) % 251 for i in range(length))
+        self.offset += length
+        self.reads.append(length)
+        return data
+
+
+def split(data, sizes):
+    pieces = []
+    for size in sizes:
+        pieces.append(data[:size])
+        data = data[size:]
+    return pieces + [data]
+
+
+@pytest.mark.parametrize('sizes', [(), (1,), (1, 1, 1), (2, 2, 2), (3, 3), (4, 5, 7), (1000,), (0, 5, 0)])
+@pytest.mark.parametrize('length', [0, 1, 2, 3, 1000, 1001, 1002])
+def test_base64_stream_matches_whole(sizes, length):
+    data = Source().randbytes('SIM00001', length)
+    pieces = list(streaming.base64_stream(split(data, sizes)))
+    assert ''.join(pieces) == base64.b64encode(data).decode('utf-8')
+    # Padding only at the very end
+    for piece in pieces[:-1]:
+        assert len(piece) % 4 == 0 and not piece.endswith('=')
+
+
+def test_hex_stream_matches_whole():
+    data = Source().randbytes('SIM00001', 1000)
+    assert ''.join(streaming.hex_stream(split(data, (3, 10, 500)))) == data.hex()
+
+
+@pytest.mark.parametrize('prefetch', [0, 1, 4])
+def test_chunks_in_order(prefetch):
+    source = Source()
+    data = b''.join(streaming.chunks(source, 'SIM00001', 2500, 1000, prefetch))
+    assert data == Source().randbytes('SIM00001', 2500)
+    assert source.reads == [1000, 1000, 500]
+
+
+@pytest.mark.parametrize('size, chunkSize', [(4, 1024), (16, 16), (32, 10)])
+@pytest.mark.parametrize('encode', [streaming.encode_hex, streaming.encode_base64])
+def test_json_string_array_matches_json(size, chunkSize, encode):
+    length = 37
+    meta = {"type": "string", "length": length, "size": size}
+    streamed = ''.join(streaming.json_envelope(meta, streaming.json_string_array(
+        Source(), 'SIM00001', length, size, encode, chunkSize)))
+    data = Source().randbytes('SIM00001', length * size)
+    expected = dict(meta, data=[encode(data[i * size:(i + 1) * size]) for i in range(length)], success=True)
+    assert streamed == json.dumps(expected)
@@ -0,0 +1,41 @@
+import numpy
+import pytest
+
+from quanttp import config, subscriptions
+from quanttp.data import conversions
+
+
+def test_batch_size():
+    assert subscriptions.batch_size('1') == 1
+    assert subscriptions.batch_size(str(config.WS_MAX_BATCH)) == config.WS_MAX_BATCH
+    with pytest.raises(subscriptions.TooLarge, match='BATCH TOO LARGE %d' % config.WS_MAX_BATCH):
+        subscriptions.batch_size(str(config.WS_MAX_BATCH + 1))
+    for text in ('0', '-1', 'x'):
+        with pytest.raises(ValueError):
+            subscriptions.batch_size(text)
+
+
+def test_chunk_size():
+    assert subscriptions.chunk_size(str(config.WS_MAX_CHUNK)) == config.WS_MAX_CHUNK
+    with pytest.raises(subscriptions.TooLarge, match='CHUNK TOO LARGE %d' % config.WS_MAX_CHUNK):
+        subscriptions.chunk_size(str(config.WS_MAX_CHUNK + 1))
+    with pytest.raises(ValueError):
+        subscriptions.chunk_size('0')
+
+
+@pytest.mark.parametrize('batch, readValues', [(1, 256), (3, 256), (256, 256), (300, 256), (7, 10)])
+def test_value_framer_yields_every_value(batch, readValues):
+    readSize, framer = subscriptions.value_framer(conversions.int32_array, conversions.INT32_SIZE, batch, readValues)
+    assert readSize % (batch * conversions.INT32_SIZE) == 0
+    data = bytes(i % 251 for i in range(readSize))
+    frames = list(framer(data))
+    assert all(len(frame.split(',')) == batch for frame in frames)
+    assert ','.join(frames) == ','.join(str(value) for value in conversions.int32_array(data).tolist())
+
+
+def test_packed_framer_yields_every_value():
+    readSize, framer = subscriptions.packed_framer(conversions.uniform_array, conversions.UNIFORM_SIZE, 3, 10, '<f8')
+    data = bytes(i % 251 for i in range(readSize))
+    frames = list(framer(data))
+    assert all(len(frame) == 3 * 8 for frame in frames)
+    assert numpy.array_equal(numpy.frombuffer(b''.join(frames), '<f8'), conversions.uniform_array(data))